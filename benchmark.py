@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import _version
+
+# Skips loading secrets which are not needed here
+_version.debug = True
+
+from musicbot import config, music_apis
+
+_words = ["love", "night", "heart", "fire", "dance", "dream", "summer", "rain", "road", "light", "shadow", "river",
+          "golden", "wild", "blue", "storm", "city", "home", "ocean", "star"]
+
+
+@contextmanager
+def _timed(name, results):
+    start = time.perf_counter()
+    yield
+    results.append((name, time.perf_counter() - start))
+
+
+def _song_rows(songs_path, count):
+    word_count = len(_words)
+    for i in range(count):
+        song_id = os.path.join(songs_path, "song{}".format(i))
+        title = "{} {} {}".format(_words[i % word_count], _words[(i // word_count) % word_count], i)
+        artist = "{} artist {}".format(_words[(i * 7) % word_count], i % 1000)
+        duration = "{:02d}:{:02d}".format((i // 60) % 10, i % 60)
+        yield (song_id, title, artist, "{} - {}".format(artist, title), None, song_id + ".mp3", duration,
+               music_apis._parse_duration(duration))
+
+
+def benchmark_offline(song_count):
+    """
+    Measure playlist activation and search times of the OfflineAPI on a synthetic library.
+    The library is created in a temporary directory, the config state is restored afterwards.
+    """
+    results = []
+    songs_path = tempfile.mkdtemp()
+    old_songs_path = music_apis._songs_path
+    old_state = dict(config._state)
+    try:
+        music_apis._songs_path = songs_path
+        open(os.path.join(songs_path, "Tj6fhurtstzgdpvfm4xv6i5cei4.mp3"), "w").close()
+        config._state.pop("active_offline_playlist", None)
+
+        with _timed("create database", results):
+            api = music_apis.OfflineAPI()
+
+        playlist_id = os.path.join(songs_path, "playlist")
+        with _timed("insert {} songs".format(song_count), results):
+            with api._db.transaction() as db:
+                db.execute("INSERT INTO playlists(playlistId, name) VALUES(?, ?)", [playlist_id, "benchmark"])
+                db.executemany(api._insert_song_query, _song_rows(songs_path, song_count))
+                db.execute("INSERT INTO playlistSongs(playlistId, songId) SELECT ?, songId FROM songs",
+                           [playlist_id])
+
+        with _timed("activate playlist", results):
+            api.set_active_playlist(playlist_id)
+        with _timed("get suggestions", results):
+            api.get_suggestions(20)
+        with _timed("get playlist", results):
+            api.get_playlist()
+        with _timed("get playlist (cached)", results):
+            api.get_playlist()
+
+        for query in ["love", "gold", "summer night", "storm artist 42", "nothing matches"]:
+            with _timed("search '{}' (first page)".format(query), results):
+                api.search_page(query, 0, 50)
+            if api._fts_enabled:
+                api._fts_enabled = False
+                with _timed("search '{}' (first page, LIKE)".format(query), results):
+                    api.search_page(query, 0, 50)
+                api._fts_enabled = True
+
+        api._db.close_all()
+    finally:
+        music_apis._songs_path = old_songs_path
+        config._state.clear()
+        config._state.update(old_state)
+        config._save_state()
+        shutil.rmtree(songs_path)
+    return results
+
+
+class _BenchmarkAPI(music_apis.AbstractAPI):
+    def get_name(self):
+        return "benchmark_api"
+
+
+def _requests_per_second(fn, duration):
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while True:
+        fn()
+        count += 1
+        now = time.perf_counter()
+        if now >= end:
+            return count / (now - start)
+
+
+def benchmark_player_state(queue_length, duration=2.0):
+    """
+    Measure how many player_state response bodies can be built per second,
+    by encoding the Song.to_json dicts and by joining cached JSON fragments.
+    """
+    api = _BenchmarkAPI()
+    songs = [music_apis.Song(str(i), api, title=title, description=artist, str_rep=str_rep, duration=duration_str,
+                             user="user{}".format(i % 30))
+             for i, (_, title, artist, str_rep, _, _, duration_str, _) in
+             enumerate(_song_rows("", queue_length + 21))]
+    current_song = songs[0]
+    last_played = songs[1:21]
+    queue = songs[21:]
+
+    def _to_json_dicts():
+        return json.dumps({"current_song": current_song.to_json(),
+                           "last_played": list(map(music_apis.Song.to_json, last_played)),
+                           "queue": list(map(music_apis.Song.to_json, queue)),
+                           "paused": False})
+
+    def _fragments():
+        return '{{"current_song": {}, "last_played": {}, "queue": {}, "paused": {}}}'.format(
+            current_song.to_json_fragment(), music_apis.songs_to_json(last_played), music_apis.songs_to_json(queue),
+            json.dumps(False))
+
+    if json.loads(_to_json_dicts()) != json.loads(_fragments()):
+        raise ValueError("Serializations differ")
+    return [("to_json dicts", _requests_per_second(_to_json_dicts, duration)),
+            ("cached JSON fragments", _requests_per_second(_fragments, duration))]
+
+
+def _print_results(title, results):
+    print(title)
+    for name, duration in results:
+        print("  {:<45} {:>10.2f} ms".format(name, duration * 1000))
+
+
+def _print_rates(title, results):
+    print(title)
+    for name, rate in results:
+        print("  {:<45} {:>10.0f} requests/s".format(name, rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run MusicBot benchmarks")
+    parser.add_argument("--songs", type=int, default=100000, help="the size of the synthetic offline library")
+    parser.add_argument("--queue", type=int, default=500, help="the queue length for the player_state benchmark")
+    parser.add_argument("--benchmark", choices=["all", "offline", "player_state"], default="all",
+                        help="the benchmark to run")
+    args = parser.parse_args()
+    if args.benchmark in ("all", "offline"):
+        _print_results("Offline library ({} songs)".format(args.songs), benchmark_offline(args.songs))
+    if args.benchmark in ("all", "player_state"):
+        _print_rates("player_state body ({} queued songs)".format(args.queue), benchmark_player_state(args.queue))
@@ -0,0 +1,258 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from io import BytesIO
+
+import pylru
+
+from musicbot import async_handler
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is optional, without it only the original images are served
+    Image = None
+
+# Magic numbers -> (MIME type, file extension, Pillow format)
+_formats = [
+    (b"\xff\xd8\xff", ("image/jpeg", "jpg", "JPEG")),
+    (b"\x89PNG\r\n\x1a\n", ("image/png", "png", "PNG")),
+    (b"GIF87a", ("image/gif", "gif", "GIF")),
+    (b"GIF89a", ("image/gif", "gif", "GIF")),
+]
+
+_hash_pattern = re.compile(r"^[0-9a-f]{64}$")
+
+
+def detect_format(data):
+    """
+    Detect the format of an image by its magic number.
+    :return: a (mime_type, extension, pillow_format) tuple, or None if the format is unknown
+    """
+    for magic, image_format in _formats:
+        if data.startswith(magic):
+            return image_format
+    return None
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class AlbumArt(object):
+    """
+    An album art file, ready to be served.
+    """
+
+    def __init__(self, path, mime_type, content_hash, size=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        path -- the path to the image file
+        mime_type -- the MIME type of the image
+        content_hash -- the SHA-256 hash of the original image
+        size -- the maximum width and height of the thumbnail, None for the original image
+        """
+        self.path = path
+        self.mime_type = mime_type
+        self.content_hash = content_hash
+        self.size = size
+
+
+class AlbumArtStore(object):
+    """
+    Extracts the album art of the OfflineAPI from its database into image files, which can be served with sendfile.
+
+    Files are named by the SHA-256 hash of the original image, so songs of the same album share them and a file never
+    changes once it has been written. Thumbnails in a few sizes are generated along with them if Pillow is installed.
+    The hash of every song's album art is stored in the database and cached in memory,
+    so serving album art doesn't read the image blobs again.
+    """
+
+    def __init__(self, db, directory, sizes=(64, 128, 300), index_size=8192):
+        """
+        Constructor
+
+        Keyword arguments:
+        db -- the ConnectionManager of the offline database
+        directory -- the directory the image files are written to
+        sizes -- the maximum width and height of the generated thumbnails
+        index_size -- the number of songs whose album art hash is cached in memory
+        """
+        self._db = db
+        self._directory = directory
+        self._sizes = sorted(sizes)
+        # Song ID -> (content_hash, image_format), or None if the song has no album art
+        self._index = pylru.lrucache(index_size)
+        self._index_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, content_hash, extension, size=None):
+        if size:
+            name = "{}_{}.{}".format(content_hash, size, extension)
+        else:
+            name = "{}.{}".format(content_hash, extension)
+        return os.path.join(self._directory, content_hash[:2], name)
+
+    def _write_thumbnails(self, data, content_hash, image_format):
+        if Image is None:
+            return
+        extension, pillow_format = image_format[1:]
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image.load()
+                for size in self._sizes:
+                    path = self._get_path(content_hash, extension, size)
+                    if os.path.isfile(path):
+                        continue
+                    thumbnail = image.copy()
+                    thumbnail.thumbnail((size, size))
+                    if pillow_format == "JPEG" and thumbnail.mode not in ("RGB", "L"):
+                        thumbnail = thumbnail.convert("RGB")
+                    out = BytesIO()
+                    thumbnail.save(out, pillow_format)
+                    _write_atomic(path, out.getvalue())
+        except (OSError, ValueError) as e:
+            # Pillow raises OSError subclasses for broken images, the originals are served instead
+            logging.getLogger("musicbot").warning("Could not create thumbnails of album art %s: %s", content_hash, e)
+
+    def _extract(self, song_id):
+        """
+        Write the album art of a song to files, unless they exist already.
+        :return: a (content_hash, image_format) tuple, or None if the song has no (usable) album art
+        """
+        row = self._db.execute("SELECT albumArt FROM albumArts WHERE songId=?", [song_id]).fetchone()
+        if not row:
+            return None
+        data = bytes(row[0])
+        image_format = detect_format(data)
+        if not image_format:
+            logging.getLogger("musicbot").debug("Unknown album art format of song %s", song_id)
+            return None
+
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self._get_path(content_hash, image_format[1])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.isfile(path):
+            _write_atomic(path, data)
+        self._write_thumbnails(data, content_hash, image_format)
+        with self._db.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO albumArtFiles(songId, hash, mimeType) VALUES(?, ?, ?)",
+                       [song_id, content_hash, image_format[0]])
+        return content_hash, image_format
+
+    def _lookup(self, song_id):
+        with self._index_lock:
+            if song_id in self._index:
+                return self._index[song_id]
+
+        entry = None
+        row = self._db.execute("SELECT hash, mimeType FROM albumArtFiles WHERE songId=?", [song_id]).fetchone()
+        if row:
+            content_hash, mime_type = row
+            image_format = next((image_format for _, image_format in _formats if image_format[0] == mime_type), None)
+            # The files may have been deleted, they are extracted again in that case
+            if image_format and os.path.isfile(self._get_path(content_hash, image_format[1])):
+                entry = content_hash, image_format
+        if entry is None:
+            entry = self._extract(song_id)
+
+        with self._index_lock:
+            self._index[song_id] = entry
+        return entry
+
+    def get(self, song_id, size=None):
+        """
+        Get the album art of a song, extracting it first if necessary.
+        :param song_id: the song ID
+        :param size: the minimum width and height of the image. The smallest thumbnail at least that large is
+                     returned, or the original image if there is none. None for the original image.
+        :return: an AlbumArt object or None if the song has no album art
+        """
+        entry = self._lookup(song_id)
+        if not entry:
+            return None
+        content_hash, image_format = entry
+        return self._get_file(content_hash, image_format, size)
+
+    def get_by_hash(self, content_hash, size=None):
+        """
+        Get an album art by the hash of the original image.
+        :param content_hash: the SHA-256 hash as returned in AlbumArt.content_hash
+        :param size: see get()
+        :return: an AlbumArt object or None if there is no such album art
+        """
+        if not content_hash or not _hash_pattern.match(content_hash):
+            return None
+        for _, image_format in _formats:
+            if os.path.isfile(self._get_path(content_hash, image_format[1])):
+                return self._get_file(content_hash, image_format, size)
+        return None
+
+    def _get_file(self, content_hash, image_format, size):
+        mime_type, extension = image_format[:2]
+        if size:
+            for thumbnail_size in self._sizes:
+                if thumbnail_size < size:
+                    continue
+                path = self._get_path(content_hash, extension, thumbnail_size)
+                if os.path.isfile(path):
+                    return AlbumArt(path, mime_type, content_hash, thumbnail_size)
+                break
+        return AlbumArt(self._get_path(content_hash, extension), mime_type, content_hash)
+
+    def forget(self, song_ids):
+        """
+        Forget the album art of songs, e.g. because their files have changed. It is extracted again on the next request.
+        """
+        with self._index_lock:
+            for song_id in song_ids:
+                if song_id in self._index:
+                    del self._index[song_id]
+        with self._db.transaction() as db:
+            db.executemany("DELETE FROM albumArtFiles WHERE songId=?", [(song_id,) for song_id in song_ids])
+
+    def start(self):
+        """
+        Start a background thread extracting the album art of all songs which haven't been extracted yet.
+        """
+        async_handler.execute(self.extract_all, self.close, "Album art extraction")
+
+    def extract_all(self):
+        """
+        Extract the album art of all songs which haven't been extracted yet.
+        :return: the number of extracted songs
+        """
+        song_ids = [song_id for (song_id,) in self._db.execute(
+            "SELECT songId FROM albumArts WHERE songId NOT IN (SELECT songId FROM albumArtFiles)").fetchall()]
+        count = 0
+        for song_id in song_ids:
+            if self._stop_event.is_set():
+                break
+            try:
+                if self._extract(song_id):
+                    count += 1
+            except OSError as e:
+                logging.getLogger("musicbot").warning("Could not extract album art of song %s: %s", song_id, e)
+        if count:
+            logging.getLogger("musicbot").info("Extracted album art of %d songs", count)
+        return count
+
+    def close(self):
+        self._stop_event.set()
@@ -0,0 +1,204 @@
+import logging
+import os
+import random
+import shutil
+import subprocess
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from musicbot import config
+from musicbot.database import ConnectionManager
+
+_manifest_path = os.path.join("config", "downloads.db")
+_priority_lowered = False
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def lower_priority():
+    """
+    Lower the CPU and I/O priority of this process, so a bulk download doesn't disturb the playback of a running bot.
+    Threads started afterwards inherit the priority. Does nothing if the platform doesn't support it.
+    """
+    global _priority_lowered
+    if _priority_lowered:
+        return
+    _priority_lowered = True
+
+    logger = logging.getLogger("musicbot")
+    try:
+        os.nice(10)
+    except (AttributeError, OSError) as e:
+        logger.debug("Could not lower CPU priority: %s", e)
+
+    ionice = shutil.which("ionice")
+    if not ionice:
+        return
+    try:
+        # Idle I/O class: only use the disk if no other process needs it
+        subprocess.run([ionice, "-c", "3", "-p", str(os.getpid())], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        try:
+            subprocess.run([ionice, "-c", "2", "-n", "7", "-p", str(os.getpid())], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.debug("Could not lower I/O priority: %s", e)
+
+
+class BulkDownload(object):
+    """
+    Downloads many songs with bounded concurrency per API and retries with exponential backoff.
+
+    The status of every song is recorded in a manifest, so an interrupted download can be resumed
+    by running it again with the same manifest ID. Songs which have been downloaded before are skipped.
+    """
+
+    def __init__(self, manifest_id, max_attempts=4, backoff=2.0, manifest_path=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        manifest_id -- identifies the download in the manifest, e.g. a playlist share token
+        max_attempts -- the maximum number of download attempts per song and run
+        backoff -- the delay in seconds before the first retry, doubled for each further retry
+        manifest_path -- the path to the manifest database
+        """
+        if not manifest_id:
+            raise ValueError("manifest_id is None")
+        self._manifest_id = manifest_id
+        self._max_attempts = max(1, max_attempts)
+        self._backoff = backoff
+        self._db = ConnectionManager(manifest_path or _manifest_path)
+        with self._db.transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS downloads(manifestId TEXT NOT NULL, songId TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, bytes INTEGER, updated REAL, PRIMARY KEY(manifestId, songId))")
+        self._semaphores = {}
+        self._semaphores_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def _get_semaphore(self, api_name):
+        with self._semaphores_lock:
+            semaphore = self._semaphores.get(api_name)
+            if semaphore is None:
+                semaphore = threading.Semaphore(max(1, config.get_bulk_download_concurrency(api_name)))
+                self._semaphores[api_name] = semaphore
+            return semaphore
+
+    def _set_status(self, song_id, status, attempts, error=None, size=None):
+        with self._db.transaction() as db:
+            db.execute(
+                "UPDATE downloads SET status=?, attempts=attempts+?, error=?, bytes=?, updated=? WHERE manifestId=? AND songId=?",
+                (status, attempts, error, size, time.time(), self._manifest_id, song_id))
+
+    def get_status(self):
+        """
+        Get the number of songs per status.
+        :return: a dict from status to count
+        """
+        return dict(self._db.execute("SELECT status, count(*) FROM downloads WHERE manifestId=? GROUP BY status",
+                                     [self._manifest_id]).fetchall())
+
+    def stop(self):
+        """
+        Stop after the songs which are currently downloading. Remaining songs stay pending in the manifest.
+        """
+        self._stop_event.set()
+
+    def run(self, song_ids: typing.Iterable[str], lookup: typing.Callable, workers=None, progress=None):
+        """
+        Download songs.
+        :param song_ids: the IDs of the songs to download
+        :param lookup: a callable returning the Song for a song ID, or None if the song is unavailable
+        :param workers: the total number of download threads, defaults to 8
+        :param progress: an optional callable which is called with (finished, total, song_id, status) after each song
+        :return: a summary dict with total, done, skipped, failed, retries, bytes, duration, songs_per_minute and
+                 mib_per_second keys
+        """
+        song_ids = list(dict.fromkeys(song_ids))
+        with self._db.transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO downloads(manifestId, songId, status) VALUES(?, ?, ?)",
+                           [(self._manifest_id, song_id, STATUS_PENDING) for song_id in song_ids])
+        done_ids = {song_id for (song_id,) in
+                    self._db.execute("SELECT songId FROM downloads WHERE manifestId=? AND status=?",
+                                     [self._manifest_id, STATUS_DONE])}
+        remaining = [song_id for song_id in song_ids if song_id not in done_ids]
+
+        stats = {
+            "total": len(song_ids),
+            "done": 0,
+            "skipped": len(song_ids) - len(remaining),
+            "failed": 0,
+            "retries": 0,
+            "bytes": 0
+        }
+        finished = [stats['skipped']]
+        start = time.perf_counter()
+
+        def _finish(song_id, status):
+            with self._stats_lock:
+                stats[status] += 1
+                finished[0] += 1
+                count = finished[0]
+            if progress:
+                progress(count, stats['total'], song_id, status)
+
+        def _download(song_id):
+            if self._stop_event.is_set():
+                return
+            song = lookup(song_id)
+            if not song:
+                self._set_status(song_id, STATUS_FAILED, 0, "Song unavailable")
+                _finish(song_id, "failed")
+                return
+
+            semaphore = self._get_semaphore(song.api.get_name())
+            error = None
+            for attempt in range(self._max_attempts):
+                if attempt:
+                    with self._stats_lock:
+                        stats['retries'] += 1
+                    # Exponential backoff with jitter, so retries of many songs don't hit the API at the same time
+                    delay = self._backoff * (2 ** (attempt - 1))
+                    if self._stop_event.wait(delay * random.uniform(0.5, 1.5)):
+                        break
+                try:
+                    with semaphore:
+                        fname = song.load()
+                    size = os.path.getsize(fname) if os.path.isfile(fname) else None
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                    logging.getLogger("musicbot").warning("Download attempt %d of %s failed: %s", attempt + 1,
+                                                          song_id, error)
+                    continue
+                self._set_status(song_id, STATUS_DONE, attempt + 1, size=size)
+                with self._stats_lock:
+                    stats['bytes'] += size or 0
+                _finish(song_id, "done")
+                return
+
+            if self._stop_event.is_set():
+                # Interrupted during a backoff, the song stays pending
+                return
+            self._set_status(song_id, STATUS_FAILED, self._max_attempts, error)
+            _finish(song_id, "failed")
+
+        with ThreadPoolExecutor(workers or 8) as executor:
+            try:
+                for _ in executor.map(_download, remaining):
+                    pass
+            except KeyboardInterrupt:
+                # Let the running downloads finish, the pending ones return immediately
+                self.stop()
+                raise
+
+        duration = time.perf_counter() - start
+        stats['duration'] = duration
+        stats['songs_per_minute'] = stats['done'] * 60 / duration if duration else 0.0
+        stats['mib_per_second'] = stats['bytes'] / (1024 * 1024) / duration if duration else 0.0
+        return stats
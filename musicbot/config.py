@@ -168,10 +168,115 @@ def get_allow_rest_admin():
     return _config.get("allow_rest_admin", True)
 
 
+def get_search_deadline(api_name):
+    """
+    Get the number of seconds a federated search waits for the results of an API.
+    """
+    return _config.get("search_deadline", {}).get(api_name, 5)
+
+
+def get_search_cache_size():
+    """
+    Get the maximum number of songs kept in the search cache.
+    """
+    return _config.get("search_cache_size", 5000)
+
+
+def get_search_cache_ttl():
+    """
+    Get the number of seconds search results are cached.
+    """
+    return _config.get("search_cache_ttl", 300)
+
+
+def get_inline_query_delay():
+    """
+    Get the number of seconds a Telegram inline query waits for a newer query by the same user before it is executed.
+    """
+    return _config.get("inline_query_delay", 0.3)
+
+
+def get_password_hash_workers():
+    """
+    Get the number of processes hashing passwords for the REST API.
+    """
+    return _config.get("password_hash_workers", 2)
+
+
+def get_password_hash_queue():
+    """
+    Get the maximum number of password hashing jobs waiting for a process before the REST API rejects requests.
+    """
+    return _config.get("password_hash_queue", 16)
+
+
+def get_rest_token_lifetime():
+    """
+    Get the number of seconds a REST API token is valid before it has to be refreshed. 0 means forever.
+    """
+    return _config.get("rest_token_lifetime", 0)
+
+
+def get_rest_token_cache_size():
+    """
+    Get the maximum number of verified REST API tokens kept in memory.
+    """
+    return _config.get("rest_token_cache_size", 1024)
+
+
+def get_rest_token_cache_ttl():
+    """
+    Get the number of seconds a verified REST API token is kept in memory.
+    """
+    return _config.get("rest_token_cache_ttl", 300)
+
+
 def get_gmusic_locale():
     return _config.get("gmusic_locale", locale.getdefaultlocale()[0])
 
 
+def get_offline_no_repeat():
+    """
+    Get the minimum number of suggestions before the offline API suggests the same song again.
+    """
+    return _config.get("offline_no_repeat", 50)
+
+
+def get_offline_recommender_enabled():
+    """
+    Get whether offline suggestions are based on the play history instead of being picked at random.
+    """
+    return _config.get("offline_recommender", True)
+
+
+def get_library_scan_workers():
+    """
+    Get the number of processes parsing tags during a library scan. 0 means one per CPU.
+    """
+    return _config.get("library_scan_workers", 0)
+
+
+def get_library_watch_enabled():
+    """
+    Get whether local directory playlists are watched for changes while the bot is running.
+    """
+    return _config.get("library_watch", False)
+
+
+def get_library_watch_delay():
+    """
+    Get the number of seconds without further changes to wait before a changed directory is rescanned.
+    """
+    return _config.get("library_watch_delay", 2)
+
+
+def get_bulk_download_concurrency(api_name):
+    """
+    Get the maximum number of concurrent downloads from an API during a bulk download.
+    """
+    return _config.get("bulk_download_concurrency", {}).get(api_name, 2)
+
+
 def get_max_conversions():
     return _config.get("max_conversions", 2)
 
@@ -188,10 +293,42 @@ def set_gmusic_quality(quality):
     _config['quality'] = quality
 
 
+def get_album_art_sizes():
+    """
+    Get the maximum widths and heights of the album art thumbnails served by the REST API.
+    """
+    return _config.get("album_art_sizes", [64, 128, 300])
+
+
 def get_songs_path():
     return _config.get("song_path", "songs")
 
 
+_default_song_cache_ttls = {
+    "gmusic": 30 * 24 * 3600,
+    "youtube": 7 * 24 * 3600,
+    "soundcloud": 7 * 24 * 3600
+}
+
+
+def get_song_cache_ttl(api_name):
+    """
+    Get the time in seconds songs of an API are kept in the persistent song cache.
+    :param api_name: the name of the API
+    :return: the TTL in seconds, 0 disables the persistent cache
+    """
+    return _config.get("song_cache_ttl", {}).get(api_name, _default_song_cache_ttls.get(api_name, 0))
+
+
+def get_song_cache_size(api_name):
+    """
+    Get the maximum number of songs of an API in the persistent song cache.
+    :param api_name: the name of the API
+    :return: the maximum number of songs
+    """
+    return _config.get("song_cache_size", {}).get(api_name, 10000)
+
+
 def get_secrets():
     """
     Get the secrets file content.
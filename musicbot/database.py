@@ -0,0 +1,216 @@
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+
+class _Connection(sqlite3.Connection):
+    # Unlike sqlite3.Connection, subclasses support weak references
+    pass
+
+
+class _TimedCursor(object):
+    """
+    Wraps a cursor, so the time spent fetching rows is added to the time of its statement.
+    """
+
+    def __init__(self, manager, sql, cursor, duration):
+        self._manager = manager
+        self._sql = sql
+        self._cursor = cursor
+        # The time spent on this execution so far
+        self._duration = duration
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            duration = time.perf_counter() - start
+            self._duration += duration
+            self._manager._record(self._sql, duration, self._duration, 0)
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._timed(next, self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ConnectionManager(object):
+    """
+    Manages the SQLite connections to one database file.
+
+    Every thread gets its own connection, which is opened on first use and reused afterwards.
+    Connections are opened in WAL mode with a tuned page cache, memory mapping and a statement cache.
+    The time spent executing each distinct query and fetching its rows is recorded.
+    """
+
+    def __init__(self, db_path, cache_size_kib=8192, mmap_size=64 * 1024 * 1024, cached_statements=256,
+                 timeout=10.0):
+        """
+        Constructor
+
+        Keyword arguments:
+        db_path -- the path to the database file
+        cache_size_kib -- the page cache size per connection in KiB
+        mmap_size -- the maximum number of bytes to memory map
+        cached_statements -- the number of prepared statements cached per connection
+        timeout -- the time in seconds to wait for a lock on the database
+        """
+        self.db_path = db_path
+        self._cache_size_kib = cache_size_kib
+        self._mmap_size = mmap_size
+        self._cached_statements = cached_statements
+        self._timeout = timeout
+        self._local = threading.local()
+        # Connections of finished threads are garbage collected and closed
+        self._connections = weakref.WeakSet()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _connect(self):
+        # Connections are only used by the thread that created them,
+        # check_same_thread is disabled so close_all() can close them from any thread.
+        connection = sqlite3.connect(self.db_path, timeout=self._timeout, cached_statements=self._cached_statements,
+                                     check_same_thread=False, factory=_Connection)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA cache_size=-{}".format(int(self._cache_size_kib)))
+        connection.execute("PRAGMA mmap_size={}".format(int(self._mmap_size)))
+        connection.execute("PRAGMA temp_store=MEMORY")
+        return connection
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Return the connection of the calling thread.
+        """
+        local = self._local
+        connection = getattr(local, "connection", None)
+        if connection is not None and local.generation == self._generation:
+            return connection
+        connection = self._connect()
+        with self._lock:
+            self._connections.add(connection)
+            local.connection = connection
+            local.generation = self._generation
+        return connection
+
+    def _record(self, sql, duration, total_duration, executions=1):
+        """
+        Add to the timings of a statement.
+        :param duration: the time spent in this call
+        :param total_duration: the time spent on the execution so far, including fetching rows
+        :param executions: the number of new executions, 0 for fetching more rows
+        """
+        with self._stats_lock:
+            stats = self._stats.get(sql)
+            if stats is None:
+                self._stats[sql] = [executions, duration, total_duration]
+            else:
+                stats[0] += executions
+                stats[1] += duration
+                if total_duration > stats[2]:
+                    stats[2] = total_duration
+
+    def _timed(self, sql, fn, *args):
+        start = time.perf_counter()
+        try:
+            cursor = fn(sql, *args)
+        finally:
+            duration = time.perf_counter() - start
+            self._record(sql, duration, duration)
+        return _TimedCursor(self, sql, cursor, duration)
+
+    def execute(self, sql, parameters=()):
+        """
+        Execute a statement on the connection of the calling thread.
+        :return: a cursor, the time spent fetching its rows is included in the timings of the statement
+        """
+        return self._timed(sql, self.get_connection().execute, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """
+        Execute a statement for each parameter tuple on the connection of the calling thread.
+        :return: a cursor like execute()
+        """
+        return self._timed(sql, self.get_connection().executemany, seq_of_parameters)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Return a context manager for a transaction on the connection of the calling thread.
+        The transaction is committed on success and rolled back if an exception is raised.
+        The yielded object is this manager, so statements are still timed.
+        """
+        with self.get_connection():
+            yield self
+
+    def get_schema_version(self) -> int:
+        return self.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, migrations):
+        """
+        Bring the database schema up to date.
+        The schema version is stored in PRAGMA user_version. Migration number i (counting from 1) is applied
+        if the version is lower than i. Every migration runs in its own exclusive transaction.
+        :param migrations: a list of callables which take this manager as their only argument
+        :return: the schema version after the migration
+        """
+        version = self.get_schema_version()
+        for target_version, migration in enumerate(migrations, 1):
+            if version >= target_version:
+                continue
+            with self.transaction():
+                self.execute("BEGIN IMMEDIATE")
+                # Another process may have migrated the database while we were waiting for the lock
+                version = self.get_schema_version()
+                if version >= target_version:
+                    continue
+                migration(self)
+                self.execute("PRAGMA user_version={}".format(int(target_version)))
+                version = target_version
+            logging.getLogger("musicbot").info("Migrated %s to schema version %d", self.db_path, version)
+        return version
+
+    def close_all(self):
+        """
+        Close all connections. Threads will open a new connection on their next access.
+        """
+        with self._lock:
+            self._generation += 1
+            connections = list(self._connections)
+            self._connections.clear()
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error as e:
+                logging.getLogger("musicbot").warning("Error closing connection to %s: %s", self.db_path, e)
+
+    def get_stats(self):
+        """
+        Return the query timings.
+        :return: a dict from SQL strings to dicts with count, total_ms, avg_ms and max_ms keys
+        """
+        with self._stats_lock:
+            return {sql: {"count": count,
+                          "total_ms": total * 1000,
+                          "avg_ms": total * 1000 / count,
+                          "max_ms": maximum * 1000}
+                    for sql, (count, total, maximum) in self._stats.items()}
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+from musicbot import config
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+
+
+def _normalize(text):
+    if not text:
+        return ""
+    return " ".join(text.lower().split())
+
+
+class BackendResult(object):
+    """
+    The result of one API in a federated search.
+    """
+
+    def __init__(self, api_name, songs, latency, status=STATUS_OK):
+        """
+        Constructor
+
+        Keyword arguments:
+        api_name -- the name of the API
+        songs -- a list of Song objects, empty if the search failed or timed out
+        latency -- the number of seconds until the API answered (or the deadline if it didn't)
+        status -- STATUS_OK, STATUS_ERROR or STATUS_TIMEOUT
+        """
+        self.api_name = api_name
+        self.songs = songs
+        self.latency = latency
+        self.status = status
+
+
+class ResultMerger(object):
+    """
+    Merges the results of multiple APIs and removes duplicates.
+
+    A song is a duplicate if it has been added before, either with the same API and song ID
+    or with the same title and description by another API.
+    """
+
+    def __init__(self, api_names):
+        """
+        Constructor
+
+        Keyword arguments:
+        api_names -- the API names in the order of preference for the merged result
+        """
+        self._api_names = list(api_names)
+        self._songs = {api_name: [] for api_name in api_names}
+        self._seen = set()
+
+    def add(self, api_name, songs):
+        """
+        Add the results of an API.
+        :return: the songs which aren't duplicates, in their original order
+        """
+        added = []
+        for song in songs:
+            keys = [(api_name, song.song_id), (_normalize(song.title), _normalize(song.description))]
+            if any(key in self._seen for key in keys):
+                continue
+            self._seen.update(keys)
+            added.append(song)
+        self._songs.setdefault(api_name, []).extend(added)
+        return added
+
+    def get_merged(self, max_len=None):
+        """
+        Get the merged result. The results of all APIs are interleaved by rank.
+        :param max_len: the maximum number of songs
+        :return: a list of Song objects
+        """
+        merged = []
+        lists = [self._songs[api_name] for api_name in self._api_names if self._songs.get(api_name)]
+        rank = 0
+        while lists and (max_len is None or len(merged) < max_len):
+            for songs in lists:
+                if rank < len(songs):
+                    merged.append(songs[rank])
+            rank += 1
+            lists = [songs for songs in lists if rank < len(songs)]
+        if max_len is not None:
+            merged = merged[:max_len]
+        return merged
+
+
+class FederatedSearch(object):
+    """
+    Searches all APIs concurrently.
+
+    Every API has its own deadline (see config.get_search_deadline()), so the whole search takes as long as the
+    slowest API within its deadline. APIs which miss their deadline are reported as timed out and their results
+    are dropped. Their threads can't be interrupted, but the size of the pool limits how many of them pile up.
+    """
+
+    def __init__(self, apis, max_workers=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        apis -- the AbstractAPIs to search, in the order of preference for merged results
+        max_workers -- the maximum number of concurrent API calls, defaults to four per API
+        """
+        self._apis = list(apis)
+        self._executor = ThreadPoolExecutor(max_workers or 4 * max(1, len(self._apis)))
+
+    def get_api_names(self):
+        return [api.get_name() for api in self._apis]
+
+    @staticmethod
+    def _search_api(api, query, max_fetch):
+        return list(islice(api.search_song(query, max_fetch=max_fetch), max_fetch))
+
+    def _submit(self, query, max_fetch):
+        """
+        Start the search on all APIs.
+        :return: a tuple (start, pending) with the start time and a dict mapping the futures to tuples
+        (api_name, deadline)
+        """
+        if not query:
+            raise ValueError("query is None")
+        start = time.perf_counter()
+        pending = {}
+        for api in self._apis:
+            api_name = api.get_name()
+            future = self._executor.submit(self._search_api, api, query, max_fetch)
+            pending[future] = (api_name, start + config.get_search_deadline(api_name))
+        return start, pending
+
+    @staticmethod
+    def _timeout(pending):
+        return max(0, min(deadline for _, deadline in pending.values()) - time.perf_counter())
+
+    @staticmethod
+    def _collect(pending, done, start):
+        """
+        Yield the results of the finished futures and of the futures which missed their deadline.
+        Those futures are removed from pending.
+        """
+        logger = logging.getLogger("musicbot")
+        now = time.perf_counter()
+        for future in done:
+            api_name, _ = pending.pop(future)
+            try:
+                yield BackendResult(api_name, future.result(), now - start)
+            except Exception as e:
+                logger.warning("Federated search on %s failed: %s", api_name, e)
+                yield BackendResult(api_name, [], now - start, STATUS_ERROR)
+        for future, (api_name, deadline) in list(pending.items()):
+            if deadline <= now:
+                del pending[future]
+                future.cancel()
+                logger.debug("Federated search on %s timed out", api_name)
+                yield BackendResult(api_name, [], deadline - start, STATUS_TIMEOUT)
+
+    def search_iter(self, query, max_fetch=20):
+        """
+        Search all APIs and yield the result of each API as soon as it is available.
+        :param query: the search query
+        :param max_fetch: the maximum number of songs per API
+        :return: a generator of BackendResult objects, one per API, fastest first
+        """
+        start, pending = self._submit(query, max_fetch)
+        try:
+            while pending:
+                done, _ = wait(list(pending), timeout=self._timeout(pending), return_when=FIRST_COMPLETED)
+                yield from self._collect(pending, done, start)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def search_async_iter(self, query, max_fetch=20):
+        """
+        Like search_iter(), but waits on the event loop instead of blocking a thread.
+        If the generator is closed early, the searches which haven't started yet are cancelled.
+        :param query: the search query
+        :param max_fetch: the maximum number of songs per API
+        :return: an asynchronous generator of BackendResult objects, one per API, fastest first
+        """
+        start, pending = self._submit(query, max_fetch)
+        # Cancelling a wrapping asyncio future cancels the wrapped one as well
+        pending = {asyncio.wrap_future(future): value for future, value in pending.items()}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), timeout=self._timeout(pending),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for result in self._collect(pending, done, start):
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def search(self, query, max_fetch=20):
+        """
+        Search all APIs and merge their results.
+        :param query: the search query
+        :param max_fetch: the maximum number of songs per API
+        :return: a tuple (songs, backend_results) with the merged songs and a list of BackendResult objects
+        """
+        merger = ResultMerger(self.get_api_names())
+        results = []
+        for result in self.search_iter(query, max_fetch):
+            merger.add(result.api_name, result.songs)
+            results.append(result)
+        return merger.get_merged(), results
+
+    def close(self):
+        self._executor.shutdown(wait=False)
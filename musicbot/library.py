@@ -0,0 +1,459 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os.path import join, realpath
+
+from mutagen import MutagenError
+from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
+
+from musicbot import async_handler
+from musicbot import config
+from musicbot.music_apis import OfflineAPI, _chunks, _parse_duration
+
+
+def _format_duration(length):
+    minutes, seconds = divmod(int(length), 60)
+    return "{:02d}:{:02d}".format(minutes, seconds)
+
+
+def _parse_file(path):
+    """
+    Read the tags of an mp3 file. Runs in a worker process, so it must not touch the database.
+    :param path: the path to the mp3 file
+    :return: a tuple (path, song_tuple, album_art, error), song_tuple is None if the file could not be parsed
+    """
+    try:
+        audio = MP3(path, ID3=ID3)
+    except (MutagenError, OSError) as e:
+        return path, None, None, str(e)
+    id3 = audio.tags
+    if not id3:
+        return path, None, None, "No ID3 header"
+    try:
+        title = str(id3['TIT2'][0])
+        if "TPE1" in id3:
+            artist = id3['TPE1']
+        else:
+            artist = id3.get("TPE2", None) or id3["TPE3"]
+        artist = str(artist[0])
+    except (KeyError, IndexError) as e:
+        return path, None, None, "Missing tag {}".format(e)
+
+    album_art = None
+    apics = id3.getall("APIC")
+    if apics:
+        album_art = apics[0].data
+
+    song_id = path[:-4]
+    duration = _format_duration(audio.info.length)
+    song_tuple = (song_id, title, artist, title, None, path, duration, _parse_duration(duration))
+    return path, song_tuple, album_art, None
+
+
+class LibraryScanner(object):
+    """
+    Scans local directories into playlists of the OfflineAPI.
+
+    The modification time and size of every scanned file is stored, so a rescan only parses new and changed files.
+    Tags are parsed in a pool of worker processes and the results are written to the database in batches.
+    """
+    _batch_size = 500
+
+    def __init__(self, offline_api: OfflineAPI, workers=None, use_processes=True):
+        """
+        Constructor
+
+        Keyword arguments:
+        offline_api -- the OfflineAPI whose database is updated
+        workers -- the number of workers parsing tags, defaults to the library_scan_workers config value
+        use_processes -- whether to parse in worker processes instead of threads.
+                         Use threads in processes with many running threads, since forking them is unsafe.
+        """
+        self._api = offline_api
+        self._db = offline_api._db
+        if workers is None:
+            workers = config.get_library_scan_workers()
+        self._workers = workers or os.cpu_count() or 1
+        self._use_processes = use_processes
+
+    def get_directories(self):
+        """
+        Get the scanned directories.
+        :return: a list of (playlist_id, recursive) tuples, the playlist ID is the directory path
+        """
+        return [(playlist_id, bool(recursive)) for playlist_id, recursive in
+                self._db.execute("SELECT playlistId, recursive FROM libraryDirectories").fetchall()]
+
+    def add_directory(self, directory_path, name, recursive=True):
+        """
+        Add a directory as a playlist and scan it.
+        :param directory_path: the path to the directory
+        :param name: the playlist name
+        :param recursive: whether to include subdirectories
+        :return: the scan result, see scan_directory()
+        """
+        directory_path = realpath(os.path.expanduser(directory_path))
+        if not os.path.isdir(directory_path):
+            raise ValueError("Invalid directory: " + directory_path)
+        with self._db.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO playlists(playlistId, name) VALUES(?, ?)", [directory_path, name])
+            db.execute("INSERT OR REPLACE INTO libraryDirectories(playlistId, recursive) VALUES(?, ?)",
+                       [directory_path, bool(recursive)])
+        return self.scan_directory(directory_path)
+
+    def rescan(self):
+        """
+        Scan all directories which have been added before.
+        :return: a list of scan results, see scan_directory()
+        """
+        return [self.scan_directory(playlist_id) for playlist_id, _ in self.get_directories()]
+
+    def _list_files(self, directory_path, recursive):
+        files = {}
+        for root, dirs, names in os.walk(directory_path):
+            if not recursive:
+                dirs[:] = []
+            for name in names:
+                if not name.lower().endswith(".mp3"):
+                    continue
+                path = join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def _parse_files(self, paths):
+        if not paths:
+            return []
+        if len(paths) < 2 * self._workers or not self._use_processes:
+            executor = ThreadPoolExecutor(self._workers)
+            chunk_size = 1
+        else:
+            executor = ProcessPoolExecutor(self._workers)
+            chunk_size = max(1, min(64, len(paths) // (4 * self._workers)))
+        with executor:
+            return list(executor.map(_parse_file, paths, chunksize=chunk_size))
+
+    def scan_directory(self, playlist_id):
+        """
+        Synchronize the playlist of a directory with the files in it.
+        :param playlist_id: the playlist ID, which is the directory path
+        :return: a dict with the playlist ID, the number of files, parsed, failed and removed files,
+                 the added, removed and updated song IDs and the duration in seconds
+        """
+        start = time.perf_counter()
+        db = self._db
+        row = db.execute("SELECT recursive FROM libraryDirectories WHERE playlistId=?", [playlist_id]).fetchone()
+        if not row:
+            raise ValueError("Unknown directory: " + playlist_id)
+        recursive = bool(row[0])
+
+        files = self._list_files(playlist_id, recursive)
+        prefix = join(playlist_id, "")
+        known = {}
+        for path, mtime, size, song_id in db.execute(
+                "SELECT path, mtime, size, songId FROM libraryFiles WHERE substr(path, 1, ?)=?",
+                [len(prefix), prefix]):
+            known[path] = (mtime, size, song_id)
+
+        changed = [path for path, stat in files.items() if known.get(path, (None, None, None))[:2] != stat]
+        vanished = [path for path in known if path not in files and not os.path.isfile(path)]
+
+        results = self._parse_files(changed)
+        failed = 0
+        updated_ids = []
+        song_rows = []
+        for path, song_tuple, album_art, error in results:
+            if song_tuple:
+                song_rows.append((song_tuple, album_art))
+                if path in known:
+                    updated_ids.append(song_tuple[0])
+            else:
+                failed += 1
+                logging.getLogger("musicbot").info("Could not parse %s: %s", path, error)
+
+        with db.transaction():
+            playlist_ids = {song_id for (song_id,) in
+                            db.execute("SELECT songId FROM playlistSongs WHERE playlistId=?", [playlist_id])}
+            for batch in _chunks(song_rows, self._batch_size):
+                song_tuples = [song_tuple for song_tuple, _ in batch]
+                # Every row is written (and indexed for search) once, new songs are inserted and known ones updated
+                existing_ids = {song_id for (song_id,) in db.execute(
+                    "SELECT songId FROM songs WHERE songId IN ({})".format(", ".join("?" * len(song_tuples))),
+                    [song_tuple[0] for song_tuple in song_tuples])}
+                db.executemany(OfflineAPI._insert_song_query,
+                               [song_tuple for song_tuple in song_tuples if song_tuple[0] not in existing_ids])
+                db.executemany(
+                    "UPDATE songs SET title=?, description=?, stringRep=?, duration=?, durationSeconds=? WHERE songId=?",
+                    [(title, description, string_rep, duration, seconds, song_id)
+                     for song_id, title, description, string_rep, _, _, duration, seconds in song_tuples
+                     if song_id in existing_ids])
+                db.executemany("INSERT OR REPLACE INTO albumArts(songId, albumArt) VALUES(?, ?)",
+                               [(song_tuple[0], album_art) for song_tuple, album_art in batch if album_art])
+                # The embedded album art may have been removed from a changed file
+                db.executemany("DELETE FROM albumArts WHERE songId=?",
+                               [(song_tuple[0],) for song_tuple, album_art in batch
+                                if not album_art and song_tuple[0] in existing_ids])
+                # The album art may have changed, it is extracted again when it is requested
+                db.executemany("DELETE FROM albumArtFiles WHERE songId=?",
+                               [(song_tuple[0],) for song_tuple, _ in batch])
+            parsed_ids = {path: song_tuple[0] if song_tuple else None for path, song_tuple, _, _ in results}
+            db.executemany("INSERT OR REPLACE INTO libraryFiles(path, mtime, size, songId) VALUES(?, ?, ?, ?)",
+                           [(path, files[path][0], files[path][1], parsed_ids[path]) for path in changed])
+
+            vanished_ids = [(known[path][2],) for path in vanished if known[path][2]]
+            db.executemany("DELETE FROM playlistSongs WHERE songId=?", vanished_ids)
+            db.executemany("DELETE FROM albumArts WHERE songId=?", vanished_ids)
+            db.executemany("DELETE FROM albumArtFiles WHERE songId=?", vanished_ids)
+            db.executemany("DELETE FROM songs WHERE songId=?", vanished_ids)
+            db.executemany("DELETE FROM libraryFiles WHERE path=?", [(path,) for path in vanished])
+
+            # The playlist contains exactly the songs of the parsable files in the directory
+            song_ids = set()
+            for path in files:
+                song_id = parsed_ids[path] if path in parsed_ids else known[path][2]
+                if song_id:
+                    song_ids.add(song_id)
+            added_ids = list(song_ids - playlist_ids)
+            removed_ids = list(playlist_ids - song_ids)
+            db.executemany("INSERT OR IGNORE INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
+                           [(playlist_id, song_id) for song_id in added_ids])
+            db.executemany("DELETE FROM playlistSongs WHERE playlistId=? AND songId=?",
+                           [(playlist_id, song_id) for song_id in removed_ids])
+
+        return {
+            "playlist_id": playlist_id,
+            "files": len(files),
+            "parsed": len(results) - failed,
+            "failed": failed,
+            "removed_files": len(vanished),
+            "added_ids": added_ids,
+            "removed_ids": removed_ids,
+            "updated_ids": updated_ids,
+            "duration": time.perf_counter() - start
+        }
+
+
+class _Inotify(object):
+    """
+    A minimal ctypes binding to the Linux inotify API.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    _IN_CLOEXEC = 0o2000000
+    _header = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify unavailable")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+        fd = libc.inotify_init1(self._IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.fd = fd
+
+    def add_watch(self, path, mask) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask | self.IN_ONLYDIR)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+        :return: a list of (wd, mask, name) tuples
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        header = self._header
+        while offset + header.size <= len(data):
+            wd, mask, _, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher(object):
+    """
+    Watches the directories of local playlists and rescans them after changes.
+
+    Uses inotify if it is available and polls the directories otherwise.
+    Changes are debounced: a directory is rescanned once no further changes happened for the configured delay,
+    or at the latest after max_delay seconds of continuous changes.
+    """
+    _watch_mask = (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO | _Inotify.IN_CREATE |
+                   _Inotify.IN_DELETE | _Inotify.IN_DELETE_SELF | _Inotify.IN_MOVE_SELF)
+    # How often new directories are picked up from the database
+    _refresh_interval = 60
+
+    def __init__(self, offline_api: OfflineAPI, delay=None, max_delay=30, poll_interval=30):
+        """
+        Constructor
+
+        Keyword arguments:
+        offline_api -- the OfflineAPI whose playlists are watched
+        delay -- the seconds to wait for further changes before rescanning, defaults to the library_watch_delay config value
+        max_delay -- the maximum seconds to wait before rescanning a directory which changes continuously
+        poll_interval -- the seconds between scans if inotify is unavailable
+        """
+        self._api = offline_api
+        # Forking the bot process is unsafe, so tags are parsed in threads
+        self._scanner = LibraryScanner(offline_api, use_processes=False)
+        self._delay = config.get_library_watch_delay() if delay is None else delay
+        self._max_delay = max(max_delay, self._delay)
+        self._poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._directories = {}
+        self._watches = {}
+        # Playlist ID -> (time of the first pending change, time of the last change)
+        self._pending = {}
+        try:
+            self._inotify = _Inotify()
+        except OSError as e:
+            logging.getLogger("musicbot").info("inotify unavailable, polling library directories (%s)", e)
+            self._inotify = None
+
+    def start(self):
+        async_handler.execute(self.run, self.stop, "Library watcher")
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _refresh_directories(self):
+        directories = dict(self._scanner.get_directories())
+        for playlist_id, recursive in directories.items():
+            if playlist_id not in self._directories and self._inotify:
+                self._watch_tree(playlist_id, recursive)
+        self._directories = directories
+
+    def _watch_tree(self, directory_path, recursive):
+        for root, dirs, _ in os.walk(directory_path):
+            if not recursive:
+                dirs[:] = []
+            try:
+                self._watches[self._inotify.add_watch(root, self._watch_mask)] = root
+            except OSError as e:
+                logging.getLogger("musicbot").warning("Could not watch %s: %s", root, e)
+
+    def _get_playlists(self, path):
+        for playlist_id, recursive in self._directories.items():
+            if path == playlist_id or (recursive and path.startswith(join(playlist_id, ""))):
+                yield playlist_id
+
+    def _mark_changed(self, playlist_id, now):
+        first, _ = self._pending.get(playlist_id, (now, now))
+        self._pending[playlist_id] = (first, now)
+
+    def _handle_events(self, events, now):
+        for wd, mask, name in events:
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                for playlist_id in self._directories:
+                    self._mark_changed(playlist_id, now)
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory_path = self._watches.get(wd)
+            if directory_path is None:
+                continue
+            is_dir = mask & _Inotify.IN_ISDIR
+            if not is_dir and name and not name.lower().endswith(".mp3"):
+                continue
+            playlist_ids = list(self._get_playlists(directory_path))
+            if is_dir and mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                path = join(directory_path, name)
+                if any(self._directories[playlist_id] for playlist_id in playlist_ids):
+                    self._watch_tree(path, True)
+            for playlist_id in playlist_ids:
+                self._mark_changed(playlist_id, now)
+
+    def _flush(self, now, force=False):
+        for playlist_id, (first, last) in list(self._pending.items()):
+            if not force and now - last < self._delay and now - first < self._max_delay:
+                continue
+            del self._pending[playlist_id]
+            if playlist_id not in self._directories:
+                continue
+            self._rescan(playlist_id)
+
+    def _rescan(self, playlist_id):
+        try:
+            result = self._scanner.scan_directory(playlist_id)
+        except (ValueError, OSError, sqlite3.Error) as e:
+            logging.getLogger("musicbot").warning("Could not rescan %s: %s", playlist_id, e)
+            return
+        added_ids = result['added_ids']
+        removed_ids = result['removed_ids']
+        updated_ids = result['updated_ids']
+        if added_ids or removed_ids or updated_ids:
+            logging.getLogger("musicbot").info("Library change in %s: %d added, %d removed, %d updated",
+                                               playlist_id, len(added_ids), len(removed_ids), len(updated_ids))
+            self._api.apply_library_changes(playlist_id, added_ids, removed_ids, updated_ids)
+
+    def run(self):
+        """
+        Watch until stop() is called.
+        """
+        stop_event = self._stop_event
+        next_refresh = 0
+        next_poll = 0
+        try:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if now >= next_refresh:
+                    self._refresh_directories()
+                    next_refresh = now + self._refresh_interval
+
+                if self._inotify:
+                    timeout = 1
+                    if self._pending:
+                        timeout = max(0, min(timeout, self._delay))
+                    events = self._inotify.read_events(timeout)
+                    self._handle_events(events, time.monotonic())
+                    self._flush(time.monotonic())
+                else:
+                    if now >= next_poll:
+                        for playlist_id in self._directories:
+                            self._rescan(playlist_id)
+                        next_poll = now + self._poll_interval
+                    stop_event.wait(1)
+        finally:
+            if self._inotify:
+                self._inotify.close()
@@ -1,26 +1,36 @@
 import json
 import logging
 import os
+import re
 import socket
 import sqlite3
 import threading
 import time
 import typing
+import unicodedata
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
 from itertools import cycle
 from itertools import islice
 from os.path import isfile, join
-from random import choice
 
 import pylru
 from gmusicapi.clients.mobileclient import Mobileclient
 from gmusicapi.exceptions import CallFailure
+from mutagen import MutagenError
+from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
 from pydub import AudioSegment
 
 import _version
 from musicbot import config
+from musicbot.album_art import AlbumArtStore
+from musicbot.database import ConnectionManager
+from musicbot.recommender import Recommender
+from musicbot.song_cache import SongCache
+from musicbot.suggestions import SuggestionPool, ShuffleBag
 
 _songs_path = config.get_songs_path()
 _max_downloads = max(config.get_max_downloads(), 1)
@@ -45,6 +55,40 @@ def _roundrobin(*iterables):
             nexts = cycle(islice(nexts, pending))
 
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _read_song_tags(fname):
+    """
+    Read the ID3 tags Song.load() writes to converted songs.
+    :param fname: the path to an mp3 file
+    :return: a dict with title, artist, album, composer and duration keys, or None
+    """
+    try:
+        audio = MP3(fname, ID3=ID3)
+    except (MutagenError, OSError):
+        return None
+    tags = audio.tags
+    if not tags or "TIT2" not in tags:
+        return None
+
+    def _get_text(frame_id):
+        frame = tags.get(frame_id)
+        if frame and frame.text:
+            return str(frame.text[0])
+        return None
+
+    return {
+        "title": _get_text("TIT2"),
+        "artist": _get_text("TPE1"),
+        "album": _get_text("TALB"),
+        "composer": _get_text("TCOM"),
+        "duration": datetime.fromtimestamp(audio.info.length).strftime("%M:%S")
+    }
+
+
 class Song(object):
     _download_semaphore = None
     _conversion_semaphore = None
@@ -63,6 +107,9 @@ class Song(object):
         str_rep -- a human readable string representation for this instance. Will be returned for __str__(). The song duration maybe will automatically appended.
         duration -- the song duration (as a string in the form [HH:]MM:SS)
         user -- a string describing which user queued this song (if applicable)
+
+        Except for the user, the fields of a song must not be changed after construction,
+        because its JSON representation is cached.
         """
         if not api:
             raise ValueError("api is None")
@@ -77,10 +124,8 @@ class Song(object):
         self.albumArtUrl = albumArtUrl
         self._api = api
         self.duration = duration
-        if user:
-            self.user = str(user)
-        else:
-            self.user = None
+        self._json_fragment = None
+        self.user = user
         self.loaded = False
 
         if str_rep:
@@ -165,6 +210,29 @@ class Song(object):
         self.loaded = True
         return fname
 
+    @property
+    def user(self):
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        if user:
+            self._user = str(user)
+        else:
+            self._user = None
+        self._json_fragment = None
+
+    def to_json_fragment(self) -> str:
+        """
+        Return the encoded JSON representation of this song.
+        It is encoded once and cached until the user changes.
+        """
+        fragment = self._json_fragment
+        if fragment is None:
+            fragment = json.dumps(self.to_json())
+            self._json_fragment = fragment
+        return fragment
+
     def to_json(self) -> typing.Dict[str, str]:
         return {
             "song_id": self.song_id,
@@ -228,6 +296,13 @@ class Song(object):
         return self.__str__() < other.__str__()
 
 
+def songs_to_json(songs: typing.Iterable[Song]) -> str:
+    """
+    Encode songs as a JSON array by joining their cached JSON fragments.
+    """
+    return "[" + ", ".join(song.to_json_fragment() for song in songs) + "]"
+
+
 class AbstractAPI(object):
     def get_name(self) -> str:
         """
@@ -250,6 +325,14 @@ class AbstractAPI(object):
         """
         raise NotImplementedError()
 
+    def lookup_songs(self, song_ids: typing.List[str]) -> typing.List[Song]:
+        """
+        Look up the info about multiple songs.
+        Return a list of Song objects (or None for unknown songs) in the order of song_ids.
+        Implementations should override this if they can look up songs more efficiently in batches.
+        """
+        return list(map(self.lookup_song, song_ids))
+
     def search_song(self, query: str, max_fetch: int = 1000) -> typing.Generator[Song, None, None]:
         """
         Search for songs.
@@ -258,6 +341,15 @@ class AbstractAPI(object):
         """
         raise NotImplementedError()
 
+    def refine_search(self, query: str, songs: typing.List[Song]) -> typing.Optional[typing.List[Song]]:
+        """
+        Get the results of a search from the complete results of a search for a prefix of the query,
+        e.g. while a user is still typing.
+        Implementations may override this if every result of a query is also a result of all its prefixes.
+        Return the matching songs in their order in songs, or None if they can't be derived from them.
+        """
+        return None
+
     def _download(self, song: Song) -> str:
         """
         Download a song and return its filename.
@@ -284,6 +376,19 @@ class AbstractSongProvider(AbstractAPI):
         """
         raise NotImplementedError()
 
+    def add_skipped(self, song: Song):
+        """
+        Called when a song of this provider is skipped while playing. Providers may use this to improve suggestions.
+        """
+        pass
+
+    def load_history(self, events: typing.List[typing.Tuple[str, bool]]):
+        """
+        Called once at startup with the past events of this provider, so recently played songs aren't suggested again.
+        :param events: a list of (song_id, skipped) tuples, the oldest first
+        """
+        pass
+
     def get_playlist(self) -> typing.List[Song]:
         """
         Return the list suggestions are based on.
@@ -324,19 +429,24 @@ class AbstractSongProvider(AbstractAPI):
 
 class GMusicAPI(AbstractSongProvider):
     _api = None
-    _songs = pylru.lrucache(256)
     _connect_lock = threading.Lock()
+    _hydration_batch_size = 50
+    _hydration_workers = 8
 
     def __init__(self):
         super().__init__()
         self._connect()
+        self._songs = SongCache(self)
         self._quality = config.get_gmusic_quality()
         self._playlist_id = None
         self._playlist_token = None
         self._station_id = None
-        self._last_played_ids = []
-        self._suggestions = []
-        self._playlist = set()
+        self._suggestions = SuggestionPool(recent_size=50)
+        # Maps song IDs to Song objects, or to None if the song info hasn't been loaded yet
+        self._playlist = {}
+        # Guards changes of the playlist, _hydrate_playlist() holds _hydrate_lock while looking up songs
+        self._playlist_lock = threading.Lock()
+        self._hydrate_lock = threading.Lock()
         self._load_ids()
         self._remote_playlist_load()
 
@@ -350,27 +460,33 @@ class GMusicAPI(AbstractSongProvider):
         return "Google Play Music"
 
     def lookup_song(self, song_id):
-        songs = self._songs
         if not song_id:
             raise ValueError("Song ID is None")
-        elif song_id in songs:
-            return songs[song_id]
-        else:
-            try:
-                info = self._api.get_track_info(song_id)
-            except CallFailure:
-                return Song(song_id, self)
-            return self._song_from_info(info)
+        song = self._fetch_song(song_id)
+        self._songs.flush()
+        return song
+
+    def _fetch_song(self, song_id):
+        """
+        Look up a song without flushing the song cache.
+        """
+        song = self._songs.get(song_id)
+        if song:
+            return song
+        try:
+            info = self._api.get_track_info(song_id)
+        except CallFailure:
+            return Song(song_id, self)
+        return self._song_from_info(info)
 
     def search_song(self, query, max_fetch=100):
         if not query:
             raise ValueError("query is None")
         max_fetch = min(100, max_fetch)
         results = self._api.search(query, max_fetch)
-        _song_from_info = self._song_from_info
-        for track in results['song_hits']:
-            info = track['track']
-            yield _song_from_info(info)
+        songs = [self._song_from_info(track['track']) for track in results['song_hits']]
+        self._songs.flush()
+        yield from songs
 
     def set_quality(self, quality):
         if not quality:
@@ -380,46 +496,48 @@ class GMusicAPI(AbstractSongProvider):
             raise ValueError("Quality must be hi, mid or low")
         self._quality = quality
 
-    def _add_last_played_id(self, song_id):
-        self._last_played_ids.append(song_id)
-        self._last_played_ids = self._last_played_ids[-50:]
-
     def get_song(self):
         self._load_suggestions(1)
-        song = self._suggestions.pop(0)
-        song_id = song.song_id
-        self._add_last_played_id(song_id)
+        song = self._suggestions.pop()
+        self._suggestions.add_played(song)
         return song
 
     def add_played(self, song):
-        if song not in self._playlist:
-            self._playlist.add(song)
+        with self._playlist_lock:
+            is_new = song.song_id not in self._playlist
+            if is_new:
+                self._playlist[song.song_id] = song
+        if is_new:
             self._remote_playlist_add(song)
-        self._suggestions = list(filter(lambda song: song != song, self._suggestions))
-        self._add_last_played_id(song.song_id)
+        self._suggestions.add_played(song)
+
+    def load_history(self, events):
+        for song_id, skipped in events:
+            if not skipped:
+                self._suggestions.add_played(song_id)
 
     def get_playlist(self):
-        return self._playlist
+        self._hydrate_playlist()
+        # Songs read from downloaded files are put into the cache as well
+        self._songs.flush()
+        with self._playlist_lock:
+            return set(filter(None, self._playlist.values()))
 
     def remove_from_playlist(self, song):
-        if song in self._playlist:
+        with self._playlist_lock:
+            removed = song.song_id in self._playlist
+            if removed:
+                del self._playlist[song.song_id]
+        if removed:
             self._remote_playlist_remove(song)
-            self._playlist.remove(song)
 
     def get_suggestions(self, max_len=15):
-        if len(self._suggestions) < max_len:
+        if not self._suggestions.is_stocked(max_len):
             self._load_suggestions(max_len)
-
-        if len(self._suggestions) > max_len:
-            return self._suggestions[:max_len]
-        else:
-            return self._suggestions
+        return self._suggestions.peek(max_len)
 
     def remove_from_suggestions(self, song):
-        try:
-            self._suggestions.remove(song)
-        except ValueError:
-            pass
+        self._suggestions.remove(song)
 
     def reload(self):
         self._suggestions.clear()
@@ -428,7 +546,8 @@ class GMusicAPI(AbstractSongProvider):
     def reset(self):
         self._remote_playlist_delete()
         self._remote_station_delete()
-        self._playlist.clear()
+        with self._playlist_lock:
+            self._playlist.clear()
 
     def _load_suggestions(self, max_len):
         self._remote_station_create()
@@ -436,22 +555,22 @@ class GMusicAPI(AbstractSongProvider):
             return
 
         api_songs = self._api.get_station_tracks(
-            self._station_id, recently_played_ids=self._last_played_ids, num_tracks=max(50, max_len))
+            self._station_id, recently_played_ids=self._suggestions.get_recent_ids(), num_tracks=max(50, max_len))
         if api_songs:
             self._suggestions.extend(map(self._song_from_info, api_songs))
-        else:
-            if not self._suggestions:
-                song_id = "Tj6fhurtstzgdpvfm4xv6i5cei4"
-                fallback_song = Song(song_id, self,
-                                     "Biste braun kriegste Fraun", "Mickie Krause",
-                                     str_rep="Mickie Krause - Biste braun kriegste Fraun")
-                self._suggestions.append(fallback_song)
+            self._songs.flush()
+        if not self._suggestions:
+            song_id = "Tj6fhurtstzgdpvfm4xv6i5cei4"
+            fallback_song = Song(song_id, self,
+                                 "Biste braun kriegste Fraun", "Mickie Krause",
+                                 str_rep="Mickie Krause - Biste braun kriegste Fraun")
+            self._suggestions.append(fallback_song, ignore_recent=True)
 
     def _remote_playlist_load(self):
         self._remote_playlist_create()
         playlist_contents = self._api.get_all_user_playlist_contents()
 
-        result = set()
+        result = {}
 
         tracks = None
         for playlist in playlist_contents:
@@ -463,42 +582,106 @@ class GMusicAPI(AbstractSongProvider):
 
         for track in tracks:
             if "track" in track:
-                result.add(self._song_from_info(track['track']))
+                song = self._song_from_info(track['track'])
+                result[song.song_id] = song
             else:
-                # We don't actually care for the song info, so we use lookup_song which will return a song without info.
-                # This is still problematic for features like (telegram) /stationremove, because all songs will show up as 'Unknown'.
-                # However, looking up the song info for every song from get_all_songs would be way too expensive.
-                # TODO consider looking up from ID3-Tag if file exists
-                result.add(self.lookup_song(track['trackId']))
+                # Looking up the info for every song would make startup way too slow.
+                # We only store the ID and load the info when someone calls get_playlist().
+                song_id = track['trackId']
+                result[song_id] = self._songs.get(song_id)
+        self._songs.flush()
 
         self._playlist = result
 
+    def _hydrate_playlist(self):
+        """
+        Load the info of all playlist songs which are only known by their ID.
+        The info is read from the ID3 tags of already downloaded songs if possible,
+        the remaining songs are looked up in batches.
+        """
+        with self._hydrate_lock:
+            with self._playlist_lock:
+                playlist = self._playlist
+                missing_ids = [song_id for song_id, song in playlist.items() if song is None]
+            if not missing_ids:
+                return
+
+            remote_ids = []
+            for song_id in missing_ids:
+                song = self._song_from_file(song_id)
+                if song:
+                    self._set_loaded(playlist, song)
+                else:
+                    remote_ids.append(song_id)
+
+            if not remote_ids:
+                return
+
+            logging.getLogger("musicbot").debug("Looking up %d playlist songs", len(remote_ids))
+            with ThreadPoolExecutor(self._hydration_workers) as executor:
+                for batch in _chunks(remote_ids, self._hydration_batch_size):
+                    for song in executor.map(self._fetch_song, batch):
+                        self._set_loaded(playlist, song)
+                    self._songs.flush()
+
+    def _set_loaded(self, playlist, song):
+        """
+        Store the loaded info of a playlist song.
+        :param playlist: the playlist dict the song ID has been read from
+        :param song: the loaded song
+        """
+        with self._playlist_lock:
+            # The song may have been removed in the meantime
+            if song.song_id in playlist:
+                playlist[song.song_id] = song
+
+    def _song_from_file(self, song_id):
+        """
+        Create a song from the ID3 tags of the downloaded song file.
+        :param song_id: the song ID
+        :return: a Song object, or None if the song hasn't been downloaded
+        """
+        fname = os.path.join(_songs_path, song_id + ".mp3")
+        if not isfile(fname):
+            return None
+        tags = _read_song_tags(fname)
+        if not tags:
+            return None
+        title = tags['title']
+        artist = tags['artist']
+        album_art_url = tags['album']
+        if album_art_url == "None":
+            album_art_url = None
+        str_rep = " - ".join([artist, title]) if artist else title
+        song = Song(song_id, self, title, artist, album_art_url, str_rep, tags['duration'])
+        self._songs.put(song)
+        return song
+
     def _remote_playlist_add(self, song):
         self._remote_playlist_create()
         self._api.add_songs_to_playlist(self._playlist_id, song.song_id)
 
     def _remote_playlist_remove(self, song):
         self._remote_playlist_create()
-        if song in self._playlist:
-            playlist_contents = self._api.get_all_user_playlist_contents()
+        playlist_contents = self._api.get_all_user_playlist_contents()
 
-            tracks = None
-            for playlist in playlist_contents:
-                if playlist['id'] == self._playlist_id:
-                    tracks = playlist['tracks']
-                    break
+        tracks = None
+        for playlist in playlist_contents:
+            if playlist['id'] == self._playlist_id:
+                tracks = playlist['tracks']
+                break
 
-            if not tracks:
-                return
+        if not tracks:
+            return
 
-            track = list(filter(lambda t: t['trackId'] == song.song_id, tracks))
-            if not track:
-                return
+        track = list(filter(lambda t: t['trackId'] == song.song_id, tracks))
+        if not track:
+            return
 
-            track = dict(track[0])
-            entry_id = track['id']
+        track = dict(track[0])
+        entry_id = track['id']
 
-            self._api.remove_entries_from_playlist(entry_id)
+        self._api.remove_entries_from_playlist(entry_id)
 
     def _remote_playlist_create(self):
         if not self._playlist_id:
@@ -559,9 +742,9 @@ class GMusicAPI(AbstractSongProvider):
             song_id = info['id']
         else:
             song_id = info['storeId']
-        songs = self._songs
-        if song_id in songs:
-            return songs[song_id]
+        song = self._songs.get_memory(song_id)
+        if song:
+            return song
         artist = info['artist']
         title = info['title']
         duration_millis = int(info['durationMillis'])
@@ -575,7 +758,7 @@ class GMusicAPI(AbstractSongProvider):
                     url = ref["url"]
 
         song = Song(song_id, self, title, artist, url, " - ".join([artist, title]), duration)
-        songs[song_id] = song
+        self._songs.put(song)
         return song
 
     def _download(self, song):
@@ -675,7 +858,6 @@ class GMusicAPI(AbstractSongProvider):
 
 class YouTubeAPI(AbstractAPI):
     _pafy = __import__("pafy")
-    _songs = pylru.lrucache(256)
     _api_key = None
 
     def __init__(self):
@@ -684,6 +866,7 @@ class YouTubeAPI(AbstractAPI):
 
         if not self._api_key:
             raise ValueError("Missing YouTube API key")
+        self._songs = SongCache(self)
 
     def get_name(self):
         return "youtube"
@@ -692,21 +875,21 @@ class YouTubeAPI(AbstractAPI):
         return "YouTube"
 
     def lookup_song(self, song_id):
-        songs = self._songs
         if not song_id:
             raise ValueError("Song ID is None")
-        elif song_id in songs:
-            return songs[song_id]
-        else:
-            url = "https://www.youtube.com/watch?v=" + song_id
-            video = self._pafy.new(url, gdata=True)
-            title = video.title
-            description = video.description
-            url = video.thumb
-            duration = video.duration
-            song = Song(song_id, self, title, description, albumArtUrl=url, duration=duration)
-            songs[song_id] = song
+        song = self._songs.get(song_id)
+        if song:
             return song
+        url = "https://www.youtube.com/watch?v=" + song_id
+        video = self._pafy.new(url, gdata=True)
+        title = video.title
+        description = video.description
+        url = video.thumb
+        duration = video.duration
+        song = Song(song_id, self, title, description, albumArtUrl=url, duration=duration)
+        self._songs.put(song)
+        self._songs.flush()
+        return song
 
     def search_song(self, query, max_fetch=50):
         if not query:
@@ -766,13 +949,13 @@ class YouTubeAPI(AbstractAPI):
 
 class SoundCloudAPI(AbstractAPI):
     _soundcloud = __import__("soundcloud")
-    _songs = pylru.lrucache(256)
     _client = None
     _connect_lock = threading.Lock()
 
     def __init__(self):
         super().__init__()
         self._connect()
+        self._songs = SongCache(self)
 
     def get_name(self):
         return "soundcloud"
@@ -781,17 +964,17 @@ class SoundCloudAPI(AbstractAPI):
         return "SoundCloud"
 
     def lookup_song(self, song_id):
-        songs = self._songs
         if not song_id:
             raise ValueError("Song ID is None")
-        elif song_id in songs:
-            return songs[song_id]
-        else:
-            info = self._client.get("/tracks/{}".format(song_id))
-            song = self._song_from_info(info)
-            if not song:
-                raise ValueError("Song is not streamable or downloadable")
+        song = self._songs.get(song_id)
+        if song:
             return song
+        info = self._client.get("/tracks/{}".format(song_id))
+        song = self._song_from_info(info)
+        self._songs.flush()
+        if not song:
+            raise ValueError("Song is not streamable or downloadable")
+        return song
 
     def search_song(self, query, max_fetch=200):
         if not query:
@@ -801,10 +984,9 @@ class SoundCloudAPI(AbstractAPI):
         _info_to_song = self._song_from_info
         count = 0
         while count < max_fetch:
-            for info in resource.collection:
-                song = _info_to_song(info)
-                if not song:
-                    continue
+            songs = list(filter(None, map(_info_to_song, resource.collection)))
+            self._songs.flush()
+            for song in songs:
                 count += 1
                 yield song
 
@@ -852,9 +1034,9 @@ class SoundCloudAPI(AbstractAPI):
         :return: a Song object, or None
         """
         song_id = str(info.id)
-        songs = self._songs
-        if song_id in songs:
-            return songs[song_id]
+        song = self._songs.get_memory(song_id)
+        if song:
+            return song
         if not info.streamable and not info.downloadable:
             return None
         artist = info.user['username']
@@ -863,7 +1045,7 @@ class SoundCloudAPI(AbstractAPI):
         duration_millis = info.duration
         duration = datetime.fromtimestamp(duration_millis / 1000).strftime("%M:%S")
         song = Song(song_id, self, title, artist, url, " - ".join([artist, title]), duration=duration)
-        songs[song_id] = song
+        self._songs.put(song)
         return song
 
     @classmethod
@@ -882,7 +1064,94 @@ class SoundCloudAPI(AbstractAPI):
                 cls._connect_lock.release()
 
 
+def _parse_duration(duration):
+    """
+    Convert a duration string in the form [HH:]MM:SS to seconds.
+    :return: the duration in seconds or None if the duration is missing or invalid
+    """
+    if not duration:
+        return None
+    seconds = 0
+    try:
+        for part in duration.split(":"):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return None
+    return seconds
+
+
+def _offline_db_v1(db):
+    # The schema before versioning was introduced
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS songs(songId TEXT PRIMARY KEY, title TEXT, description TEXT, stringRep TEXT, albumArtUrl TEXT, path TEXT UNIQUE NOT NULL, duration TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS playlists(playlistId TEXT UNIQUE NOT NULL, name TEXT NOT NULL)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS playlistSongs(playlistId INTEGER NOT NULL REFERENCES playlists(playlistId), songId TEXT NOT NULL REFERENCES songs(songId), PRIMARY KEY(playlistId, songId))")
+    db.execute("CREATE TABLE IF NOT EXISTS albumArts(songId TEXT PRIMARY KEY, albumArt BLOB NOT NULL)")
+
+
+def _offline_db_v2(db):
+    # An explicit INTEGER PRIMARY KEY keeps the rowids the search index refers to stable, even across a VACUUM
+    db.execute(
+        "CREATE TABLE songsNew(id INTEGER PRIMARY KEY, songId TEXT UNIQUE NOT NULL, title TEXT, description TEXT, stringRep TEXT, albumArtUrl TEXT, path TEXT UNIQUE NOT NULL, duration TEXT, durationSeconds INTEGER)")
+    db.execute(
+        "INSERT INTO songsNew(id, songId, title, description, stringRep, albumArtUrl, path, duration) SELECT rowid, songId, title, description, stringRep, albumArtUrl, path, duration FROM songs")
+
+    def _fix_song(row):
+        song_id, string_rep, duration = row
+        # stringRep used to contain the duration, which was then appended a second time by Song.__str__()
+        suffix = " ({})".format(duration)
+        if duration and string_rep and string_rep.endswith(suffix):
+            string_rep = string_rep[:-len(suffix)]
+        return string_rep, _parse_duration(duration), song_id
+
+    rows = db.execute("SELECT id, stringRep, duration FROM songsNew").fetchall()
+    db.executemany("UPDATE songsNew SET stringRep=?, durationSeconds=? WHERE id=?", map(_fix_song, rows))
+    db.execute("DROP TABLE songs")
+    db.execute("ALTER TABLE songsNew RENAME TO songs")
+
+    # Playlist IDs are paths or share tokens, numeric-looking IDs were stored as integers before
+    db.execute(
+        "CREATE TABLE playlistSongsNew(playlistId TEXT NOT NULL REFERENCES playlists(playlistId), songId TEXT NOT NULL REFERENCES songs(songId), PRIMARY KEY(playlistId, songId))")
+    db.execute("INSERT OR IGNORE INTO playlistSongsNew(playlistId, songId) SELECT CAST(playlistId AS TEXT), songId FROM playlistSongs")
+    db.execute("DROP TABLE playlistSongs")
+    db.execute("ALTER TABLE playlistSongsNew RENAME TO playlistSongs")
+    db.execute("CREATE INDEX playlistSongsSongId ON playlistSongs(songId)")
+
+
+def _offline_db_v3(db):
+    # Local directory playlists and the state of every scanned file, so rescans only parse changed files
+    db.execute(
+        "CREATE TABLE libraryDirectories(playlistId TEXT PRIMARY KEY REFERENCES playlists(playlistId), recursive INTEGER NOT NULL)")
+    db.execute(
+        "CREATE TABLE libraryFiles(path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, songId TEXT)")
+
+    # Local playlists used to be identified by their directory path only
+    for (playlist_id,) in db.execute("SELECT playlistId FROM playlists").fetchall():
+        if not os.path.isdir(playlist_id):
+            continue
+        prefix = os.path.join(playlist_id, "")
+        paths = db.execute(
+            "SELECT path FROM songs WHERE songId IN (SELECT songId FROM playlistSongs WHERE playlistId=?)",
+            [playlist_id]).fetchall()
+        recursive = any(os.path.dirname(path[0]) != playlist_id for path in paths if path[0].startswith(prefix))
+        db.execute("INSERT INTO libraryDirectories(playlistId, recursive) VALUES(?, ?)", [playlist_id, recursive])
+
+
+def _offline_db_v4(db):
+    # The files album arts have been extracted to, named by the hash of the image
+    db.execute("CREATE TABLE albumArtFiles(songId TEXT PRIMARY KEY, hash TEXT NOT NULL, mimeType TEXT NOT NULL)")
+
+
+_offline_db_migrations = [_offline_db_v1, _offline_db_v2, _offline_db_v3, _offline_db_v4]
+
+
 class OfflineAPI(AbstractSongProvider):
+    _insert_song_query = "INSERT OR IGNORE INTO songs(songId, title, description, stringRep, albumArtUrl, path, duration, durationSeconds) VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
+    _song_cache_size = 8192
+    # SQLite allows at most 999 parameters per statement in older versions
+    _lookup_chunk_size = 500
+
     def __init__(self):
         super().__init__()
         self._fallback_path = os.path.realpath(join(_songs_path, "Tj6fhurtstzgdpvfm4xv6i5cei4.mp3"))
@@ -892,36 +1161,66 @@ class OfflineAPI(AbstractSongProvider):
         self._fallback_playlist = OfflineAPI._Playlist("fallbackID", "fallbackPlaylist", [self._fallback_id])
         self._active_playlist = None
         self._db_path = os.path.join(_songs_path, "offline_playlists.db")
+        self._db = ConnectionManager(self._db_path)
         self._create_db()
-        self._next_songs = []
-        self._last_played_ids = []
+        self._album_arts = AlbumArtStore(self._db, join(_songs_path, "album_art"), config.get_album_art_sizes())
+        self._songs = pylru.lrucache(self._song_cache_size)
+        self._songs_lock = threading.Lock()
+        self._next_songs = SuggestionPool(recent_size=50)
+        if config.get_offline_recommender_enabled():
+            self._recommender = Recommender(min(config.get_offline_no_repeat(), 5))
+        else:
+            self._recommender = None
+        self._library_listeners = []
         active_playlist_id = config.get_state("active_offline_playlist")
         if active_playlist_id:
             self.set_active_playlist(active_playlist_id)
 
     def _create_db(self):
-        db = sqlite3.connect(self._db_path)
+        self._db.migrate(_offline_db_migrations)
+        with self._db.transaction() as db:
+            db.execute(
+                self._insert_song_query,
+                [
+                    self._fallback_id,
+                    "Biste braun kriegste Fraun",
+                    "Mickie Krause",
+                    "Mickie Krause - Biste braun kriegste Fraun",
+                    "http://lh3.googleusercontent.com/-ErPXoaDD1a4Y5JzOGwZK0Q3ZvFhziKoV0HJCgrIFTen2NYU93WtF0R_3ESFb_MvhHxOfPyA-g",
+                    self._fallback_path,
+                    None,
+                    None
+                ])
+        self._fts_enabled = self._create_search_index()
+
+    def _create_search_index(self):
+        """
+        Create the full text search index over the songs table if it doesn't exist yet.
+        The index is kept in sync by triggers, so every insert into songs is indexed automatically.
+        :return: whether full text search is available
+        """
+        db = self._db
         try:
-            with db:
+            with db.transaction():
+                # Rebuilding the songs table drops the triggers, so the index may be out of date in that case, too
+                existing = db.execute(
+                    "SELECT count(*) FROM sqlite_master WHERE name IN ('songsSearch', 'songsSearchInsert', 'songsSearchDelete', 'songsSearchUpdate')").fetchone()[
+                    0]
                 db.execute(
-                    "CREATE TABLE IF NOT EXISTS songs(songId TEXT PRIMARY KEY, title TEXT, description TEXT, stringRep TEXT, albumArtUrl TEXT, path TEXT UNIQUE NOT NULL, duration TEXT)")
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS songsSearch USING fts5(title, description, stringRep, content='songs', content_rowid='rowid')")
                 db.execute(
-                    "CREATE TABLE IF NOT EXISTS playlists(playlistId TEXT UNIQUE NOT NULL, name TEXT NOT NULL)")
+                    "CREATE TRIGGER IF NOT EXISTS songsSearchInsert AFTER INSERT ON songs BEGIN INSERT INTO songsSearch(rowid, title, description, stringRep) VALUES(new.rowid, new.title, new.description, new.stringRep); END")
                 db.execute(
-                    "CREATE TABLE IF NOT EXISTS playlistSongs(playlistId INTEGER NOT NULL REFERENCES playlists(playlistId), songId TEXT NOT NULL REFERENCES songs(songId), PRIMARY KEY(playlistId, songId))")
-                db.execute("CREATE TABLE IF NOT EXISTS albumArts(songId TEXT PRIMARY KEY, albumArt BLOB NOT NULL)")
+                    "CREATE TRIGGER IF NOT EXISTS songsSearchDelete AFTER DELETE ON songs BEGIN INSERT INTO songsSearch(songsSearch, rowid, title, description, stringRep) VALUES('delete', old.rowid, old.title, old.description, old.stringRep); END")
                 db.execute(
-                    "INSERT OR IGNORE INTO songs(songId, title, description, stringRep, albumArtUrl, path) VALUES(?, ?, ?, ?, ?, ?)",
-                    [
-                        self._fallback_id,
-                        "Biste braun kriegste Fraun",
-                        "Mickie Krause",
-                        "Mickie Krause - Biste braun kriegste Fraun",
-                        "http://lh3.googleusercontent.com/-ErPXoaDD1a4Y5JzOGwZK0Q3ZvFhziKoV0HJCgrIFTen2NYU93WtF0R_3ESFb_MvhHxOfPyA-g",
-                        self._fallback_path
-                    ])
-        finally:
-            db.close()
+                    "CREATE TRIGGER IF NOT EXISTS songsSearchUpdate AFTER UPDATE ON songs BEGIN INSERT INTO songsSearch(songsSearch, rowid, title, description, stringRep) VALUES('delete', old.rowid, old.title, old.description, old.stringRep); INSERT INTO songsSearch(rowid, title, description, stringRep) VALUES(new.rowid, new.title, new.description, new.stringRep); END")
+                if existing < 4:
+                    # Index the songs which have been added before the index (or its triggers) existed
+                    db.execute("INSERT INTO songsSearch(songsSearch) VALUES('rebuild')")
+        except sqlite3.OperationalError as e:
+            logging.getLogger("musicbot").warning("Full text search unavailable, falling back to LIKE search: %s", e)
+            return False
+        return True
 
     @staticmethod
     def _get_song_tuple(song: Song) -> typing.Tuple:
@@ -930,7 +1229,8 @@ class OfflineAPI(AbstractSongProvider):
         song_path = song.song_id + ".mp3"
         if not isfile(song_path):
             return None
-        return song.song_id, song.title, song.description, str(song), song.albumArtUrl, song_path, song.duration
+        return (song.song_id, song.title, song.description, song._str_rep, song.albumArtUrl, song_path, song.duration,
+                _parse_duration(song.duration))
 
     @staticmethod
     def _get_song_tuple_generator(songs: typing.List[Song]):
@@ -945,8 +1245,27 @@ class OfflineAPI(AbstractSongProvider):
         return "Offline"
 
     def add_played(self, song: Song):
-        self._last_played_ids.append(song.song_id)
-        self._last_played_ids = self._last_played_ids[-50:]
+        self._next_songs.add_played(song)
+        self._get_active_playlist().shuffle_bag.add_played(song.song_id)
+        if self._recommender is not None:
+            self._recommender.add_played(song.song_id)
+
+    def add_skipped(self, song: Song):
+        if self._recommender is not None:
+            self._recommender.add_skipped(song.song_id)
+
+    def load_history(self, events):
+        shuffle_bag = self._get_active_playlist().shuffle_bag
+        recommender = self._recommender
+        for song_id, skipped in events:
+            if skipped:
+                if recommender is not None:
+                    recommender.add_skipped(song_id)
+                continue
+            self._next_songs.add_played(song_id)
+            shuffle_bag.add_played(song_id)
+            if recommender is not None:
+                recommender.add_played(song_id)
 
     def reload(self):
         pass
@@ -958,7 +1277,7 @@ class OfflineAPI(AbstractSongProvider):
         :return:
         """
         active_playlist = self._active_playlist
-        if active_playlist:
+        if active_playlist and active_playlist.song_ids:
             return active_playlist
         return self._fallback_playlist
 
@@ -974,115 +1293,148 @@ class OfflineAPI(AbstractSongProvider):
         Load the next songs up to max_load.
         :param max_load: the maximum number of songs to load
         """
-        if len(self._next_songs) >= max_load:
+        next_songs = self._next_songs
+        if len(next_songs) >= max_load:
             return
 
-        playlist = self._get_active_playlist()
-
-        if playlist.playlist_id == "fallbackID":
-            if not self._next_songs:
-                self._next_songs.append(self.lookup_song(playlist.song_ids[0]))
-            return
-
-        last_played = self._last_played_ids
-
-        conflicts = 0
-        extender = []
-        while len(extender) < max_load and conflicts < 20:
-            store_id = choice(playlist.song_ids)
-            if store_id in last_played or store_id in extender:
-                conflicts += 1
-                continue
-            extender.append(store_id)
-        self._next_songs.extend(map(self.lookup_song, extender))
+        shuffle_bag = self._get_active_playlist().shuffle_bag
+        # Every suggestion is based on the one before, so the suggestions follow a path through the playlist
+        seed = next_songs.peek_last()
+        seed_id = seed.song_id if seed else None
+        # The shuffle bag takes care of recently played songs, every song is drawn at most once per call
+        draws = len(shuffle_bag)
+        while len(next_songs) < max_load and draws:
+            song_ids = []
+            while len(next_songs) + len(song_ids) < max_load and draws:
+                draws -= 1
+                song_id = self._draw_song_id(shuffle_bag, seed_id)
+                if song_id not in next_songs and song_id not in song_ids:
+                    song_ids.append(song_id)
+                    seed_id = song_id
+            for song in self.lookup_songs(song_ids):
+                if song:
+                    next_songs.append(song, ignore_recent=True)
+
+    def _draw_song_id(self, shuffle_bag, seed_id):
+        recommender = self._recommender
+        if recommender is not None:
+            song_id = recommender.recommend(seed_id)
+            if song_id and song_id in shuffle_bag and not self._next_songs.was_played_recently(song_id):
+                # Keep the shuffle bag from suggesting the same song soon
+                shuffle_bag.add_played(song_id)
+                return song_id
+        return shuffle_bag.draw()
 
     def get_song(self):
         self._load_next_songs(1)
-        return self._next_songs.pop(0)
+        song = self._next_songs.pop()
+        self.add_played(song)
+        return song
 
     def get_suggestions(self, max_len=20):
-        self._load_next_songs(max_len)
-        return self._next_songs[:max_len]
+        if not self._next_songs.is_stocked(max_len):
+            self._load_next_songs(max_len)
+        return self._next_songs.peek(max_len)
 
     def remove_playlist(self, playlist_id):
-        db = sqlite3.connect(self._db_path)
-        try:
-            with db:
-                db.execute("DELETE FROM playlistSongs WHERE playlistId=?", [playlist_id])
-                db.execute("DELETE FROM playlists WHERE playlistId=?", [playlist_id])
-        finally:
-            db.close()
+        with self._db.transaction() as db:
+            db.execute("DELETE FROM playlistSongs WHERE playlistId=?", [playlist_id])
+            db.execute("DELETE FROM libraryDirectories WHERE playlistId=?", [playlist_id])
+            db.execute("DELETE FROM playlists WHERE playlistId=?", [playlist_id])
         active = self._active_playlist
         if active and active.playlist_id == playlist_id:
             self._active_playlist = None
+            if self._recommender is not None:
+                self._recommender.set_songs([])
 
     def add_playlist(self, playlist_id, name, songs: typing.List[Song]):
-        db = sqlite3.connect(self._db_path)
-        try:
-            with db:
-                cursor = db.cursor()
-                cursor.execute("INSERT OR IGNORE INTO playlists(playlistId, name) VALUES(?, ?)", [playlist_id, name])
-                cursor.executemany(
-                    "INSERT OR IGNORE INTO songs(songId, title, description, stringRep, albumArtUrl, path, duration) VALUES(?, ?, ?, ?, ?, ?, ?)",
-                    filter(None, self._get_song_tuple_generator(songs)))
-                cursor.executemany("INSERT OR IGNORE INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
-                                   map(lambda song: (playlist_id, song.song_id), songs))
-        finally:
-            db.close()
+        with self._db.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO playlists(playlistId, name) VALUES(?, ?)", [playlist_id, name])
+            db.executemany(self._insert_song_query, filter(None, self._get_song_tuple_generator(songs)))
+            db.executemany("INSERT OR IGNORE INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
+                           map(lambda song: (playlist_id, song.song_id), songs))
 
     def add_to_playlist(self, song):
         active_playlist = self._active_playlist
         if active_playlist:
-            active_playlist.add(song)
+            active_playlist.add(song.song_id)
         else:
             raise ValueError("No active playlist")
+        if self._recommender is not None:
+            self._recommender.add_song(song.song_id, song.description)
 
         playlist_id = active_playlist.playlist_id
 
-        db = sqlite3.connect(self._db_path)
-        try:
-            with db:
-                db.execute(
-                    "INSERT OR IGNORE INTO songs(songId, title, description, stringRep, albumArtUrl, path, duration) VALUES(?, ?, ?, ?, ?, ?, ?)",
-                    self._get_song_tuple(song))
-                db.execute("INSERT OR IGNORE INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
-                           (playlist_id, song.song_id))
-        finally:
-            db.close()
+        with self._db.transaction() as db:
+            db.execute(self._insert_song_query, self._get_song_tuple(song))
+            db.execute("INSERT OR IGNORE INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
+                       (playlist_id, song.song_id))
 
     def remove_from_playlist(self, song):
         active_playlist = self._active_playlist
         if active_playlist:
-            active_playlist.remove(song)
+            active_playlist.remove(song.song_id)
         else:
             raise ValueError("No active playlist")
+        if self._recommender is not None:
+            self._recommender.remove_song(song.song_id)
 
         playlist_id = active_playlist.playlist_id
 
-        db = sqlite3.connect(self._db_path)
-        try:
-            with db:
-                db.execute("DELETE FROM playlistSongs WHERE playlistId=? AND songId=?",
-                           (playlist_id, song.song_id))
-        finally:
-            db.close()
+        with self._db.transaction() as db:
+            db.execute("DELETE FROM playlistSongs WHERE playlistId=? AND songId=?", (playlist_id, song.song_id))
 
     def remove_from_suggestions(self, song: Song):
-        try:
-            self._next_songs.remove(song)
-        except ValueError:
-            pass
+        self._next_songs.remove(song)
+
+    def apply_library_changes(self, playlist_id, added_ids, removed_ids, updated_ids):
+        """
+        Update the in-memory state after the songs of a playlist have been changed in the database.
+        :param playlist_id: the ID of the changed playlist
+        :param added_ids: the IDs of songs added to the playlist
+        :param removed_ids: the IDs of songs removed from the playlist
+        :param updated_ids: the IDs of songs whose info changed
+        """
+        with self._songs_lock:
+            for song_id in removed_ids + updated_ids:
+                if song_id in self._songs:
+                    del self._songs[song_id]
+        for song_id in removed_ids + updated_ids:
+            self._next_songs.remove(song_id)
+        # New songs may have been looked up before they had album art
+        self._album_arts.forget(added_ids + removed_ids + updated_ids)
+
+        active_playlist = self._active_playlist
+        if active_playlist and active_playlist.playlist_id == playlist_id:
+            for song_id in removed_ids:
+                active_playlist.remove(song_id)
+            for song_id in added_ids:
+                active_playlist.add(song_id)
+
+            recommender = self._recommender
+            if recommender is not None:
+                for song_id in removed_ids + updated_ids:
+                    recommender.remove_song(song_id)
+                for song in self.lookup_songs(added_ids + updated_ids):
+                    if song and song.song_id in active_playlist.shuffle_bag:
+                        recommender.add_song(song.song_id, song.description)
+
+        for listener in self._library_listeners:
+            listener()
+
+    def add_library_listener(self, listener):
+        """
+        Add a listener which is called without arguments after songs have been added, removed or changed,
+        e.g. to drop cached search results. It is called on the thread applying the changes.
+        """
+        self._library_listeners.append(listener)
 
     def get_available_playlists(self):
         """
         Get a list of available playlists
         :return: a list of (playlist_id, playlist_name) tuples
         """
-        db = sqlite3.connect(self._db_path)
-        try:
-            return db.execute("SELECT playlistId, name FROM playlists").fetchall()
-        finally:
-            db.close()
+        return self._db.execute("SELECT playlistId, name FROM playlists").fetchall()
 
     def get_active_playlist(self):
         """
@@ -1094,105 +1446,206 @@ class OfflineAPI(AbstractSongProvider):
             return playlist.playlist_id, playlist.name
         return None
 
-    @staticmethod
-    def _get_tuple_generator(cursor: sqlite3.Cursor, fetch_size=100):
-        while True:
-            tuples = cursor.fetchmany(fetch_size)
-            if not tuples:
-                break
-            yield from tuples
-
     def set_active_playlist(self, playlist_id):
-        def _song_id_from_tuple(song_tuple):
-            return song_tuple[0]
-
-        db = sqlite3.connect(self._db_path)
-        try:
-            name = db.execute("SELECT name FROM playlists WHERE playlistId=?", [playlist_id]).fetchone()[0]
-            cursor = db.execute(
-                "SELECT songId FROM (SELECT * FROM playlists WHERE playlistId=?) NATURAL JOIN playlistSongs",
-                [playlist_id])
-            song_ids = list(map(_song_id_from_tuple, self._get_tuple_generator(cursor)))
-            playlist = OfflineAPI._Playlist(playlist_id, name, song_ids)
-            self._active_playlist = playlist
-            config.save_state("active_offline_playlist", playlist.playlist_id)
-            self._next_songs = []
-            self._last_played_ids = []
-        except IndexError:
+        db = self._db
+        name_row = db.execute("SELECT name FROM playlists WHERE playlistId=?", [playlist_id]).fetchone()
+        if not name_row:
             raise ValueError("Unknown playlist")
-        finally:
-            db.close()
+        song_tuples = db.execute(
+            "SELECT playlistSongs.songId, songs.description FROM playlistSongs LEFT JOIN songs ON songs.songId=playlistSongs.songId WHERE playlistId=?",
+            [playlist_id]).fetchall()
+        song_ids = [song_tuple[0] for song_tuple in song_tuples]
+        playlist = OfflineAPI._Playlist(playlist_id, name_row[0], song_ids, config.get_offline_no_repeat())
+        if self._recommender is not None:
+            self._recommender.set_songs(song_tuples)
+        self._active_playlist = playlist
+        config.save_state("active_offline_playlist", playlist.playlist_id)
+        self._next_songs.reset()
 
     def get_playlist(self):
         active_playlist = self._active_playlist
         if active_playlist:
-            return list(map(self.lookup_song, active_playlist.song_ids))
+            return list(filter(None, self.lookup_songs(active_playlist.song_ids)))
         else:
             return []
 
-    def search_song(self, query, max_fetch=100):
-        query_parts = query.strip().lower().split(" ")
-        sqlite_query_args = list(_roundrobin(query_parts, query_parts))
-        sqlite_query_parts = map(lambda part: "title LIKE ('%' || ? || '%') OR description LIKE ('%' || ? || '%')",
-                                 query_parts)
-        sqlite_query = "SELECT songId, title, description, stringRep, albumArtUrl, path, duration FROM songs WHERE " + " OR ".join(
-            sqlite_query_parts)
-
-        def song_from_tuple(song_tuple):
-            song = Song(song_tuple[0], self, song_tuple[1], song_tuple[2], song_tuple[4], song_tuple[3], song_tuple[6])
-            song.load = lambda: song_tuple[5]
-            song.loaded = True
-            return song
+    def _song_from_tuple(self, song_tuple):
+        song_id, title, description, stringRep, albumArtUrl, path, duration = song_tuple
+        song = Song(song_id, self, title, description, albumArtUrl, stringRep, duration)
+        song.load = lambda: path
+        song.loaded = True
+        return song
 
-        db = sqlite3.connect(self._db_path)
-        try:
-            cursor = db.execute(sqlite_query, sqlite_query_args)
-            for song_tuple in self._get_tuple_generator(cursor, max_fetch):
-                yield song_from_tuple(song_tuple)
-        finally:
-            db.close()
+    @staticmethod
+    def _get_fts_query(query):
+        """
+        Convert a user query to an FTS5 query matching songs which contain all words as prefixes.
+        :return: the FTS5 query or None if the query contains no words
+        """
+        # Like the unicode61 tokenizer, split on underscores, too
+        words = re.findall(r"[^\W_]+", query.lower())
+        if not words:
+            return None
+        return " ".join('"{}"*'.format(word) for word in words)
+
+    @staticmethod
+    def _get_search_tokens(text):
+        """
+        Split a text into lower case words without diacritics, like the FTS5 unicode61 tokenizer does.
+        """
+        if not text:
+            return []
+        text = "".join(c for c in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(c))
+        return re.findall(r"[^\W_]+", text)
+
+    def refine_search(self, query, songs):
+        # With LIKE search, additional words match additional songs
+        if not self._fts_enabled:
+            return None
+        words = self._get_search_tokens(query)
+        if not words:
+            return []
+        _get_search_tokens = self._get_search_tokens
+
+        def _matches(song):
+            tokens = set(_get_search_tokens(song.title) + _get_search_tokens(song.description) + _get_search_tokens(
+                song._str_rep))
+            return all(any(token.startswith(word) for token in tokens) for word in words)
+
+        return list(filter(_matches, songs))
+
+    def search_page(self, query, offset=0, limit=50):
+        """
+        Search for songs and return one page of results, best matches first.
+        :param query: the search query
+        :param offset: the number of results to skip, use the returned offset to get the next page
+        :param limit: the maximum number of results on the page
+        :return: a tuple (songs, next_offset), next_offset is None if there are no more results
+        """
+        if not query:
+            raise ValueError("query is None")
+
+        if self._fts_enabled:
+            fts_query = self._get_fts_query(query)
+            if not fts_query:
+                return [], None
+            # bm25 scores are negative, the best match has the lowest score. Title matches weigh the most.
+            song_tuples = self._db.execute(
+                "SELECT songs.songId, songs.title, songs.description, songs.stringRep, songs.albumArtUrl, songs.path, songs.duration FROM songsSearch JOIN songs ON songs.rowid=songsSearch.rowid WHERE songsSearch MATCH ? ORDER BY bm25(songsSearch, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?",
+                (fts_query, limit, offset)).fetchall()
+        else:
+            query_parts = query.strip().lower().split(" ")
+            sqlite_query_args = list(_roundrobin(query_parts, query_parts))
+            sqlite_query_parts = map(
+                lambda part: "title LIKE ('%' || ? || '%') OR description LIKE ('%' || ? || '%')", query_parts)
+            sqlite_query = "SELECT songId, title, description, stringRep, albumArtUrl, path, duration FROM songs WHERE " + " OR ".join(
+                sqlite_query_parts) + " LIMIT ? OFFSET ?"
+            song_tuples = self._db.execute(sqlite_query, sqlite_query_args + [limit, offset]).fetchall()
+
+        songs = list(map(self._song_from_tuple, song_tuples))
+        next_offset = offset + len(songs) if len(songs) == limit else None
+        return songs, next_offset
+
+    def search_song(self, query, max_fetch=100):
+        if not query:
+            raise ValueError("query is None")
+        # Fetch whole pages, the generator may be continued by another thread with its own connection
+        offset = 0
+        while offset is not None:
+            songs, offset = self.search_page(query, offset, max_fetch)
+            yield from songs
 
-    @pylru.lrudecorator(1024)
     def lookup_song(self, song_id):
-        db = sqlite3.connect(self._db_path)
+        return self.lookup_songs([song_id])[0]
+
+    def lookup_songs(self, song_ids):
+        songs = {}
+        missing_ids = []
+        with self._songs_lock:
+            cache = self._songs
+            for song_id in song_ids:
+                if song_id in songs:
+                    continue
+                if song_id in cache:
+                    songs[song_id] = cache[song_id]
+                else:
+                    # Mark as seen, so duplicates are only queried once
+                    songs[song_id] = None
+                    missing_ids.append(song_id)
+
+        for chunk in _chunks(missing_ids, self._lookup_chunk_size):
+            cursor = self._db.execute(
+                "SELECT songId, title, description, stringRep, albumArtUrl, path, duration FROM songs WHERE songId IN ({})".format(
+                    ", ".join("?" * len(chunk))), chunk)
+            loaded = list(map(self._song_from_tuple, cursor))
+            with self._songs_lock:
+                for song in loaded:
+                    songs[song.song_id] = song
+                    self._songs[song.song_id] = song
+
+        return [songs[song_id] for song_id in song_ids]
+
+    def get_album_art(self, song_id):
+        """
+        Get the album art of a song.
+        :param song_id: the song ID
+        :return: the image data as bytes, or None
+        """
+        row = self._db.execute("SELECT albumArt FROM albumArts WHERE songId=?", [song_id]).fetchone()
+        if not row:
+            return None
+        return row[0]
 
-        try:
-            with db:
-                cursor = db.execute(
-                    "SELECT title, description, stringRep, albumArtUrl, path, duration FROM songs WHERE songId=?",
-                    [song_id])
-                song_tuple = cursor.fetchone()
-                if not song_tuple:
-                    return None
-                title, description, stringRep, albumArtUrl, path, duration = song_tuple
-                song = Song(song_id, self, title, description, albumArtUrl, stringRep, duration)
-                song.load = lambda: path
-                song.loaded = True
-                return song
-        finally:
-            db.close()
+    def get_album_art_file(self, song_id, size=None):
+        """
+        Get the file the album art of a song has been extracted to.
+        :param song_id: the song ID
+        :param size: the minimum width and height of the image, None for the original image
+        :return: an AlbumArt object, or None if the song has no album art
+        """
+        return self._album_arts.get(song_id, size)
+
+    def get_album_art_by_hash(self, content_hash, size=None):
+        """
+        Get an album art file by the hash of the original image, see get_album_art_file().
+        """
+        return self._album_arts.get_by_hash(content_hash, size)
+
+    def get_album_art_store(self):
+        return self._album_arts
+
+    def get_db_stats(self):
+        """
+        Return the query timings of the playlist database, as returned by ConnectionManager.get_stats().
+        """
+        return self._db.get_stats()
 
     def reset(self):
         self._active_playlist = None
-        self._last_played_ids = []
+        self._next_songs.reset()
+        if self._recommender is not None:
+            self._recommender = Recommender(min(config.get_offline_no_repeat(), 5))
+        with self._songs_lock:
+            self._songs.clear()
+        self._db.close_all()
         os.remove(self._db_path)
 
     class _Playlist(object):
-        def __init__(self, playlist_id, name, song_ids: typing.List[str]):
+        def __init__(self, playlist_id, name, song_ids: typing.List[str], no_repeat=0):
             self.playlist_id = playlist_id
             self.name = name
             self.song_ids = song_ids
+            self.shuffle_bag = ShuffleBag(song_ids, no_repeat)
 
-        def add(self, song):
-            song_ids = self.song_ids
-            if song not in song_ids:
-                song_ids.append(song)
+        def add(self, song_id):
+            if song_id not in self.shuffle_bag:
+                self.song_ids.append(song_id)
+                self.shuffle_bag.add(song_id)
 
-        def remove(self, song):
-            try:
-                self.song_ids.remove(song)
-            except ValueError:
-                pass
+        def remove(self, song_id):
+            if song_id in self.shuffle_bag:
+                self.shuffle_bag.remove(song_id)
+                self.song_ids.remove(song_id)
 
         def to_json(self):
             return {
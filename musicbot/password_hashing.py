@@ -0,0 +1,12 @@
+from passlib.hash import bcrypt_sha256
+
+
+# These functions run in the worker processes of the REST API's hashing pool. The workers import this module only,
+# so it must not import modules with side effects, like musicbot.config asking for the secrets password.
+
+def hash_password(password):
+    return bcrypt_sha256.encrypt(password)
+
+
+def verify_password(password, pw_hash):
+    return bcrypt_sha256.verify(password, pw_hash)
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from musicbot import async_handler
+from musicbot.database import ConnectionManager
+from musicbot.music_apis import Song
+
+_db_path = os.path.join("config", "play_history.db")
+
+EVENT_PLAY = 0
+EVENT_SKIP = 1
+
+
+def _get_filter(api_name=None, song_id=None, since=None):
+    conditions = []
+    parameters = []
+    if api_name:
+        conditions.append("apiName=?")
+        parameters.append(api_name)
+    if song_id:
+        conditions.append("songId=?")
+        parameters.append(song_id)
+    if since:
+        conditions.append("time>=?")
+        parameters.append(since)
+    if not conditions:
+        return "", parameters
+    return " AND " + " AND ".join(conditions), parameters
+
+
+def _create_db(db):
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS events(id INTEGER PRIMARY KEY, time REAL NOT NULL, apiName TEXT NOT NULL, songId TEXT NOT NULL, event INTEGER NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS eventsSong ON events(apiName, songId, event)")
+    db.execute("CREATE INDEX IF NOT EXISTS eventsTime ON events(time)")
+    # The latest info about every song in the log, so songs can be restored without asking their API
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS songs(apiName TEXT NOT NULL, songId TEXT NOT NULL, songJson TEXT NOT NULL, PRIMARY KEY(apiName, songId))")
+
+
+class PlayHistory(object):
+    """
+    An append-only log of play and skip events.
+
+    Events are buffered in memory and written to an SQLite database in batches, either when the buffer is full
+    or periodically by a background thread. The most recent events are also kept in memory,
+    so queries for recently played songs don't touch the database.
+    """
+
+    def __init__(self, apis, db_path=None, recent_size=200, batch_size=100, flush_interval=5.0):
+        """
+        Constructor
+
+        Keyword arguments:
+        apis -- a list of all APIs whose songs may appear in the log
+        db_path -- the path to the database file
+        recent_size -- the number of events kept in memory
+        batch_size -- the number of buffered events which triggers a write
+        flush_interval -- the maximum number of seconds an event stays buffered once start() has been called
+        """
+        self._apis = {api.get_name(): api for api in apis}
+        self._db = ConnectionManager(db_path or _db_path)
+        with self._db.transaction() as db:
+            _create_db(db)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # (time, api_name, song_id, event, song) tuples, the newest last
+        self._recent = deque(maxlen=recent_size)
+        self._load_recent()
+
+    def _load_recent(self):
+        rows = self._db.execute(
+            "SELECT time, events.apiName, events.songId, event, songJson FROM events LEFT JOIN songs ON songs.apiName=events.apiName AND songs.songId=events.songId ORDER BY id DESC LIMIT ?",
+            [self._recent.maxlen]).fetchall()
+        for event_time, api_name, song_id, event, song_json in reversed(rows):
+            song = None
+            if song_json:
+                try:
+                    song = Song.from_json(json.loads(song_json), self._apis)
+                except ValueError:
+                    pass
+            self._recent.append((event_time, api_name, song_id, event, song))
+
+    def start(self):
+        """
+        Start a background thread which writes buffered events periodically.
+        """
+        async_handler.execute(self._run, self.close, "Play history writer")
+
+    def _run(self):
+        while not self._stop_event.wait(self._flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Write all buffered events and stop the background thread.
+        """
+        self._stop_event.set()
+        self.flush()
+
+    def _add(self, song, event):
+        api_name = song.api.get_name()
+        event_tuple = (time.time(), api_name, song.song_id, event, song)
+        with self._pending_lock:
+            self._pending.append(event_tuple)
+            self._recent.append(event_tuple)
+            full = len(self._pending) >= self._batch_size
+        if full:
+            self.flush()
+
+    def add_played(self, song):
+        self._add(song, EVENT_PLAY)
+
+    def add_skipped(self, song):
+        self._add(song, EVENT_SKIP)
+
+    def flush(self):
+        """
+        Write all buffered events to the database.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = []
+            if not pending:
+                return
+            songs = {}
+            for _, api_name, song_id, _, song in pending:
+                songs[(api_name, song_id)] = song
+            try:
+                with self._db.transaction() as db:
+                    db.executemany("INSERT INTO events(time, apiName, songId, event) VALUES(?, ?, ?, ?)",
+                                   [event_tuple[:4] for event_tuple in pending])
+                    db.executemany("INSERT OR REPLACE INTO songs(apiName, songId, songJson) VALUES(?, ?, ?)",
+                                   [(api_name, song_id, json.dumps(song.to_json()))
+                                    for (api_name, song_id), song in songs.items()])
+            except sqlite3.Error as e:
+                logging.getLogger("musicbot").warning("Could not write %d play history events: %s", len(pending), e)
+                with self._pending_lock:
+                    self._pending = pending + self._pending
+
+    def get_recent_songs(self, max_len, api_name=None):
+        """
+        Get the most recently played songs, the oldest first.
+        :param max_len: the maximum number of songs
+        :param api_name: only return songs of this API
+        :return: a list of Song objects
+        """
+        result = []
+        with self._pending_lock:
+            recent = list(self._recent)
+        for _, event_api_name, _, event, song in reversed(recent):
+            if len(result) >= max_len:
+                break
+            if event != EVENT_PLAY or not song or (api_name and event_api_name != api_name):
+                continue
+            result.append(song)
+        result.reverse()
+        return result
+
+    def get_events(self, api_name, max_len):
+        """
+        Get the most recent events of an API, e.g. to restore the state of a song provider.
+        :param api_name: the API name
+        :param max_len: the maximum number of events
+        :return: a list of (song_id, skipped) tuples, the oldest first. skipped is False for play events.
+        """
+        self.flush()
+        rows = self._db.execute("SELECT songId, event FROM events WHERE apiName=? ORDER BY id DESC LIMIT ?",
+                                [api_name, max_len]).fetchall()
+        rows.reverse()
+        return [(song_id, event == EVENT_SKIP) for song_id, event in rows]
+
+    def get_play_counts(self, api_name=None, since=None, max_len=100):
+        """
+        Get the most played songs.
+        :param api_name: only count songs of this API
+        :param since: only count plays after this UNIX timestamp
+        :param max_len: the maximum number of songs
+        :return: a list of (api_name, song_id, plays) tuples, the most played first
+        """
+        self.flush()
+        condition, parameters = _get_filter(api_name, since=since)
+        return self._db.execute(
+            "SELECT apiName, songId, count(*) AS plays FROM events WHERE event=?" + condition + " GROUP BY apiName, songId ORDER BY plays DESC LIMIT ?",
+            [EVENT_PLAY] + parameters + [max_len]).fetchall()
+
+    def get_skip_rate(self, api_name=None, song_id=None, since=None):
+        """
+        Get the share of plays which have been skipped.
+        :param api_name: only consider songs of this API
+        :param song_id: only consider this song (requires api_name)
+        :param since: only consider events after this UNIX timestamp
+        :return: the skip rate between 0 and 1, or None if nothing has been played
+        """
+        if song_id and not api_name:
+            raise ValueError("song_id requires api_name")
+        self.flush()
+        condition, parameters = _get_filter(api_name, song_id, since)
+        plays, skips = self._db.execute(
+            "SELECT sum(event=?), sum(event=?) FROM events WHERE 1" + condition,
+            [EVENT_PLAY, EVENT_SKIP] + parameters).fetchone()
+        if not plays:
+            return None
+        return min(1.0, (skips or 0) / plays)
@@ -1,5 +1,6 @@
 import logging
 import threading
+from collections import deque
 
 import pyaudio
 import pydub
@@ -7,16 +8,21 @@ from pydub.utils import make_chunks
 
 from musicbot import async_handler
 from musicbot.music_apis import AbstractSongProvider
+from musicbot.state_log import StateLog
 from musicbot.telegram.notifier import Notifier, Cause
 
 
 class SongQueue(list):
-    def __init__(self, song_provider):
+    """
+    The queue of songs to play next. Every change is recorded as an event in a StateLog.
+    """
+
+    def __init__(self, song_provider, state_log=None):
         super().__init__()
         self._stop_preparing = False
         self._prepare_event = threading.Event()
         self._song_provider = song_provider
-        self._append_lock = threading.Lock()
+        self._state_log = state_log or StateLog()
 
         def close_prepare_thread():
             self._stop_preparing = True
@@ -34,13 +40,25 @@ class SongQueue(list):
             self._prepare_event.wait()
             self._prepare_event.clear()
 
+    def _normalize_index(self, index):
+        if index < 0:
+            index += len(self)
+        return min(max(index, 0), len(self))
+
     def insert(self, index, song):
-        list.insert(self, index, song)
+        with self._state_log.lock:
+            index = self._normalize_index(index)
+            list.insert(self, index, song)
+            self._state_log.append("queue_add", index=index, song=song.to_json())
         async_handler.submit(lambda: song.load())
 
-    def pop(self, *args, **kwargs):
+    def pop(self, index=-1):
         try:
-            result = list.pop(self, *args, **kwargs)
+            with self._state_log.lock:
+                if index < 0:
+                    index += len(self)
+                result = list.pop(self, index)
+                self._state_log.append("queue_remove", index=index)
             if isinstance(result.api, AbstractSongProvider):
                 result.api.add_played(result)
         except IndexError:
@@ -48,6 +66,39 @@ class SongQueue(list):
         self._prepare_event.set()
         return result
 
+    def remove(self, song):
+        with self._state_log.lock:
+            index = self.index(song)
+            list.pop(self, index)
+            self._state_log.append("queue_remove", index=index)
+
+    def clear(self):
+        with self._state_log.lock:
+            list.clear(self)
+            self._state_log.append("queue_clear")
+
+    def move(self, song, other_song, after_other=False):
+        """
+        Move a song in front of or behind another song.
+        :param song: the song to move
+        :param other_song: the song to move it next to
+        :param after_other: whether to move the song behind the other song
+        :raises ValueError: if one of the songs is not in the queue, the message names the missing song
+        """
+        with self._state_log.lock:
+            if song not in self:
+                raise ValueError("song {} is not in queue".format(song))
+            old_index = self.index(song)
+            list.pop(self, old_index)
+            if other_song not in self:
+                list.insert(self, old_index, song)
+                raise ValueError("song {} is not in queue".format(other_song))
+            index = self.index(other_song)
+            if after_other:
+                index += 1
+            list.insert(self, index, song)
+            self._state_log.append("queue_move", from_index=old_index, to_index=index)
+
     def append(self, song):
         def _load_appended():
             logger = logging.getLogger("musicbot")
@@ -57,22 +108,34 @@ class SongQueue(list):
             logger.debug("FINISHED LOADING APPENDED SONG: %s", str(song))
             Notifier.notify(Cause.queue_add(song))
 
-        self._append_lock.acquire()
-        if song not in self:
+        with self._state_log.lock:
+            if song in self:
+                return
             list.append(self, song)
-            async_handler.submit(_load_appended)
-        self._append_lock.release()
+            self._state_log.append("queue_add", index=len(self) - 1, song=song.to_json())
+        async_handler.submit(_load_appended)
 
 
 class Player(object):
-    def __init__(self, song_provider):
+    def __init__(self, song_provider, history=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        song_provider -- the AbstractSongProvider suggesting songs if the queue is empty
+        history -- an optional PlayHistory to record play and skip events in
+        """
         self._pa = pyaudio.PyAudio()
         self._stop = False
         self._resume_event = threading.Event()
         self._resume_event.set()
         self._skip = False
-        self._last_played = []
-        self._queue = SongQueue(song_provider)
+        self._history = history
+        self._last_played = deque(maxlen=20)
+        if history:
+            self._last_played.extend(history.get_recent_songs(20))
+        self._state_log = StateLog()
+        self._queue = SongQueue(song_provider, self._state_log)
         self._current_song = None
         self._current_segment = None
         self._lock = threading.Lock()
@@ -88,20 +151,38 @@ class Player(object):
         self._queue.remove(song)
         Notifier.notify(Cause.queue_remove(song))
 
+    def get_state_log(self):
+        """
+        Get the StateLog recording changes of the queue, the current song and the pause state.
+        """
+        return self._state_log
+
     def pause(self):
-        self._resume_event.clear()
+        with self._state_log.lock:
+            if self._resume_event.is_set():
+                self._resume_event.clear()
+                self._state_log.append("paused", paused=True)
 
     def resume(self):
-        self._resume_event.set()
+        with self._state_log.lock:
+            if not self._resume_event.is_set():
+                self._resume_event.set()
+                self._state_log.append("paused", paused=False)
 
     def next(self):
         '''
         Skip to the next song.
         Block until the next song is actually playing.
         '''
+        current_song = self._current_song
+        if current_song:
+            if self._history:
+                self._history.add_skipped(current_song)
+            if isinstance(current_song.api, AbstractSongProvider):
+                current_song.api.add_skipped(current_song)
         self._on_song_end()
         self._skip = True
-        self._resume_event.set()
+        self.resume()
 
     def get_current_song(self):
         return self._current_song
@@ -145,12 +226,10 @@ class Player(object):
 
             fname = song.load()
             seg = pydub.AudioSegment.from_mp3(fname)
-            self._current_song = song
-            self._current_segment = seg
+            self._set_current_song(song, seg)
             self._next_chosen_event.set()
 
             Notifier.notify(Cause.current_song(song))
-            self._add_played(song)
 
             logger.debug("LEAVING _on_song_end (%s)", thread_name)
 
@@ -189,12 +268,17 @@ class Player(object):
 
         async_handler.execute(_run, _stop, name="player_thread")
 
-    def _add_played(self, song):
-        self._last_played.append(song)
-        self._last_played = self._last_played[-20:]
+    def _set_current_song(self, song, segment):
+        with self._state_log.lock:
+            self._current_song = song
+            self._current_segment = segment
+            self._last_played.append(song)
+            self._state_log.append("current_song", song=song.to_json())
+        if self._history:
+            self._history.add_played(song)
 
     def get_last_played(self):
-        return self._last_played
+        return list(self._last_played)
 
     def is_paused(self):
         return not self._resume_event.is_set()
@@ -0,0 +1,254 @@
+import random
+import re
+import threading
+
+from musicbot.suggestions import ShuffleBag
+
+_artist_separator = re.compile(r"\s*(?:,|&|;|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b|\bvs\b\.?)\s*", re.IGNORECASE)
+
+
+def split_artists(description):
+    """
+    Split a song description into normalized artist names, e.g. "A feat. B & C" into ["a", "b", "c"].
+    """
+    if not description:
+        return []
+    names = []
+    for name in _artist_separator.split(description):
+        name = name.strip().lower()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class Recommender(object):
+    """
+    Recommends songs of a playlist based on the song played before.
+
+    Every artist has two sparse similarity vectors:
+    - collaborations, precomputed from songs with multiple artists in their description
+    - transitions, counting how often a song by one artist was played after a song by another one without being skipped
+
+    A recommendation picks one of the artists of the seed song, follows one of its vectors to a similar artist
+    and draws one of that artist's songs from a shuffle bag. Artists whose songs are often skipped are picked less.
+    Some recommendations are deliberately left to the caller (by returning None) to explore the whole playlist.
+    Every update and recommendation runs in time proportional to the size of one vector, not of the playlist.
+    """
+    # The probabilities of following the transition vector, the collaboration vector or staying with the seed artist.
+    # The remaining probability is left for exploration.
+    transition_weight = 0.45
+    collaboration_weight = 0.1
+    same_artist_weight = 0.15
+
+    def __init__(self, no_repeat=0, rng=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        no_repeat -- the minimum number of songs drawn from an artist before one of them is drawn again
+        rng -- a random.Random instance
+        """
+        self._rng = rng or random.Random()
+        self._no_repeat = no_repeat
+        self._lock = threading.RLock()
+        self._artist_ids = {}
+        # Artist ID -> ShuffleBag of the artist's song IDs in the playlist
+        self._artist_songs = {}
+        # Song ID -> tuple of artist IDs
+        self._song_artists = {}
+        # Artist ID -> {artist ID: weight}
+        self._collaborations = {}
+        self._transitions = {}
+        self._plays = {}
+        self._skips = {}
+        self._last_played = None
+        self._last_transition = None
+
+    def __len__(self):
+        return len(self._song_artists)
+
+    def __contains__(self, song_id):
+        return song_id in self._song_artists
+
+    def _get_artist_id(self, name):
+        artist_id = self._artist_ids.get(name)
+        if artist_id is None:
+            artist_id = len(self._artist_ids)
+            self._artist_ids[name] = artist_id
+        return artist_id
+
+    @staticmethod
+    def _increment(vectors, a, b, amount=1.0):
+        vector = vectors.get(a)
+        if vector is None:
+            vector = {}
+            vectors[a] = vector
+        value = vector.get(b, 0.0) + amount
+        if value > 0:
+            vector[b] = value
+        else:
+            vector.pop(b, None)
+
+    def set_songs(self, songs):
+        """
+        Replace the recommendable songs. Play and skip statistics are kept.
+        :param songs: an iterable of (song_id, description) tuples
+        """
+        with self._lock:
+            self._artist_songs = {}
+            self._song_artists = {}
+            self._collaborations = {}
+            for song_id, description in songs:
+                self._add_song(song_id, description)
+
+    def _add_song(self, song_id, description):
+        if song_id in self._song_artists:
+            return
+        artist_ids = tuple(map(self._get_artist_id, split_artists(description)))
+        self._song_artists[song_id] = artist_ids
+        for artist_id in artist_ids:
+            bag = self._artist_songs.get(artist_id)
+            if bag is None:
+                bag = ShuffleBag(no_repeat=self._no_repeat, rng=self._rng)
+                self._artist_songs[artist_id] = bag
+            bag.add(song_id)
+            for other_id in artist_ids:
+                if other_id != artist_id:
+                    self._increment(self._collaborations, artist_id, other_id)
+
+    def add_song(self, song_id, description):
+        with self._lock:
+            self._add_song(song_id, description)
+
+    def remove_song(self, song_id):
+        with self._lock:
+            artist_ids = self._song_artists.pop(song_id, None)
+            if artist_ids is None:
+                return
+            for artist_id in artist_ids:
+                bag = self._artist_songs[artist_id]
+                bag.remove(song_id)
+                if not bag:
+                    del self._artist_songs[artist_id]
+                for other_id in artist_ids:
+                    if other_id != artist_id:
+                        self._increment(self._collaborations, artist_id, other_id, -1.0)
+
+    def add_played(self, song_id):
+        """
+        Record that a song started playing after the previous one.
+        """
+        with self._lock:
+            artist_ids = self._song_artists.get(song_id, ())
+            for artist_id in artist_ids:
+                self._plays[artist_id] = self._plays.get(artist_id, 0) + 1
+                bag = self._artist_songs.get(artist_id)
+                if bag:
+                    bag.add_played(song_id)
+
+            self._last_transition = None
+            previous = self._last_played
+            if previous and previous[1] and artist_ids:
+                previous_artist_ids = self._song_artists.get(previous[0], ())
+                if previous_artist_ids:
+                    transition = (previous_artist_ids, artist_ids)
+                    self._update_transition(transition, 1.0)
+                    self._last_transition = transition
+            # The song counts as a positive example until it is skipped
+            self._last_played = (song_id, True)
+
+    def add_skipped(self, song_id):
+        """
+        Record that a song has been skipped while playing.
+        """
+        with self._lock:
+            for artist_id in self._song_artists.get(song_id, ()):
+                self._skips[artist_id] = self._skips.get(artist_id, 0) + 1
+            last_played = self._last_played
+            if last_played and last_played[0] == song_id:
+                self._last_played = (song_id, False)
+                if self._last_transition:
+                    # The transition to this song wasn't a good one after all
+                    self._update_transition(self._last_transition, -1.0)
+                    self._last_transition = None
+
+    def _update_transition(self, transition, amount):
+        from_ids, to_ids = transition
+        amount /= len(from_ids) * len(to_ids)
+        for from_id in from_ids:
+            for to_id in to_ids:
+                self._increment(self._transitions, from_id, to_id, amount)
+
+    def _acceptance(self, artist_id):
+        # Laplace smoothed share of plays which weren't skipped
+        plays = self._plays.get(artist_id, 0)
+        skips = min(self._skips.get(artist_id, 0), plays)
+        return (plays - skips + 1) / (plays + 1)
+
+    def _pick_weighted(self, vector):
+        total = 0.0
+        choices = []
+        for artist_id, weight in vector.items():
+            if artist_id in self._artist_songs:
+                total += weight
+                choices.append((artist_id, weight))
+        if not choices:
+            return None
+        target = self._rng.random() * total
+        for artist_id, weight in choices:
+            target -= weight
+            if target < 0:
+                return artist_id
+        return choices[-1][0]
+
+    def recommend(self, seed_id=None, attempts=3):
+        """
+        Recommend a song to play after the seed song.
+        :param seed_id: the song ID of the seed, defaults to the last played song which hasn't been skipped
+        :param attempts: how often to retry if the picked artist is rejected because of skips
+        :return: a song ID, or None if the caller should pick a song at random
+        """
+        with self._lock:
+            if seed_id is None:
+                last_played = self._last_played
+                if not last_played or not last_played[1]:
+                    return None
+                seed_id = last_played[0]
+            seed_artist_ids = self._song_artists.get(seed_id)
+            if not seed_artist_ids:
+                return None
+
+            rng = self._rng
+            for _ in range(attempts):
+                seed_artist_id = rng.choice(seed_artist_ids)
+                choice = rng.random()
+                if choice < self.transition_weight:
+                    artist_id = self._pick_weighted(self._transitions.get(seed_artist_id, {}))
+                elif choice < self.transition_weight + self.collaboration_weight:
+                    artist_id = self._pick_weighted(self._collaborations.get(seed_artist_id, {}))
+                elif choice < self.transition_weight + self.collaboration_weight + self.same_artist_weight:
+                    artist_id = seed_artist_id
+                else:
+                    return None
+                bag = self._artist_songs.get(artist_id)
+                if not bag or (len(bag) == 1 and seed_id in bag):
+                    continue
+                if rng.random() >= self._acceptance(artist_id):
+                    continue
+                song_id = bag.draw()
+                if song_id == seed_id:
+                    song_id = bag.draw()
+                return song_id
+            return None
+
+    def get_stats(self):
+        """
+        Return a dict containing the number of songs, artists and similarity vector entries.
+        """
+        with self._lock:
+            return {
+                "songs": len(self._song_artists),
+                "artists": len(self._artist_songs),
+                "transitions": sum(map(len, self._transitions.values())),
+                "collaborations": sum(map(len, self._collaborations.values()))
+            }
@@ -1,20 +1,25 @@
 import asyncio
+import hashlib
+import inspect
+import json
 import logging
-import os
-import sqlite3
-import threading
+import multiprocessing
 import time
 import uuid
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-import falcon
-import hug
 import jwt
-from passlib.hash import bcrypt_sha256
+import pylru
+from aiohttp import web
 
 from musicbot import async_handler
 from musicbot import config
-from musicbot.music_apis import Song, AbstractSongProvider, AbstractAPI
+from musicbot.federated_search import FederatedSearch, ResultMerger
+from musicbot.music_apis import Song, AbstractSongProvider, AbstractAPI, songs_to_json
+from musicbot.password_hashing import hash_password, verify_password
+from musicbot.search_cache import SearchCache, normalize_query
+from musicbot.user_store import UserStore, SecretClient
 
 
 class _API(object):
@@ -76,46 +81,13 @@ class _Permission(object):
             name = perm_json['name']
             description = perm_json['description']
         except KeyError:
-            return ValueError("Missing key in json")
+            raise ValueError("Missing key in json")
         return _Permission(name, description)
 
     def __str__(self):
         return self.name
 
 
-class _SecretClient(object):
-    def __init__(self, name, pw_hash, permissions):
-        self.name = name
-        self.pw_hash = pw_hash
-        self.permissions = permissions
-
-    def __eq__(self, other):
-        if not isinstance(other, _SecretClient):
-            return False
-        return str(self) == str(other)
-
-    def __hash__(self):
-        return hash(self.name)
-
-    def __str__(self):
-        return "User {}: [permissions={}] [pw_hash={}]".format(self.name, self.permissions, self.pw_hash)
-
-    def to_json(self):
-        return {"name": self.name,
-                "permissions": self.permissions,
-                "pw_hash": self.pw_hash}
-
-    @staticmethod
-    def from_json(client_json):
-        try:
-            name = client_json['name']
-            pw_hash = client_json['pw_hash']
-            permissions = client_json['permissions']
-            return _SecretClient(name, pw_hash, permissions)
-        except KeyError as e:
-            raise ValueError("Missing key: " + str(e))
-
-
 def _create_token(secrets):
     '''
     Create a string token, write it to secrets['rest_token'] and return it.
@@ -128,15 +100,25 @@ def _create_token(secrets):
 def _create_user_token(username, permissions):
     """
     Creates an encoded user token.
+    It expires after the configured token lifetime, unless it is refreshed.
     :param username: the username
     :param permissions: a list of permissions (strings)
     :return: the encoded token
     """
+    issued_at = int(time.time())
     user_token = {
         "name": username,
-        "permissions": permissions
+        "permissions": permissions,
+        "iat": issued_at
     }
-    return jwt.encode(user_token, token, algorithm="HS256")
+    lifetime = config.get_rest_token_lifetime()
+    if lifetime:
+        user_token['exp'] = issued_at + lifetime
+    encoded = jwt.encode(user_token, token, algorithm="HS256")
+    # Older PyJWT versions return bytes
+    if isinstance(encoded, bytes):
+        encoded = encoded.decode("utf-8")
+    return encoded
 
 
 def _read_secrets():
@@ -149,40 +131,6 @@ def _read_secrets():
         return result
 
 
-def _get_db_conn():
-    return sqlite3.connect("config/clients.db")
-
-
-def _get_client(username):
-    db = _get_db_conn()
-    try:
-        cursor = db.cursor()
-        cursor.execute("SELECT pw_hash, permissions FROM clients WHERE username=?", [username])
-        client_row = cursor.fetchone()
-        if not client_row:
-            return None
-        pw_hash = client_row[0]
-        permissions = client_row[1].split(",")
-        return _SecretClient(username, pw_hash, permissions)
-    finally:
-        db.close()
-
-
-def _add_client(client):
-    with _add_client_lock:
-        if _get_client(client.name):
-            raise ValueError("client already in clients")
-        db = _get_db_conn()
-        try:
-            with db:
-                db.execute("INSERT INTO clients(username, pw_hash, permissions) VALUES(?, ?, ?)",
-                           (client.name,
-                            client.pw_hash,
-                            ",".join(client.permissions)))
-        finally:
-            db.close()
-
-
 available_permissions = [
     _Permission("mod", "all admin permissions, except exit, reset and granting permissions"),
     _Permission("queue_remove", "remove a song from the queue"),
@@ -191,7 +139,20 @@ available_permissions = [
     _Permission("reset", "reset all bot settings, delete the remote playlist and shut the program down")
 ]
 
-_add_client_lock = threading.Lock()
+# Blocking work is kept off the event loop. Each kind of work gets its own executor, so slow remote searches can't
+# delay logins and a burst of bcrypt hashing can't starve everything else.
+# Password hashing holds the GIL, so it runs in other processes. The pool is created by init().
+_hash_executor = None
+_hash_jobs = 0
+# Writes to the user store
+_db_executor = ThreadPoolExecutor(max_workers=1)
+_api_executor = ThreadPoolExecutor(max_workers=8)
+_routes = []
+_event_hub = None
+_users = None
+_token_cache = None
+_federated_search = None
+_search_cache = None
 player = None
 queue = []
 music_api_names = {}
@@ -200,75 +161,392 @@ token = None
 
 logger = logging.getLogger("musicbot")
 
-db = _get_db_conn()
-db.execute(
-    "CREATE TABLE IF NOT EXISTS clients (userid INTEGER PRIMARY KEY ASC AUTOINCREMENT, username TEXT UNIQUE NOT NULL, pw_hash CHAR(75) NOT NULL, permissions TEXT)")
-db.commit()
-db.close()
-
 
-def init(music_apis, queued_player):
+def init(music_apis, queued_player, search_cache=None):
     """
     Keyword arguments:
     music_apis -- a list of AbstractAPIs
     queued_player -- a Player instance
+    search_cache -- the SearchCache shared with the Telegram bots, a new one is created if None
     """
     global music_api_names
     global apis_json
     global player
     global queue
     global token
+    global _event_hub
+    global _hash_executor
+    global _users
+    global _token_cache
+    global _federated_search
+    global _search_cache
     music_api_names = {api.get_name(): api for api in music_apis}
     apis_json = list(map(lambda music_api: _API(music_api).to_json(), music_apis))
     player = queued_player
     queue = player.get_queue()
     token = _read_secrets()
+    _users = UserStore()
+    _token_cache = _TokenCache(config.get_rest_token_cache_size(), config.get_rest_token_cache_ttl())
+    _federated_search = FederatedSearch(music_apis)
+    _search_cache = search_cache or SearchCache(config.get_search_cache_size(), config.get_search_cache_ttl())
+    _event_hub = _PlayerEventHub(player.get_state_log())
+    _hash_executor = _create_hash_executor()
+    async_handler.execute(None, _shutdown_executors)
+
+
+def _shutdown_executors():
+    for executor in [_hash_executor, _db_executor, _api_executor]:
+        if executor:
+            executor.shutdown(wait=False)
+    if _federated_search:
+        _federated_search.close()
+
+
+def create_app():
+    """
+    Create an aiohttp application serving all REST endpoints. init() has to be called first.
+    :return: a web.Application
+    """
+    app = web.Application()
+    for method, path, handler in _routes:
+        app.router.add_route(method, path, handler)
+    return app
+
+
+class _TokenCache(object):
+    """
+    A bounded LRU cache of verified user tokens, so the signature of a token is only checked once in a while.
+
+    Entries are keyed with a hash of the server secret and the token, so they are useless after the secret has
+    been rotated. They expire after a TTL or when the token expires, whatever comes first.
+    Only used on the event loop thread.
+    """
+    # Longer tokens aren't cached, which bounds the memory of the cache
+    max_token_length = 4096
+
+    def __init__(self, size, ttl):
+        self._ttl = ttl
+        self._cache = pylru.lrucache(max(1, size), self._on_evict)
+        # Username -> set of cache keys, to invalidate all tokens of a user
+        self._user_keys = {}
+
+    @staticmethod
+    def _get_key(user_token):
+        return hashlib.sha256("{}:{}".format(token, user_token).encode("utf-8")).digest()
+
+    def _on_evict(self, key, entry):
+        keys = self._user_keys.get(entry[1]['name'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[entry[1]['name']]
+
+    def get(self, user_token):
+        """
+        :return: the cached claims or None
+        """
+        if len(user_token) > self.max_token_length:
+            return None
+        key = self._get_key(user_token)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            # Deleting doesn't call the eviction callback of the lrucache
+            del self._cache[key]
+            self._on_evict(key, entry)
+            return None
+        return entry[1]
+
+    def put(self, user_token, claims):
+        if len(user_token) > self.max_token_length or not self._ttl:
+            return
+        expires = time.time() + self._ttl
+        if "exp" in claims:
+            expires = min(expires, claims['exp'])
+        key = self._get_key(user_token)
+        self._cache[key] = (expires, claims)
+        self._user_keys.setdefault(claims['name'], set()).add(key)
+
+    def invalidate_user(self, username):
+        """
+        Drop all cached tokens of a user, e.g. after a permission change.
+        """
+        for key in list(self._user_keys.get(username, ())):
+            if key in self._cache:
+                del self._cache[key]
+        self._user_keys.pop(username, None)
+
+    def clear(self):
+        self._cache.clear()
+        self._user_keys.clear()
 
 
 def verify(user_token):
+    """
+    Verify a user token.
+    The permissions in the returned claims are the current ones of the user, not the ones the token was issued with.
+    :param user_token: the encoded token
+    :return: the claims, which must not be modified, or False if the token is invalid or the user has been deleted
+    """
+    if not user_token:
+        return False
+    claims = _token_cache.get(user_token)
+    if claims:
+        return claims
     try:
-        return jwt.decode(user_token, token, algorithm="HS256")
-    except (KeyError, jwt.InvalidTokenError):
+        claims = jwt.decode(user_token, token, algorithms=["HS256"])
+        permissions = _users.get_permissions(claims['name'])
+    except (KeyError, TypeError, jwt.InvalidTokenError):
         return False
+    if permissions is None:
+        return False
+    claims['permissions'] = sorted(permissions)
+    _token_cache.put(user_token, claims)
+    return claims
+
+
+def _run(executor, fn, *args):
+    """
+    Run a blocking function in an executor.
+    :return: an awaitable for the result
+    """
+    return asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+
+
+class _HTTPError(Exception):
+    """
+    Raised by endpoints to send an error response with a JSON encoded message.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _create_hash_executor():
+    """
+    Create the process pool hashing passwords and start its workers.
+    The workers are started by a fork server (or spawned), since forking the bot with all its threads is unsafe.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=max(1, config.get_password_hash_workers()), mp_context=context)
+    # Start the workers now instead of on the first request
+    executor.submit(int)
+    return executor
+
+
+async def _run_password_job(fn, *args):
+    """
+    Run a password hashing function in the process pool.
+    If a worker died, the pool is replaced and the request is rejected.
+    :raises _HTTPError: with status 503 if too many jobs are waiting already or the pool is broken
+    """
+    global _hash_jobs
+    global _hash_executor
+    # Only called on the event loop thread, so the counter needs no lock
+    if _hash_jobs >= config.get_password_hash_workers() + config.get_password_hash_queue():
+        logger.warning("Rejected request, too many password hashing jobs")
+        raise _HTTPError(503, "Server busy, try again later")
+    _hash_jobs += 1
+    executor = _hash_executor
+    try:
+        return await asyncio.wrap_future(executor.submit(fn, *args))
+    except BrokenProcessPool:
+        # All jobs of the broken pool fail, only the first one replaces it
+        if _hash_executor is executor:
+            logger.error("A password hashing process died, restarting the pool")
+            executor.shutdown(wait=False)
+            _hash_executor = _create_hash_executor()
+        raise _HTTPError(503, "Server busy, try again later")
+    finally:
+        _hash_jobs -= 1
 
 
-authentication = hug.authentication.token(verify)
+def _response(result, status=200):
+    """
+    Create a JSON response. Strings are JSON encoded as well, which is what clients expect.
+    """
+    return web.json_response(result, status=status)
+
+
+def _json_text_response(text, headers=None):
+    """
+    Create a response from an already encoded JSON string.
+    """
+    return web.Response(text=text, content_type="application/json", headers=headers)
 
 
-@hug.post()
-def register(username, password, response=None):
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    try:
+        return bool(int(value))
+    except ValueError:
+        value = value.strip().lower()
+        if value in ("true", "t"):
+            return True
+        if value in ("false", "f", ""):
+            return False
+        raise
+
+
+_converters = {
+    bool: _to_bool,
+    int: int,
+    str: str
+}
+
+
+async def _read_params(request):
+    """
+    Read the parameters of a request. Query parameters are merged with the fields of a JSON or form body.
+    The whole body is available as the 'body' parameter.
+    :return: a dict of parameters
+    :raises ValueError: if the body is invalid
+    """
+    params = dict(request.query)
+    if request.body_exists:
+        if request.content_type == "application/json":
+            body = await request.json()
+        elif request.content_type in ("application/x-www-form-urlencoded", "multipart/form-data"):
+            body = dict(await request.post())
+        else:
+            body = await request.text()
+        if isinstance(body, dict):
+            params.update(body)
+        params['body'] = body
+    return params
+
+
+def _endpoint(method, authenticated=False, name=None):
+    """
+    Register a coroutine function as the REST endpoint /<name>.
+
+    The function's arguments are taken from the request parameters by name and converted according to their
+    annotation (bool, int or str). Arguments without a default value are required. The 'user' argument
+    receives the verified claims of the authenticated user, which are also stored as request['user'].
+    The 'request' argument receives the request itself. If the function returns a web.StreamResponse,
+    it is sent as is, any other result is sent as JSON.
+
+    Keyword arguments:
+    method -- the HTTP method
+    authenticated -- whether a valid user token is required in the Authorization header
+    name -- the endpoint name, defaults to the function name
+    """
+
+    def _decorator(fn):
+        signature = inspect.signature(fn)
+
+        async def _handle(request):
+            user = None
+            if authenticated:
+                user = verify(request.headers.get("Authorization"))
+                if not user:
+                    return _response({"title": "Authentication Required",
+                                      "description": "Please provide valid Token credentials"}, 401)
+                request['user'] = user
+            try:
+                params = await _read_params(request)
+            except ValueError:
+                return _response({"errors": {"body": "Invalid request body"}}, 400)
+
+            kwargs = {}
+            errors = {}
+            for param_name, parameter in signature.parameters.items():
+                if param_name == "user":
+                    kwargs[param_name] = user
+                elif param_name == "request":
+                    kwargs[param_name] = request
+                elif param_name in params:
+                    value = params[param_name]
+                    converter = _converters.get(parameter.annotation)
+                    if converter and value is not None:
+                        try:
+                            value = converter(value)
+                        except (TypeError, ValueError):
+                            errors[param_name] = "Invalid {} provided".format(parameter.annotation.__name__)
+                            continue
+                    kwargs[param_name] = value
+                elif parameter.default is inspect.Parameter.empty:
+                    errors[param_name] = "Required parameter '{}' not supplied".format(param_name)
+            if errors:
+                return _response({"errors": errors}, 400)
+
+            try:
+                result = await fn(**kwargs)
+            except _HTTPError as e:
+                return _response(e.message, e.status)
+            if isinstance(result, web.StreamResponse):
+                return result
+            return _response(result)
+
+        _routes.append((method, "/" + (name or fn.__name__), _handle))
+        return fn
+
+    return _decorator
+
+
+def _has_permission(user, needed_permissions):
+    """
+    Ensure that a user has at least one of the needed permissions.
+    :param user: the decoded user token
+    :param needed_permissions: an iterable of permission strings
+    :return: True or False
+    """
+    return not set(user['permissions']).isdisjoint(set(needed_permissions))
+
+
+def _is_admin(user):
+    return "admin" in user['permissions']
+
+
+def _has_admin(user=None):
+    """
+    Check whether the server has an admin.
+    If there is none and none is allowed, also returns True.
+    :return: True or False
+    """
+    if not config.get_allow_rest_admin():
+        return True
+    if user and _is_admin(user):
+        return True
+    return _users.has_admin()
+
+
+@_endpoint("POST")
+async def register(username, password):
     if not username or not username.strip():
         logger.debug("Empty username")
-        response.status = falcon.HTTP_BAD_REQUEST
-        return "Empty username"
+        return _response("Empty username", 400)
     username = username.strip().lower()
     if len(username) > 64:
         logger.debug("Username too long")
-        response.status = falcon.HTTP_UNPROCESSABLE_ENTITY
-        return "Username too long"
-    if _get_client(username):
+        return _response("Username too long", 422)
+    if _users.get(username):
         logger.debug("Username %s already in use", username)
-        response.status = falcon.HTTP_CONFLICT
-        return "Name already in use"
+        return _response("Name already in use", 409)
 
     if len(password.strip()) < 6:
         logger.debug("Password too short")
-        response.status = falcon.HTTP_BAD_REQUEST
-        return "Invalid password. Must be of length >= 6"
-    pw_hash = bcrypt_sha256.encrypt(password)
-    client = _SecretClient(username, pw_hash, ["user"])
+        return _response("Invalid password. Must be of length >= 6", 400)
+    pw_hash = await _run_password_job(hash_password, password)
+    client = SecretClient(username, pw_hash, ["user"])
     try:
-        _add_client(client)
+        await _run(_db_executor, _users.add, client)
     except ValueError:
         logger.debug("Username %s already in database", username)
-        response.status = falcon.HTTP_CONFLICT
-        return "Name already in use"
+        return _response("Name already in use", 409)
     logger.debug("Registered new user: %s", username)
     return _create_user_token(username, client.permissions)
 
 
-@hug.put()
-def login(username, password, response=None):
+@_endpoint("PUT")
+async def login(username, password):
     """
     Logs user in. Returns status 400 response if user doesn't exist or password is wrong.
     :param username: a username
@@ -277,266 +555,537 @@ def login(username, password, response=None):
     """
     if not username or not username.strip():
         logger.debug("Tried to log in with empty username")
-        response.status = falcon.HTTP_400
-        return "empty username"
+        return _response("empty username", 400)
     username = username.strip().lower()
-    client = _get_client(username)
+    client = _users.get(username)
     if not client:
         logger.debug("Tried to log in with unknown username: %s", username)
-        response.status = falcon.HTTP_400
-        return "unknown"
-    success = bcrypt_sha256.verify(password, client.pw_hash)
+        return _response("unknown", 400)
+    success = await _run_password_job(verify_password, password, client.pw_hash)
     if not success:
         logger.debug("Tried to log in with wrong password as user %s", username)
-        response.status = falcon.HTTP_400
-        return "wrong password"
+        return _response("wrong password", 400)
     logger.debug("New user login: %s", username)
     return _create_user_token(username, client.permissions)
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def change_password(old_password, new_password, user: hug.directives.user, response=None):
+@_endpoint("PUT", authenticated=True)
+async def refresh_token(user):
+    """
+    Get a new token with a new expiration time and the current permissions of the user, without sending the password.
+    :return: a token to authenticate with
+    """
+    client = _users.get(user['name'])
+    if not client:
+        logger.debug("Tried to refresh the token of unknown user %s", user['name'])
+        return _response("unknown", 400)
+    return _create_user_token(client.name, client.permissions)
+
+
+@_endpoint("PUT", authenticated=True)
+async def change_password(old_password, new_password, user):
     """
     Change the password of the user if the old password is correct and the new one satisfies the password requirements.
     :param old_password: the old password
     :param new_password: the new password
     """
-    client = _get_client(user['name'])
-    success = bcrypt_sha256.verify(old_password, client.pw_hash)
+    client = _users.get(user['name'])
+    if not client:
+        return _response("unknown", 400)
+    success = await _run_password_job(verify_password, old_password, client.pw_hash)
     if not success:
         logger.debug("%s tried to change his password with a wrong old password", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return "Wrong password"
+        return _response("Wrong password", 403)
 
     new_password = new_password.strip()
     if len(new_password) < 6:
         logger.debug("Password too short")
-        response.status = falcon.HTTP_BAD_REQUEST
-        return "Invalid password. Must be of length >= 6"
-
-    pw_hash = bcrypt_sha256.encrypt(new_password)
+        return _response("Invalid password. Must be of length >= 6", 400)
 
-    db = _get_db_conn()
-    try:
-        with db:
-            db.execute("UPDATE clients SET pw_hash=? WHERE username=?", pw_hash, user['name'])
-        return "OK"
-    finally:
-        db.close()
+    pw_hash = await _run_password_job(hash_password, new_password)
+    await _run(_db_executor, _users.set_password, user['name'], pw_hash)
+    return "OK"
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def delete_user(password, user: hug.directives.user, response=None):
+@_endpoint("PUT", authenticated=True)
+async def delete_user(password, user):
     """
     Delete the users account.
     :param password: the user's password
     """
-    client = _get_client(user['name'])
-    success = bcrypt_sha256.verify(password, client.pw_hash)
+    client = _users.get(user['name'])
+    if not client:
+        return _response("unknown", 400)
+    success = await _run_password_job(verify_password, password, client.pw_hash)
     if not success:
         logger.debug("%s tried to delete his account with a wrong password", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return "Wrong password"
+        return _response("Wrong password", 403)
 
-    db = _get_db_conn()
-    try:
-        db.execute("DELETE FROM clients WHERE username=?", user['name'])
-        db.commit()
-        return "OK"
-    finally:
-        db.close()
+    await _run(_db_executor, _users.delete, user['name'])
+    _token_cache.invalidate_user(user['name'])
+    return "OK"
 
 
-@hug.get()
-def music_apis():
+@_endpoint("GET")
+async def music_apis():
     return apis_json
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def queue(body, remove: hug.types.boolean = False, user: hug.directives.user = None, response=None):
+@_endpoint("PUT", authenticated=True, name="queue")
+async def queue_song(body, remove: bool = False, user=None):
     try:
         song = Song.from_json(body, music_api_names)
         song.user = user['name']
     except ValueError as e:
         logger.debug("Received bad json %s", e)
-        response.status = falcon.HTTP_400
-        return str(e)
+        return _response(str(e), 400)
 
     if remove:
-        if not has_permission(user, ["admin", "mod", "queue_remove"]):
+        if not _has_permission(user, ["admin", "mod", "queue_remove"]):
             logger.debug("Unauthorized attempt to remove song from queue by %s", user['name'])
-            response.status = falcon.HTTP_FORBIDDEN
-            return "Not permitted"
+            return _response("Not permitted", 403)
         try:
             logger.debug("Song %s removed by %s", song, user['name'])
             queue.remove(song)
         except ValueError:
             logger.debug("%s tried to remove Song not in queue: %s", user['name'], song)
-            response.status = falcon.HTTP_400
-            return "song {} is not in queue".format(song)
+            return _response("song {} is not in queue".format(song), 400)
     else:
         logger.debug("Song %s added by %s", song, user['name'])
         queue.append(song)
     return "OK"
 
 
-@asyncio.coroutine
-@hug.get()
-def suggestions(api_name, max_fetch: hug.types.number = 10, response=None):
+@_endpoint("GET")
+async def suggestions(api_name, max_fetch: int = 10):
     max_fetch = min(10, max(1, max_fetch))
 
     try:
         api = music_api_names[api_name]
     except KeyError:
         logger.debug("Requested suggestions for unknown API %s", api_name)
-        response.status = falcon.HTTP_400
-        return "Unknown API"
+        return _response("Unknown API", 400)
 
     if isinstance(api, AbstractSongProvider):
-        return list(map(Song.to_json, api.get_suggestions(max_fetch)))
+        songs = await _run(_api_executor, api.get_suggestions, max_fetch)
+        return _json_text_response(songs_to_json(songs))
     else:
         logger.debug("Tried to get suggestions for API %s which isn't a SongProvider", api_name)
-        response.status = falcon.HTTP_400
-        return []
+        return _response([], 400)
 
 
-@asyncio.coroutine
-@hug.get()
-def search(api_name, query, max_fetch: hug.types.number = 50, response=None):
+@_endpoint("GET")
+async def search(api_name, query, max_fetch: int = 50, offset: int = 0):
+    """
+    Search songs, a page at a time. The following page is fetched in the background.
+    If there are more results, the X-Next-Offset header contains the offset of the next page.
+    :param query: the search query
+    :param max_fetch: the maximum number of songs on the page (at most 50)
+    :param offset: the number of results to skip
+    """
     max_fetch = min(50, max(1, max_fetch))
+    offset = max(0, offset)
     try:
         api = music_api_names[api_name]
     except KeyError:
         logger.debug("Tried to search on unknown API %s", api_name)
-        response.status = falcon.HTTP_400
-        return "Unknown API"
+        return _response("Unknown API", 400)
 
-    if not query:
-        response.status = falcon.HTTP_400
-        return "Invalid query"
+    if not normalize_query(query):
+        return _response("Invalid query", 400)
 
-    return list(map(Song.to_json, api.search_song(query, max_fetch=max_fetch)))
+    songs, next_offset = await _run(_api_executor, _search_cache.get_page, api, query, offset, max_fetch)
+    headers = None
+    if next_offset is not None:
+        headers = {"X-Next-Offset": str(next_offset)}
+    return _json_text_response(songs_to_json(songs), headers)
 
 
-@hug.local()
-@hug.get()
-def player_state():
+def _backend_result_to_json(result, songs):
+    return '{{"api_name": {}, "status": {}, "latency": {:.3f}, "songs": {}}}'.format(
+        json.dumps(result.api_name), json.dumps(result.status), result.latency, songs_to_json(songs))
+
+
+@_endpoint("GET")
+async def federated_search(request, query, max_fetch: int = 20, stream: bool = True):
+    """
+    Search all APIs concurrently. Every API has its own deadline, APIs missing it are reported as timed out.
+    Duplicates (the same title and description from different APIs) are removed.
+
+    If stream is true, the response is newline delimited JSON. There is one line per API as soon as it answers:
+    {'api_name': ..., 'status': 'ok'|'error'|'timeout', 'latency': <seconds>, 'songs': [...]},
+    containing only songs which haven't been sent before. The last line is {'done': true, 'duration': <seconds>}.
+
+    Otherwise the response is {'songs': [...], 'backends': [...]} with the merged songs, interleaved by rank,
+    and the backend lines with empty song lists.
+    :param query: the search query
+    :param max_fetch: the maximum number of songs per API (at most 50)
+    :param stream: whether to stream the results
+    """
+    if not query:
+        return _response("Invalid query", 400)
+    max_fetch = min(50, max(1, max_fetch))
+    start = time.perf_counter()
+    results = _federated_search.search_async_iter(query, max_fetch)
+    merger = ResultMerger(_federated_search.get_api_names())
+
+    if not stream:
+        backends = []
+        async for result in results:
+            merger.add(result.api_name, result.songs)
+            backends.append(_backend_result_to_json(result, []))
+        return _json_text_response('{{"songs": {}, "backends": [{}]}}'.format(
+            songs_to_json(merger.get_merged()), ", ".join(backends)))
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    try:
+        async for result in results:
+            line = _backend_result_to_json(result, merger.add(result.api_name, result.songs))
+            await response.write((line + "\n").encode("utf-8"))
+    except ConnectionResetError:
+        # The client has gone away, don't wait for the remaining APIs
+        return response
+    finally:
+        await results.aclose()
+    await response.write('{{"done": true, "duration": {:.3f}}}\n'.format(time.perf_counter() - start).encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+def _get_player_state():
+    """
+    Encode the player state as JSON, joining the cached JSON fragments of the songs.
+    """
     current_song = player.get_current_song()
     if current_song:
-        song_json = current_song.to_json()
+        song_json = current_song.to_json_fragment()
     else:
-        song_json = None
+        song_json = "null"
+
+    return '{{"current_song": {}, "last_played": {}, "queue": {}, "paused": {}}}'.format(
+        song_json, songs_to_json(player.get_last_played()), songs_to_json(queue), json.dumps(player.is_paused()))
+
+
+class _Subscription(object):
+    """
+    The serialized player events waiting to be sent to one client.
+    """
+
+    def __init__(self, max_len=256):
+        self.queue = asyncio.Queue(maxsize=max_len)
+        # Set if the client is too slow to keep up, it has to catch up with the state log then
+        self.overflowed = False
+
+    def put(self, version, message):
+        try:
+            self.queue.put_nowait((version, message))
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def reset(self):
+        self.queue = asyncio.Queue(maxsize=self.queue.maxsize)
+        self.overflowed = False
+
+
+class _PlayerEventHub(object):
+    """
+    Forwards the events of the player's StateLog from the player threads to the subscriptions and long-polling
+    requests on the event loop. Every event is serialized once, no matter how many clients are subscribed.
+
+    Also caches the serialized player state until the next event, so polling an unchanged state is cheap.
+    """
+
+    def __init__(self, state_log):
+        self.state_log = state_log
+        self._subscriptions = set()
+        self._waiters = set()
+        self._loop = None
+        # (version, serialized state, ETag)
+        self._state = None
+        state_log.add_listener(self._on_event)
+
+    def _on_event(self, version, event):
+        loop = self._loop
+        if loop and (self._subscriptions or self._waiters):
+            loop.call_soon_threadsafe(self._dispatch, version, json.dumps(event))
+
+    def _dispatch(self, version, message):
+        for subscription in self._subscriptions:
+            subscription.put(version, message)
+        waiters = self._waiters
+        self._waiters = set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(version)
+
+    def get_state(self):
+        """
+        Get the serialized player state, including its version.
+        :return: a (version, serialized state, ETag) tuple
+        """
+        state = self._state
+        if state and state[0] == self.state_log.get_version():
+            return state
+        version, body = self.state_log.snapshot(_get_player_state)
+        # Insert the version without deserializing the state again
+        body = '{{"version": {}, {}'.format(version, body[1:])
+        state = (version, body, '"{}"'.format(version))
+        self._state = state
+        return state
+
+    async def wait_for_change(self, version, timeout):
+        """
+        Wait until the player state changes.
+        :param version: the version known by the client
+        :param timeout: the maximum number of seconds to wait
+        :return: True if the state changed, False if the timeout expired
+        """
+        loop = asyncio.get_event_loop()
+        self._loop = loop
+        waiter = loop.create_future()
+        self._waiters.add(waiter)
+        try:
+            # Check after registering the waiter, so an event in between isn't missed
+            if self.state_log.get_version() != version:
+                return True
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.discard(waiter)
+
+    def subscribe(self):
+        self._loop = asyncio.get_event_loop()
+        subscription = _Subscription()
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+
+    def get_catch_up(self, version):
+        """
+        Get the messages a client needs to catch up from a version.
+        :param version: the version known by the client or None
+        :return: a list of (version, message) tuples. The messages are the missed events,
+                 or a 'state' message with the full player state if they aren't available anymore.
+        """
+        if version is not None:
+            events = self.state_log.get_since(version)
+            if events is not None:
+                return [(event_version, json.dumps(event)) for event_version, event in events]
+        version, body, _ = self.get_state()
+        return [(version, '{{"type": "state", "version": {}, "state": {}}}'.format(version, body))]
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == etag or value == "*":
+            return True
+    return False
+
 
-    return {"current_song": song_json,
-            "last_played": list(map(Song.to_json, player.get_last_played())),
-            "queue": list(map(Song.to_json, queue)),
-            "paused": player.is_paused()}
+def _player_state_response():
+    _, body, etag = _event_hub.get_state()
+    return _json_text_response(body, {"ETag": etag, "Cache-Control": "no-cache"})
 
 
-@hug.put(requires=authentication)
-def toggle_pause(user: hug.directives.user):
+@_endpoint("GET")
+async def player_state(request, wait_for_change: int = 0):
+    """
+    Get the player state, including its version. The version is also sent as the ETag of the response.
+    If the If-None-Match header matches the current version, status 304 is returned without a body.
+    :param wait_for_change: if the If-None-Match header matches, wait up to this many seconds (at most 60)
+                            for the state to change before returning 304
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    version, _, etag = _event_hub.get_state()
+    if _etag_matches(if_none_match, etag):
+        if wait_for_change > 0 and await _event_hub.wait_for_change(version, min(wait_for_change, 60)):
+            return _player_state_response()
+        return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return _player_state_response()
+
+
+async def _stream_player_events(send, version, keepalive_interval=30):
+    """
+    Send player events until the connection is closed.
+    :param send: a coroutine function sending a (version, message) tuple, or a keepalive if the message is None
+    :param version: the version known by the client or None
+    :param keepalive_interval: the maximum number of seconds without a message
+    """
+    subscription = _event_hub.subscribe()
+    try:
+        catch_up = True
+        while True:
+            if catch_up or subscription.overflowed:
+                subscription.reset()
+                for version, message in _event_hub.get_catch_up(version):
+                    await send(version, message)
+                catch_up = False
+            try:
+                event_version, message = await asyncio.wait_for(subscription.queue.get(), keepalive_interval)
+            except asyncio.TimeoutError:
+                await send(version, None)
+                continue
+            # Events which happened before the catch up are part of it already
+            if event_version > version:
+                version = event_version
+                await send(version, message)
+    finally:
+        _event_hub.unsubscribe(subscription)
+
+
+@_endpoint("GET")
+async def player_events(request, version: int = None):
+    """
+    Push the player state as a WebSocket or, without a WebSocket upgrade, as server-sent events.
+
+    The first message is the full state ({'type': 'state', 'version': ..., 'state': <player_state>}),
+    followed by one message for every change:
+    - {'type': 'queue_add', 'index': ..., 'song': ...}
+    - {'type': 'queue_remove', 'index': ...}
+    - {'type': 'queue_move', 'from_index': ..., 'to_index': ...}
+    - {'type': 'queue_clear'}
+    - {'type': 'current_song', 'song': ...}, the song is also appended to last_played
+    - {'type': 'paused', 'paused': ...}
+    Every message contains the version of the state after the change.
+    A reconnecting client passes the last version it received (or the Last-Event-ID header for server-sent events)
+    and only receives the changes it missed, or the full state again if they are not available anymore.
+    :param version: the last version known by the client
+    """
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id:
+        try:
+            version = int(last_event_id)
+        except ValueError:
+            pass
+
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        async def _send_ws(_, message):
+            if message is not None:
+                await ws.send_str(message)
+
+        def _on_sender_done(task):
+            # Sending failed, closing the connection ends the loop below
+            if not task.cancelled():
+                asyncio.ensure_future(ws.close())
+
+        sender = asyncio.ensure_future(_stream_player_events(_send_ws, version))
+        sender.add_done_callback(_on_sender_done)
+        try:
+            # Messages from the client are ignored, this only waits for the connection to be closed
+            async for _ in ws:
+                pass
+        finally:
+            sender.cancel()
+            # Unlike awaiting the sender, this doesn't raise its exception or cancel it if this handler is cancelled
+            await asyncio.wait([sender])
+            if not sender.cancelled():
+                error = sender.exception()
+                if error and not isinstance(error, ConnectionResetError):
+                    logger.error("Could not send player events", exc_info=error)
+            await ws.close()
+        return ws
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    async def _send_sse(event_version, message):
+        if message is None:
+            await response.write(b": keepalive\n\n")
+        else:
+            await response.write("id: {}\ndata: {}\n\n".format(event_version, message).encode("utf-8"))
+
+    try:
+        await _stream_player_events(_send_sse, version)
+    except ConnectionResetError:
+        pass
+    return response
+
+
+@_endpoint("PUT", authenticated=True)
+async def toggle_pause(user):
     if player.is_paused():
         logger.debug("Resumed by %s", user['name'])
         player.resume()
     else:
         logger.debug("Paused by %s", user['name'])
         player.pause()
-    return player_state()
+    return _player_state_response()
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def next_song(user: hug.directives.user):
+@_endpoint("PUT", authenticated=True)
+async def next_song(user):
     logger.debug("Skip to next song by %s", user['name'])
-    player.next()
-    return player_state()
+    await _run(_api_executor, player.next)
+    return _player_state_response()
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def move(moving_song_json, other_song_json, after_other: hug.types.boolean = False, response=None):
+@_endpoint("PUT", authenticated=True)
+async def move(moving_song_json, other_song_json, after_other: bool = False, user=None):
     try:
         moving_song = Song.from_json(moving_song_json, music_api_names)
         other_song = Song.from_json(other_song_json, music_api_names)
     except ValueError as e:
         logger.debug("Received invalid json (%s): %s , %s", str(e), moving_song_json, other_song_json)
-        response.status = falcon.HTTP_400
-        return str(e)
-
-    try:
-        queue.remove(moving_song)
-    except ValueError:
-        logger.debug("Tried to move song %s that wasn't in the queue", moving_song)
-        response.status = falcon.HTTP_400
-        return "song {} is not in queue".format(moving_song)
+        return _response(str(e), 400)
 
     try:
-        index = queue.index(other_song)
-        if after_other:
-            index += 1
-        queue.insert(index, moving_song)
+        # Checked by the queue while it is locked, either song may have been removed by another request
+        queue.move(moving_song, other_song, after_other)
         logger.debug("Moved song %s after/before(%s) %s", moving_song, after_other, other_song)
-        return player_state()
-    except ValueError:
-        logger.debug("Couldn't move song %s, because other song %s was removed from queue", moving_song, other_song)
-        response.status = falcon.HTTP_400
-        return "song {} is not in queue".format(other_song)
+        return _player_state_response()
+    except ValueError as e:
+        logger.debug("Couldn't move song %s next to %s: %s", moving_song, other_song, e)
+        return _response(str(e), 400)
 
 
-@hug.local()
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def has_admin(user: hug.directives.user = None):
+@_endpoint("GET", authenticated=True)
+async def has_admin(user):
     """
     Check whether the server has an admin.
     If there is none and none is allowed, also returns True.
     :return: True or False
     """
-    if not config.get_allow_rest_admin():
-        return True
-    if user and ("admin" in user['permissions']):
-        return True
-    db = _get_db_conn()
-    try:
-        cursor = db.cursor()
-        cursor.execute("SELECT permissions FROM clients")
-        rows = cursor.fetchall()
-        for row in rows:
-            if "admin" in row[0].split(","):
-                return True
-        return False
-    finally:
-        db.close()
+    return _has_admin(user)
 
 
-@hug.local()
-@hug.get(requires=authentication)
-def is_admin(user: hug.directives.user):
+@_endpoint("GET", authenticated=True)
+async def is_admin(user):
     """
     Check whether the the calling user is admin
     :return: True or False
     """
-    return "admin" in user['permissions']
+    return _is_admin(user)
 
 
-@hug.local()
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def has_permission(user: hug.directives.user, needed_permissions=["admin"]):
+@_endpoint("GET", authenticated=True)
+async def has_permission(user, needed_permissions=None):
     """
     Ensure that a user has at least one of the needed permissions.
-    :param needed_permissions: an iterable of permission strings
+    :param needed_permissions: a list of permission strings or a comma separated string, defaults to admin
     :return: True or False
     """
-    return not set(user['permissions']).isdisjoint(set(needed_permissions))
+    if not needed_permissions:
+        needed_permissions = ["admin"]
+    elif isinstance(needed_permissions, str):
+        needed_permissions = needed_permissions.split(",")
+    return _has_permission(user, needed_permissions)
 
 
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def get_permissions(user: hug.directives.user):
+@_endpoint("GET", authenticated=True)
+async def get_permissions(user):
     """
     Return the permissions of the client.
     :return: a list of permissions
@@ -544,87 +1093,60 @@ def get_permissions(user: hug.directives.user):
     return user['permissions']
 
 
-claim_admin_lock = threading.Lock()
-
-
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def claim_admin(user: hug.directives.user, response=None):
+@_endpoint("GET", authenticated=True)
+async def claim_admin(user):
     """
     Request admin rights. If allow_rest_admin is set in config and no other admin exists, return admin token.
     :return: an admin token on success.
     """
     username = user['name']
-    permissions = user['permissions']
-    if "admin" in permissions:
-        response.status = falcon.HTTP_400
-        return None
-    with claim_admin_lock:
-        if has_admin():
-            logger.debug("%s tried to claim admin rights, but there already is an admin.", user['name'])
-            response.status = falcon.HTTP_CONFLICT
-            return None
-        permissions.append("admin")
-        permissions = list(set(permissions))
-        db = _get_db_conn()
+    if _is_admin(user):
+        return _response(None, 400)
+    if not config.get_allow_rest_admin():
+        permissions = None
+    else:
         try:
-            with db:
-                db.execute("UPDATE clients SET permissions=? WHERE username=?", (",".join(permissions), username))
-        finally:
-            db.close()
+            permissions = await _run(_db_executor, _users.claim_admin, username)
+            _token_cache.invalidate_user(username)
+        except ValueError:
+            return _response("unknown", 400)
+    if permissions is None:
+        logger.debug("%s tried to claim admin rights, but there already is an admin.", username)
+        return _response(None, 409)
     return _create_user_token(username, permissions)
 
 
-@hug.local()
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def get_available_permissions(user: hug.directives.user = None, response=None):
+@_endpoint("GET", authenticated=True)
+async def get_available_permissions(user):
     """
     Return a list of available permissions an admin can grant to users.
     Needs admin permission.
     :return: a list of permissions
     """
-    if user and (not is_admin(user)):
+    if not _is_admin(user):
         logger.debug("%s tried to get available permissions but is not admin.", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
+        return _response(None, 403)
     return list(map(_Permission.to_json, available_permissions))
 
 
-@hug.local()
-@asyncio.coroutine
-@hug.get(requires=authentication)
-def get_users(user: hug.directives.user = None, response=None):
+@_endpoint("GET", authenticated=True)
+async def get_users(user):
     """
     Return a list of all registered users with their permissions.
     Needs admin permission.
     :return: a list of users or None
     """
-    if user and (not is_admin(user)):
+    if not _is_admin(user):
         logger.debug("%s tried to get users but is not admin", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
-    db = _get_db_conn()
-    try:
-        cursor = db.cursor()
-        cursor.execute("SELECT username, permissions FROM clients")
-        result = []
-        for row in cursor.fetchall():
-            result.append({
-                "username": row[0],
-                "permissions": row[1].split(",")
-            })
-        return result
-    finally:
-        db.close()
+        return _response(None, 403)
+    clients = _users.get_all()
+    return [{"username": username, "permissions": permissions} for username, permissions in clients]
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def grant_permission(target_username, body, user: hug.directives.user = None, response=None):
+@_endpoint("PUT", authenticated=True)
+async def grant_permission(target_username, body, user):
     """
     Grant a permission to a user
-    Note that the new permissions only apply after the user logged out and in again.
     Needs admin permission.
     :param target_username: the username of the user the permission should be granted
     :param body: the permission as returned by get_permissions
@@ -633,37 +1155,25 @@ def grant_permission(target_username, body, user: hug.directives.user = None, re
     try:
         permission = _Permission.from_json(body)
     except ValueError:
-        response.status = falcon.HTTP_UNPROCESSABLE_ENTITY
-        return "invalid JSON"
-    if not is_admin(user):
+        return _response("invalid JSON", 422)
+    if not _is_admin(user):
         logger.debug("%s tried to grant a permission %s to %s but is not admin.", user['name'], permission,
                      target_username)
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
+        return _response(None, 403)
     target_username = target_username.strip().lower()
-    client = _get_client(target_username)
-    if not client:
-        logger.debug("%s tried to grant permission to unknown user %s", user['name'], target_username)
-        response.status = falcon.HTTP_400
-        return "unknown target user"
-    permissions = client.permissions
-    permissions.append(permission.name)
-    permissions = list(set(permissions))
-    db = _get_db_conn()
     try:
-        with db:
-            db.execute("UPDATE clients SET permissions=? WHERE username=?", [",".join(permissions), target_username])
-    finally:
-        db.close()
+        await _run(_db_executor, _users.change_permission, target_username, permission.name, True)
+        _token_cache.invalidate_user(target_username)
+    except ValueError:
+        logger.debug("%s tried to grant permission to unknown user %s", user['name'], target_username)
+        return _response("unknown target user", 400)
     return "OK"
 
 
-@asyncio.coroutine
-@hug.put(requires=authentication)
-def revoke_permission(target_username, body, user: hug.directives.user = None, response=None):
+@_endpoint("PUT", authenticated=True)
+async def revoke_permission(target_username, body, user):
     """
     Revokes a granted permission.
-    Note that the new permissions only apply after the user logged out and in again.
     Needs admin permission.
     :param target_username: the username of the user whos permission should be revoked
     :param body: the permission as returned by get_permissions
@@ -672,30 +1182,18 @@ def revoke_permission(target_username, body, user: hug.directives.user = None, r
     try:
         permission = _Permission.from_json(body)
     except ValueError:
-        response.status = falcon.HTTP_UNPROCESSABLE_ENTITY
-        return "invalid JSON"
-    if not is_admin(user):
+        return _response("invalid JSON", 422)
+    if not _is_admin(user):
         logger.debug("%s tried to revoke a permission %s from %s but is not admin.", user['name'], permission,
                      target_username)
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
+        return _response(None, 403)
     target_username = target_username.strip().lower()
-    client = _get_client(target_username)
-    if not client:
-        logger.debug("%s tried to revoke permission from unknown user %s", user['name'], target_username)
-        response.status = falcon.HTTP_400
-        return "unknown target user"
-    permissions = client.permissions
     try:
-        permissions.remove(permission.name)
+        await _run(_db_executor, _users.change_permission, target_username, permission.name, False)
+        _token_cache.invalidate_user(target_username)
     except ValueError:
-        pass
-    db = _get_db_conn()
-    try:
-        with db:
-            db.execute("UPDATE clients SET permissions=? WHERE username=?", [",".join(permissions), target_username])
-    finally:
-        db.close()
+        logger.debug("%s tried to revoke permission from unknown user %s", user['name'], target_username)
+        return _response("unknown target user", 400)
     return "OK"
 
 
@@ -704,27 +1202,18 @@ def _exit():
     async_handler.shutdown()
 
 
-@hug.put(requires=authentication)
-def exit_bot(user: hug.directives.user, response=None):
-    if not has_permission(user, ["admin", "exit"]):
+@_endpoint("PUT", authenticated=True)
+async def exit_bot(user):
+    if not _has_permission(user, ["admin", "exit"]):
         logger.debug("%s called exit but is not admin", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
+        return _response(None, 403)
 
     logger.debug("%s called exit", user['name'])
     async_handler.submit(_exit)
     return "OK"
 
 
-@hug.put(requires=authentication)
-def reset_bot(user: hug.directives.user, response=None):
-    if not has_permission(user, ["admin", "reset"]):
-        logger.debug("%s called reset but is not permitted", user['name'])
-        response.status = falcon.HTTP_FORBIDDEN
-        return None
-
-    logger.debug("%s called reset", user['name'])
-
+def _reset():
     for api_name in music_api_names:
         api = music_api_names[api_name]
         if isinstance(api, AbstractSongProvider):
@@ -732,91 +1221,119 @@ def reset_bot(user: hug.directives.user, response=None):
 
     del config.get_secrets()['rest_token']
     config.save_secrets()
-    os.remove("config/clients.db")
+    _users.reset()
 
+
+@_endpoint("PUT", authenticated=True)
+async def reset_bot(user):
+    if not _has_permission(user, ["admin", "reset"]):
+        logger.debug("%s called reset but is not permitted", user['name'])
+        return _response(None, 403)
+
+    logger.debug("%s called reset", user['name'])
+    await _run(_api_executor, _reset)
+    _token_cache.clear()
     async_handler.submit(_exit)
     return "OK"
 
 
-@hug.get(requires=authentication)
-def get_available_offline_playlists(user: hug.directives.user, response=None):
+@_endpoint("GET", authenticated=True)
+async def get_available_offline_playlists(user):
     """
     Get all available playlists of the offline API.
     :return: a list of playlists of the form {'playlist_id': <id>, 'playlist_name': <name>}
     """
-    if not has_permission(user, ["admin", "mod", "select_playlist"]):
-        response.status = falcon.HTTP_FORBIDDEN
-        return "Forbidden"
+    if not _has_permission(user, ["admin", "mod", "select_playlist"]):
+        return _response("Forbidden", 403)
     try:
         api = music_api_names['offline_api']
-        playlists = api.get_available_playlists()
-        return list(map(lambda p: {'playlist_id': p[0], 'playlist_name': p[1]}, playlists))
     except KeyError:
-        response.status = falcon.HTTP_400
-        return "Not in offline mode"
+        return _response("Not in offline mode", 400)
+    playlists = await _run(_api_executor, api.get_available_playlists)
+    return list(map(lambda p: {'playlist_id': p[0], 'playlist_name': p[1]}, playlists))
 
 
-@hug.get(requires=authentication)
-def get_active_playlist(user: hug.directives.user, response=None):
+@_endpoint("GET", authenticated=True)
+async def get_active_playlist(user):
     """
     Get the active playlist of the offline API.
     :return: the active playlist of the form {'playlist_id': <id>, 'playlist_name': <name>}
     """
-    if not has_permission(user, ["admin", "mod", "select_playlist"]):
-        response.status = falcon.HTTP_FORBIDDEN
-        return "Forbidden"
+    if not _has_permission(user, ["admin", "mod", "select_playlist"]):
+        return _response("Forbidden", 403)
 
     try:
         api = music_api_names['offline_api']
-        playlist_tuple = api.get_active_playlist()
-        if not playlist_tuple:
-            return None
-        return {'playlist_id': playlist_tuple[0], 'playlist_name': playlist_tuple[1]}
     except KeyError:
-        response.status = falcon.HTTP_400
-        return "Not in offline mode"
+        return _response("Not in offline mode", 400)
+    playlist_tuple = await _run(_api_executor, api.get_active_playlist)
+    if not playlist_tuple:
+        return None
+    return {'playlist_id': playlist_tuple[0], 'playlist_name': playlist_tuple[1]}
 
 
-@hug.put(requires=authentication)
-def mark_active(playlist_id: str, user: hug.directives.user, response=None):
+@_endpoint("PUT", authenticated=True)
+async def mark_active(playlist_id: str, user):
     """
     Mark a playlist as active in offline mode.
     Needs admin, mod or select_playlist permission.
     :param playlist_id: the playlist ID as returned by get_available_playlists
     """
-    if not has_permission(user, ["admin", "mod", "select_playlist"]):
-        response.status = falcon.HTTP_FORBIDDEN
-        return "Forbidden"
+    if not _has_permission(user, ["admin", "mod", "select_playlist"]):
+        return _response("Forbidden", 403)
 
     try:
-        try:
-            api = music_api_names['offline_api']
-        except KeyError:
-            response.status = falcon.HTTP_400
-            return "Not in offline mode"
-        api.set_active_playlist(playlist_id)
+        api = music_api_names['offline_api']
+    except KeyError:
+        return _response("Not in offline mode", 400)
+    try:
+        await _run(_api_executor, api.set_active_playlist, playlist_id)
         return "OK"
     except ValueError:
-        response.status = falcon.HTTP_UNPROCESSABLE_ENTITY
-        return "Unknown ID"
+        return _response("Unknown ID", 422)
 
 
-@asyncio.coroutine
-@hug.get(output=hug.output_format.png_image)
-def get_album_art(song_id: hug.types.text, response=None):
+@_endpoint("GET")
+async def get_album_art(song_id: str, size: int = 0):
+    """
+    Get the album art of an offline song.
+    The response is the original image, or the smallest thumbnail which is at least size pixels wide and high.
+    It has a strong ETag, so If-None-Match requests are answered with 304. The album art of a song may change
+    when its file changes, so it has to be revalidated after a day. The Content-Location header contains
+    the URL of the same image by its content hash (see album_art), which can be cached forever.
+    """
     try:
         api = music_api_names['offline_api']
     except KeyError:
-        response.status = falcon.HTTP_400
-        return "Not in offline mode"
-    db = sqlite3.connect(api._db_path)
+        return _response("Not in offline mode", 400)
+    album_art = await _run(_api_executor, api.get_album_art_file, song_id, max(0, size) or None)
+    if not album_art:
+        return web.Response(status=404)
+
+    return _album_art_response(album_art, "public, max-age=86400", {
+        "Content-Location": "/album_art?hash={}&size={}".format(album_art.content_hash, album_art.size or 0)
+    })
+
+
+@_endpoint("GET")
+async def album_art(hash: str, size: int = 0):
+    """
+    Get an album art by the SHA-256 hash of the original image. The image never changes, so it can be cached forever.
+    """
     try:
-        cursor = db.execute("SELECT albumArt FROM albumArts WHERE songId=?", [song_id])
-        result = cursor.fetchone()
-        if not result:
-            response.status = falcon.HTTP_404
-            return None
+        api = music_api_names['offline_api']
+    except KeyError:
+        return _response("Not in offline mode", 400)
+    album_art = await _run(_api_executor, api.get_album_art_by_hash, hash, max(0, size) or None)
+    if not album_art:
+        return web.Response(status=404)
 
-        return BytesIO(result[0])
-    finally:
-        db.close()
+    return _album_art_response(album_art, "public, max-age=31536000, immutable")
+
+
+def _album_art_response(album_art, cache_control, headers=None):
+    headers = dict(headers or {})
+    headers["Content-Type"] = album_art.mime_type
+    headers["Cache-Control"] = cache_control
+    # FileResponse sends the file with sendfile and handles conditional and range requests
+    return web.FileResponse(album_art.path, headers=headers)
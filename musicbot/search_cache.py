@@ -0,0 +1,366 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_query(query):
+    """
+    Normalize a search query, so queries differing only in case or whitespace share a cache entry.
+    :return: the normalized query, an empty string if the query contains nothing but whitespace
+    """
+    if not query:
+        return ""
+    return " ".join(query.lower().split())
+
+
+class _Entry(object):
+    """
+    The materialized results of one search.
+
+    The generator returned by the API is the cursor for the next results. It is only advanced while holding the lock
+    and it is closed as soon as all results have been fetched or the entry is dropped, so clients never see it.
+    """
+
+    def __init__(self, generator, expires_at, max_len, songs=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        generator -- the search results, None if songs already contains all of them
+        expires_at -- the time.monotonic() timestamp the entry expires at
+        max_len -- the maximum number of songs
+        songs -- the songs fetched already
+        """
+        self.songs = songs or []
+        # The number of songs included in the size of the cache
+        self.counted = 0
+        self.complete = generator is None
+        # Whether songs contains all results, not just the first max_len songs
+        self.exhausted = generator is None
+        self.dropped = False
+        self.error = None
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+        self._generator = generator
+        self._max_len = max_len
+        self._refill_target = 0
+
+    def is_stale(self, now):
+        return self.error is not None or self.expires_at <= now
+
+    def fill(self, target, cancelled=None):
+        """
+        Fetch songs until there are at least target songs or there are no more results.
+        :param target: the number of songs
+        :param cancelled: a function returning True if the songs aren't needed anymore, checked after every song
+        """
+        target = min(target, self._max_len)
+        with self.lock:
+            try:
+                while not self.complete and not self.dropped and len(self.songs) < target:
+                    if cancelled is not None and cancelled():
+                        return
+                    try:
+                        self.songs.append(next(self._generator))
+                    except StopIteration:
+                        self.exhausted = True
+                        self._close()
+                if self.dropped or len(self.songs) >= self._max_len:
+                    self._close()
+            except Exception as e:
+                self.error = e
+                self._close()
+
+    def request_refill(self, target):
+        """
+        Raise the target of the next background refill.
+        :return: whether a refill has to be scheduled
+        """
+        with self.lock:
+            if self.complete or len(self.songs) >= target or target <= self._refill_target:
+                return False
+            self._refill_target = target
+            return True
+
+    def close(self):
+        """
+        Close the cursor. If it is being advanced right now, it is closed by fill() instead of waiting for it.
+        """
+        self.dropped = True
+        if self.lock.acquire(blocking=False):
+            try:
+                self._close()
+            finally:
+                self.lock.release()
+
+    def _close(self):
+        self.complete = True
+        if self._generator is not None:
+            # Some APIs return a plain iterator instead of a generator
+            close = getattr(self._generator, "close", None)
+            if close:
+                close()
+            self._generator = None
+
+
+class SearchCache(object):
+    """
+    A process-wide cache of search results, shared by all Telegram bots and the REST API.
+
+    Entries are keyed by API and normalized query and store the songs fetched so far. Whenever a page is requested,
+    the following pages are fetched in the background, so paging through results rarely waits for the API.
+    Entries expire after a TTL. The total number of cached songs is bounded, the least recently used entries are
+    dropped first.
+
+    If all results of a prefix of a query are cached, the API may derive the results from them
+    (see AbstractAPI.refine_search()), so searching as you type only searches once for some APIs.
+    """
+
+    def __init__(self, max_songs=5000, ttl=300, prefetch_pages=1, max_query_songs=500, max_workers=4):
+        """
+        Constructor
+
+        Keyword arguments:
+        max_songs -- the maximum number of songs in all entries
+        ttl -- the number of seconds an entry is kept after it has been created
+        prefetch_pages -- the number of pages fetched ahead of the requested page
+        max_query_songs -- the maximum number of songs fetched for a single query
+        max_workers -- the maximum number of concurrent background refills
+        """
+        self._max_songs = max_songs
+        self._ttl = ttl
+        self._prefetch_pages = prefetch_pages
+        self._max_query_songs = max_query_songs
+        self._lock = threading.Lock()
+        # (api_name, query) -> _Entry, the least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        # Incremented by invalidate(), so results of searches started before aren't cached anymore
+        self._generation = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _get_entry(self, api, query):
+        key = (api.get_name(), query)
+        now = time.monotonic()
+        dropped = []
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(key)
+            if entry is not None and entry.is_stale(now):
+                dropped.append(self._pop(key))
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            else:
+                dropped.extend(self._pop(other_key) for other_key, other_entry in list(self._entries.items())
+                               if other_entry.is_stale(now))
+                prefix_entry = self._find_prefix_entry(key, now)
+        for dropped_entry in dropped:
+            dropped_entry.close()
+        if entry is not None:
+            return key, entry
+
+        songs = None
+        if prefix_entry is not None:
+            songs = api.refine_search(query, prefix_entry.songs)
+        if songs is None:
+            new_entry = _Entry(iter(api.search_song(query)), now + self._ttl, self._max_query_songs)
+        else:
+            # The derived results are as old as the ones they are derived from
+            new_entry = _Entry(None, prefix_entry.expires_at, self._max_query_songs, songs)
+
+        with self._lock:
+            if self._generation != generation:
+                # The cache has been invalidated in the meantime, the results may be outdated already
+                return key, new_entry
+            entry = self._entries.get(key)
+            if entry is None or entry.is_stale(now):
+                if entry is not None:
+                    dropped.append(self._pop(key))
+                entry = new_entry
+                self._entries[key] = entry
+                self._count(entry)
+                dropped.extend(self._evict(key))
+            else:
+                # Another thread created the entry in the meantime
+                dropped.append(new_entry)
+        for dropped_entry in dropped:
+            dropped_entry.close()
+        return key, entry
+
+    def _find_prefix_entry(self, key, now):
+        """
+        Find the entry with all results of the longest prefix of a query. Has to be called while holding the lock.
+        :return: the entry or None
+        """
+        api_name, query = key
+        for end in range(len(query) - 1, 0, -1):
+            entry = self._entries.get((api_name, query[:end]))
+            if entry is not None and entry.exhausted and not entry.is_stale(now):
+                return entry
+        return None
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.counted
+        return entry
+
+    def _count(self, entry):
+        size = len(entry.songs)
+        self._size += size - entry.counted
+        entry.counted = size
+
+    def _evict(self, keep_key):
+        """
+        Drop the least recently used entries until the size limit is met. Has to be called while holding the lock.
+        :param keep_key: the key of an entry which is never dropped
+        :return: the dropped entries, they still have to be closed
+        """
+        dropped = []
+        while self._size > self._max_songs and len(self._entries) > 1:
+            oldest_key = next(iter(self._entries))
+            if oldest_key == keep_key:
+                self._entries.move_to_end(keep_key)
+                oldest_key = next(iter(self._entries))
+            dropped.append(self._pop(oldest_key))
+        return dropped
+
+    def _fill(self, key, entry, target, cancelled=None):
+        entry.fill(target, cancelled)
+        dropped = []
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._count(entry)
+                if entry.error is not None:
+                    dropped.append(self._pop(key))
+            dropped.extend(self._evict(key))
+        for dropped_entry in dropped:
+            dropped_entry.close()
+
+    def _refill(self, key, entry, target):
+        try:
+            self._fill(key, entry, target)
+            if entry.error is not None:
+                logging.getLogger("musicbot").warning("Could not prefetch search results: %s", entry.error)
+        except Exception:
+            logging.getLogger("musicbot").exception("Search cache refill failed")
+
+    def get_page(self, api, query, offset=0, limit=20, cancelled=None):
+        """
+        Get a page of search results. The following pages are fetched in the background.
+        :param api: the AbstractAPI to search
+        :param query: the search query
+        :param offset: the number of results to skip
+        :param limit: the maximum number of results on the page
+        :param cancelled: a function returning True if the page isn't needed anymore.
+                          The songs fetched so far stay cached, but the returned page may be incomplete.
+        :return: a tuple (songs, next_offset), next_offset is None if there are no more results
+        """
+        query = normalize_query(query)
+        if not query:
+            raise ValueError("query is None")
+        if offset < 0 or limit < 1:
+            raise ValueError("Invalid page")
+
+        key, entry = self._get_entry(api, query)
+        end = offset + limit
+        # One more song than needed shows whether there is a next page
+        if len(entry.songs) <= end and not entry.complete:
+            self._fill(key, entry, end + 1, cancelled)
+        if entry.error is not None and len(entry.songs) <= offset:
+            raise entry.error
+
+        songs = entry.songs[offset:end]
+        if cancelled is not None and cancelled():
+            return songs, None
+        next_offset = end if len(entry.songs) > end else None
+
+        if next_offset is not None:
+            target = end + 1 + self._prefetch_pages * limit
+            if entry.request_refill(target):
+                self._executor.submit(self._refill, key, entry, target)
+        return songs, next_offset
+
+    def get_songs(self, api, query, max_len):
+        """
+        Get the first search results.
+        :return: a list of at most max_len Song objects
+        """
+        return self.get_page(api, query, 0, max_len)[0]
+
+    def invalidate(self, api_name=None):
+        """
+        Drop all entries, or only those of one API, e.g. after its library changed.
+        """
+        with self._lock:
+            self._generation += 1
+            dropped = [self._pop(key) for key in list(self._entries) if api_name is None or key[0] == api_name]
+        for entry in dropped:
+            entry.close()
+
+    def get_size(self):
+        """
+        Get the number of cached songs.
+        """
+        return self._size
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.invalidate()
+
+
+class QueryDebouncer(object):
+    """
+    Tracks the latest search query of every user, e.g. for search as you type.
+
+    A query is superseded as soon as the same user sends a new one. Queries wait a short delay before they are
+    executed and are dropped if they are superseded in the meantime. Queries which are already running can check
+    whether they are still current and stop early.
+    """
+
+    def __init__(self, delay=0.3):
+        """
+        Constructor
+
+        Keyword arguments:
+        delay -- the number of seconds a query waits for a newer one before it is executed
+        """
+        self._delay = delay
+        self._condition = threading.Condition()
+        # User ID -> the ticket of the latest query
+        self._latest = {}
+        self._next_ticket = 0
+
+    def start(self, user_id):
+        """
+        Register a new query, superseding all older queries of the user.
+        :return: the ticket of the query
+        """
+        with self._condition:
+            self._next_ticket += 1
+            ticket = self._next_ticket
+            self._latest[user_id] = ticket
+            self._condition.notify_all()
+        return ticket
+
+    def is_current(self, user_id, ticket):
+        return self._latest.get(user_id) == ticket
+
+    def wait(self, user_id, ticket):
+        """
+        Wait until the delay has passed or the query has been superseded.
+        :return: whether the query is still current
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self.is_current(user_id, ticket), self._delay)
+            return self.is_current(user_id, ticket)
+
+    def finish(self, user_id, ticket):
+        """
+        Forget about a query once it has been answered or dropped.
+        """
+        with self._condition:
+            if self.is_current(user_id, ticket):
+                del self._latest[user_id]
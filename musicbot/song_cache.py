@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pylru
+
+from musicbot import config
+from musicbot.database import ConnectionManager
+
+_db_path = os.path.join("config", "song_cache.db")
+_db_lock = threading.Lock()
+_db = None
+
+
+def _get_db():
+    global _db
+    with _db_lock:
+        if not _db:
+            db = ConnectionManager(_db_path)
+            with db.transaction():
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS songCache(apiName TEXT NOT NULL, songId TEXT NOT NULL, songJson TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY(apiName, songId))")
+                db.execute("CREATE INDEX IF NOT EXISTS songCacheUpdated ON songCache(apiName, updated)")
+            _db = db
+    return _db
+
+
+class SongCache(object):
+    """
+    A two-tier cache for song metadata.
+    The first tier is an in-memory LRU cache, the second one is an SQLite database which survives restarts.
+    Entries in the second tier expire after a per-API TTL and are pruned to a per-API maximum size.
+    Songs are written to the second tier in batches, see flush().
+    """
+    _prune_interval = 100
+    # The maximum number of songs waiting to be written to disk
+    _max_pending = 100
+
+    def __init__(self, api, memory_size=256):
+        """
+        Constructor
+
+        Keyword arguments:
+        api -- the AbstractAPI whose songs are cached
+        memory_size -- the maximum number of songs in the in-memory tier
+        """
+        self._api = api
+        self._api_name = api.get_name()
+        self._apis = {self._api_name: api}
+        self._ttl = config.get_song_cache_ttl(self._api_name)
+        self._max_size = config.get_song_cache_size(self._api_name)
+        self._memory = pylru.lrucache(memory_size)
+        self._memory_lock = threading.Lock()
+        # Song ID -> (Song, time of the put) of the songs waiting to be written to disk
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._puts = 0
+        self._memory_hits = 0
+        self._memory_misses = 0
+        self._disk_hits = 0
+        self._disk_misses = 0
+
+    def __contains__(self, song_id):
+        return self.get(song_id) is not None
+
+    def get(self, song_id):
+        """
+        Look up a song, first in memory, then on disk.
+        :param song_id: the song ID
+        :return: the cached Song or None
+        """
+        with self._memory_lock:
+            if song_id in self._memory:
+                self._memory_hits += 1
+                return self._memory[song_id]
+            self._memory_misses += 1
+
+        with self._pending_lock:
+            pending = self._pending.get(song_id)
+        if pending:
+            song = pending[0]
+        else:
+            song = self._disk_get(song_id)
+        if song:
+            self._disk_hits += 1
+            with self._memory_lock:
+                self._memory[song_id] = song
+        else:
+            self._disk_misses += 1
+        return song
+
+    def get_memory(self, song_id):
+        """
+        Look up a song in the in-memory tier only.
+        :param song_id: the song ID
+        :return: the cached Song or None
+        """
+        with self._memory_lock:
+            if song_id in self._memory:
+                self._memory_hits += 1
+                return self._memory[song_id]
+            self._memory_misses += 1
+            return None
+
+    def put(self, song):
+        """
+        Store a song in memory and queue it for the disk tier.
+        Queued songs are written by the next flush(), or as soon as there are too many of them.
+        :param song: a Song of the cached API
+        """
+        with self._memory_lock:
+            self._memory[song.song_id] = song
+        if not self._ttl or not self._max_size:
+            return
+
+        with self._pending_lock:
+            self._pending[song.song_id] = (song, time.time())
+            full = len(self._pending) >= self._max_pending
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued songs to disk in one transaction.
+        Should be called after every search, lookup or batch of lookups putting songs into the cache.
+        """
+        with self._pending_lock:
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = {}
+
+        rows = []
+        for song_id, (song, updated) in pending.items():
+            song_json = song.to_json()
+            song_json['user'] = None
+            rows.append((self._api_name, song_id, json.dumps(song_json), updated))
+        try:
+            with _get_db().transaction() as db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO songCache(apiName, songId, songJson, updated) VALUES(?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logging.getLogger("musicbot").warning("Could not write %d songs to cache: %s", len(rows), e)
+            return
+
+        puts = self._puts
+        self._puts += len(rows)
+        if self._puts // self._prune_interval != puts // self._prune_interval:
+            self.prune()
+
+    def _disk_get(self, song_id):
+        if not self._ttl or not self._max_size:
+            return None
+        try:
+            row = _get_db().execute("SELECT songJson, updated FROM songCache WHERE apiName=? AND songId=?",
+                                    (self._api_name, song_id)).fetchone()
+        except sqlite3.Error as e:
+            logging.getLogger("musicbot").warning("Could not read song %s from cache: %s", song_id, e)
+            return None
+        if not row:
+            return None
+        song_json, updated = row
+        expired = time.time() - self._ttl
+        if updated < expired:
+            try:
+                with _get_db().transaction() as db:
+                    db.execute("DELETE FROM songCache WHERE apiName=? AND songId=? AND updated<?",
+                               (self._api_name, song_id, expired))
+            except sqlite3.Error as e:
+                logging.getLogger("musicbot").warning("Could not delete song %s from cache: %s", song_id, e)
+            return None
+        # Imported here to avoid a circular import, music_apis uses this module
+        from musicbot.music_apis import Song
+        try:
+            return Song.from_json(json.loads(song_json), self._apis)
+        except ValueError:
+            return None
+
+    def prune(self):
+        """
+        Delete expired songs from disk and shrink the disk tier to its maximum size.
+        """
+        api_name = self._api_name
+        try:
+            with _get_db().transaction() as db:
+                db.execute("DELETE FROM songCache WHERE apiName=? AND updated<?", (api_name, time.time() - self._ttl))
+                db.execute(
+                    "DELETE FROM songCache WHERE apiName=? AND songId IN (SELECT songId FROM songCache WHERE apiName=? ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                    (api_name, api_name, self._max_size))
+        except sqlite3.Error as e:
+            logging.getLogger("musicbot").warning("Could not prune song cache for %s: %s", api_name, e)
+
+    def clear(self):
+        """
+        Remove all songs of the cached API from both tiers.
+        """
+        with self._memory_lock:
+            self._memory.clear()
+        with self._pending_lock:
+            self._pending.clear()
+        with _get_db().transaction() as db:
+            db.execute("DELETE FROM songCache WHERE apiName=?", [self._api_name])
+
+    def get_stats(self):
+        """
+        Return a dict containing the hits, misses and hit ratio of each tier.
+        """
+
+        def _tier_stats(hits, misses):
+            lookups = hits + misses
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / lookups if lookups else 0.0
+            }
+
+        return {
+            "memory": _tier_stats(self._memory_hits, self._memory_misses),
+            "disk": _tier_stats(self._disk_hits, self._disk_misses)
+        }
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import deque
+
+
+class StateLog(object):
+    """
+    A versioned ring buffer of state change events.
+
+    Every event gets the next version number. Clients which know the version of their state can ask for the events
+    they missed, as long as those are still in the buffer. Otherwise they have to fetch the full state again.
+
+    The lock has to be held while changing the state and appending the corresponding event,
+    so a snapshot of the state always matches the version it is taken at.
+    """
+
+    def __init__(self, max_len=256, start_version=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        max_len -- the number of events kept for clients resuming from an older version
+        start_version -- the version before the first event. Defaults to the current time in milliseconds,
+                         so versions known by clients from before a restart are older than all new ones.
+        """
+        self.lock = threading.RLock()
+        if start_version is None:
+            start_version = int(time.time() * 1000)
+        self._version = start_version
+        # (version, event) tuples, the newest last
+        self._events = deque(maxlen=max_len)
+        self._listeners = []
+
+    def get_version(self):
+        return self._version
+
+    def append(self, event_type, **data):
+        """
+        Append an event and notify all listeners.
+        :param event_type: the event type, e.g. 'queue_add'
+        :param data: the event data, must be JSON serializable
+        :return: the new version
+        """
+        data['type'] = event_type
+        with self.lock:
+            self._version += 1
+            version = self._version
+            data['version'] = version
+            self._events.append((version, data))
+            for listener in self._listeners:
+                listener(version, data)
+        return version
+
+    def get_since(self, version):
+        """
+        Get the events after a version.
+        :param version: the version the client knows
+        :return: a list of (version, event) tuples, the oldest first,
+                 or None if the version is unknown or the events have already been dropped from the buffer
+        """
+        with self.lock:
+            if version == self._version:
+                return []
+            if version > self._version or not self._events or version < self._events[0][0] - 1:
+                return None
+            return [event for event in self._events if event[0] > version]
+
+    def snapshot(self, fn):
+        """
+        Call a function while no state changes can happen.
+        :param fn: a function without arguments returning the state
+        :return: a (version, state) tuple
+        """
+        with self.lock:
+            return self._version, fn()
+
+    def add_listener(self, listener):
+        """
+        Add a listener which is called with (version, event) for every new event.
+        It is called while the lock is held, so it should return quickly.
+        """
+        with self.lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            try:
+                self._listeners.remove(listener)
+            except ValueError:
+                pass
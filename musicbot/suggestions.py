@@ -0,0 +1,353 @@
+import random
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+
+class SuggestionPool(object):
+    """
+    An ordered pool of suggested songs used by AbstractSongProvider implementations.
+
+    Songs are indexed by their song_id, so membership tests, removal and popping the first song are O(1).
+    Songs which have been played recently are rejected when they are added to the pool.
+    """
+
+    def __init__(self, recent_size=50):
+        """
+        Constructor
+
+        Keyword arguments:
+        recent_size -- the number of recently played song IDs to remember for deduplication
+        """
+        self._songs = OrderedDict()
+        self._recent_ids = OrderedDict()
+        self._recent_size = max(0, recent_size)
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._rejected = 0
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __bool__(self):
+        return bool(self._songs)
+
+    def __contains__(self, song):
+        return self._get_id(song) in self._songs
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._songs.values()))
+
+    @staticmethod
+    def _get_id(song):
+        if isinstance(song, str):
+            return song
+        return song.song_id
+
+    def append(self, song, ignore_recent=False) -> bool:
+        """
+        Append a song to the end of the pool.
+        :param song: the song to append
+        :param ignore_recent: add the song even if it has been played recently
+        :return: whether the song has been added
+        """
+        song_id = song.song_id
+        with self._lock:
+            if song_id in self._songs or (not ignore_recent and song_id in self._recent_ids):
+                self._rejected += 1
+                return False
+            self._songs[song_id] = song
+            return True
+
+    def extend(self, songs) -> int:
+        """
+        Append all given songs which are neither in the pool nor recently played.
+        :param songs: an iterable of songs
+        :return: the number of added songs
+        """
+        added = 0
+        for song in songs:
+            if self.append(song):
+                added += 1
+        return added
+
+    def pop(self):
+        """
+        Remove and return the first song of the pool.
+        :return: the first song
+        :raises IndexError: if the pool is empty
+        """
+        with self._lock:
+            try:
+                return self._songs.popitem(last=False)[1]
+            except KeyError:
+                raise IndexError("pop from empty SuggestionPool")
+
+    def remove(self, song) -> bool:
+        """
+        Remove a song from the pool. If the song is not in the pool, nothing happens.
+        :param song: a song or song ID
+        :return: whether the song has been in the pool
+        """
+        with self._lock:
+            return self._songs.pop(self._get_id(song), None) is not None
+
+    def peek(self, max_len):
+        """
+        Return a list of up to max_len songs from the front of the pool without removing them.
+        """
+        with self._lock:
+            return list(islice(self._songs.values(), max_len))
+
+    def peek_last(self):
+        """
+        Return the last song of the pool without removing it, or None if the pool is empty.
+        """
+        with self._lock:
+            if not self._songs:
+                return None
+            return self._songs[next(reversed(self._songs))]
+
+    def is_stocked(self, min_len) -> bool:
+        """
+        Check whether the pool contains at least min_len songs. Counts as a hit or a miss.
+        """
+        with self._lock:
+            if len(self._songs) >= min_len:
+                self._hits += 1
+                return True
+            self._misses += 1
+            return False
+
+    def add_played(self, song):
+        """
+        Remember a song as recently played and remove it from the pool.
+        :param song: a song or song ID
+        """
+        song_id = self._get_id(song)
+        with self._lock:
+            self._songs.pop(song_id, None)
+            if not self._recent_size:
+                return
+            recent_ids = self._recent_ids
+            recent_ids.pop(song_id, None)
+            recent_ids[song_id] = None
+            while len(recent_ids) > self._recent_size:
+                recent_ids.popitem(last=False)
+
+    def was_played_recently(self, song) -> bool:
+        return self._get_id(song) in self._recent_ids
+
+    def get_recent_ids(self):
+        """
+        Return a list of recently played song IDs, the oldest first.
+        """
+        with self._lock:
+            return list(self._recent_ids)
+
+    def clear(self):
+        """
+        Remove all songs from the pool. Recently played song IDs are kept.
+        """
+        with self._lock:
+            self._songs.clear()
+
+    def reset(self):
+        """
+        Remove all songs and forget all recently played song IDs.
+        """
+        with self._lock:
+            self._songs.clear()
+            self._recent_ids.clear()
+
+    def get_stats(self):
+        """
+        Return a dict containing the pool size, hits, misses, hit ratio and the number of rejected songs.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._songs),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+                "rejected": self._rejected
+            }
+
+
+class ShuffleBag(object):
+    """
+    Draws items in random order without replacement until the bag is empty, then refills it.
+
+    A draw is O(1). Refilling the bag is O(n) or O(n log n) if there are weighted items.
+    Items can be added and removed in O(1) while the bag is in use.
+    An item is not drawn again until at least no_repeat other items have been drawn,
+    unless the bag contains too few items to make this possible.
+    """
+
+    def __init__(self, items=(), no_repeat=0, weights=None, rng=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        items -- the initial items (must be hashable)
+        no_repeat -- the minimum number of draws before an item can be drawn again
+        weights -- an optional dict from items to positive weights (default weight is 1)
+        rng -- a random.Random instance
+        """
+        self._rng = rng or random.Random()
+        self._weights = {}
+        self._no_repeat = max(0, no_repeat)
+        # The remaining items, the next one to draw is at the end
+        self._bag = []
+        self._positions = {}
+        self._recent = OrderedDict()
+        self._lock = threading.RLock()
+        weights = weights or {}
+        for item in items:
+            self._weights[item] = weights.get(item, 1)
+
+    def __len__(self):
+        return len(self._weights)
+
+    def __contains__(self, item):
+        return item in self._weights
+
+    def _window(self):
+        # Never keep every item out of the bag
+        return min(self._no_repeat, len(self._weights) - 1)
+
+    def _swap(self, i, j):
+        bag = self._bag
+        positions = self._positions
+        bag[i], bag[j] = bag[j], bag[i]
+        positions[bag[i]] = i
+        positions[bag[j]] = j
+
+    def _refill(self):
+        rng = self._rng
+        weights = self._weights
+        items = list(weights)
+        if any(weight != 1 for weight in weights.values()):
+            # Weighted random order (Efraimidis-Spirakis), the heaviest keys end up at the end
+            items.sort(key=lambda item: rng.random() ** (1.0 / weights[item]))
+        else:
+            rng.shuffle(items)
+        self._bag = items
+        self._positions = {item: index for index, item in enumerate(items)}
+        self._push_back_recent()
+
+    def _push_back_recent(self):
+        """
+        Move recently drawn items out of the next window draws.
+        """
+        window = self._window()
+        bag = self._bag
+        if window <= 0 or len(bag) <= window:
+            return
+        limit = len(bag) - window
+        recent = set(list(self._recent)[-window:])
+        candidates = [index for index in range(limit) if bag[index] not in recent]
+        randrange = self._rng.randrange
+        for index in range(limit, len(bag)):
+            if bag[index] in recent and candidates:
+                candidate_index = randrange(len(candidates))
+                candidates[candidate_index], candidates[-1] = candidates[-1], candidates[candidate_index]
+                self._swap(index, candidates.pop())
+
+    def _move_before(self, index, limit):
+        """
+        Swap the item at index with a random item in front of limit, preferring items which weren't drawn recently.
+        """
+        randrange = self._rng.randrange
+        target = randrange(limit)
+        for _ in range(8):
+            if self._bag[target] not in self._recent:
+                break
+            target = randrange(limit)
+        self._swap(index, target)
+
+    def _remember(self, item):
+        recent = self._recent
+        recent.pop(item, None)
+        recent[item] = None
+        while len(recent) > self._no_repeat:
+            recent.popitem(last=False)
+
+    def draw(self):
+        """
+        Draw the next item.
+        :return: an item
+        :raises IndexError: if the bag contains no items
+        """
+        with self._lock:
+            if not self._weights:
+                raise IndexError("draw from empty ShuffleBag")
+            if not self._bag:
+                self._refill()
+            item = self._bag.pop()
+            del self._positions[item]
+            self._remember(item)
+            return item
+
+    def add(self, item, weight=1):
+        """
+        Add an item and put it at a random position in the bag. If the item is already present, update its weight.
+        """
+        with self._lock:
+            if item in self._weights:
+                self._weights[item] = weight
+                return
+            self._weights[item] = weight
+            bag = self._bag
+            bag.append(item)
+            self._positions[item] = len(bag) - 1
+            self._swap(len(bag) - 1, self._rng.randrange(len(bag)))
+
+    def remove(self, item):
+        """
+        Remove an item. If the item is not present, nothing happens.
+        """
+        with self._lock:
+            if self._weights.pop(item, None) is None:
+                return
+            self._recent.pop(item, None)
+            index = self._positions.pop(item, None)
+            if index is None:
+                return
+            bag = self._bag
+            last = bag.pop()
+            if last != item:
+                bag[index] = last
+                self._positions[last] = index
+
+    def add_played(self, item):
+        """
+        Treat an item as drawn, without removing it from the bag, so it won't be drawn again too soon.
+        """
+        with self._lock:
+            if item not in self._weights:
+                return
+            self._remember(item)
+            window = self._window()
+            index = self._positions.get(item)
+            limit = len(self._bag) - window
+            if index is not None and window > 0 and limit > 0 and index >= limit:
+                self._move_before(index, limit)
+
+    def set_weight(self, item, weight):
+        """
+        Change the weight of an item. Takes effect after the next refill.
+        """
+        with self._lock:
+            if item in self._weights:
+                self._weights[item] = weight
+
+    def clear(self):
+        with self._lock:
+            self._weights.clear()
+            self._bag = []
+            self._positions.clear()
+            self._recent.clear()
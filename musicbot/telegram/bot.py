@@ -4,7 +4,6 @@ import sys
 import time
 
 import telegram
-from pylru import lrucache
 from telegram.ext import dispatcher
 from telegram.ext import updater
 from telegram.ext.callbackqueryhandler import CallbackQueryHandler
@@ -21,6 +20,7 @@ from telegram.replykeyboardmarkup import ReplyKeyboardMarkup
 from musicbot import async_handler
 from musicbot import config
 from musicbot import music_apis
+from musicbot.search_cache import SearchCache, QueryDebouncer
 from musicbot.telegram import decorators, notifier
 from musicbot.telegram.user import User
 
@@ -42,10 +42,13 @@ _password = None
 
 
 class TelegramBot(notifier.Subscribable):
-    def __init__(self, plugins, music_api, song_provider, player):
+    def __init__(self, plugins, music_api, song_provider, player, search_cache=None):
         self._music_api = music_api
         self._song_provider = song_provider
         self._player = player
+        if search_cache is None:
+            search_cache = SearchCache(config.get_search_cache_size(), config.get_search_cache_ttl())
+        self._search_cache = search_cache
         self._sent_keyboard = {}
         self._sent_keyboard_message_ids = {}
 
@@ -336,9 +339,8 @@ class TelegramBot(notifier.Subscribable):
             self.current_song_command(bot, update)
 
     def get_inline_query_handler(self):
-        generators_cache = lrucache(256)
-        lists_cache = lrucache(256)
         max_len = 20
+        debouncer = QueryDebouncer(config.get_inline_query_delay())
 
         def _get_inline_result_article(song):
             title = song.title
@@ -370,41 +372,38 @@ class TelegramBot(notifier.Subscribable):
             if not self.is_logged_in(update.inline_query.from_user):
                 return
 
+            user_id = update.inline_query.from_user.id
+            ticket = debouncer.start(user_id)
+            try:
+                _answer(bot, update, user_id, ticket)
+            finally:
+                debouncer.finish(user_id, ticket)
+
+        def _answer(bot, update, user_id, ticket):
             offset = update.inline_query.offset
             if offset:
                 offset = int(offset)
             else:
                 offset = 0
+
+            # Telegram sends a query for almost every key stroke, wait for the user to stop typing
+            if not offset and not debouncer.wait(user_id, ticket):
+                return
+
+            def _cancelled():
+                return not debouncer.is_current(user_id, ticket)
+
             query = update.inline_query.query
             api = self._music_api
 
             suggest = config.get_suggest_songs_enabled() and isinstance(api, music_apis.AbstractSongProvider)
             if query and query.strip():
-                query = query.strip()
-                try:
-                    song_generator = generators_cache[query]
-                except KeyError:
-                    song_generator = api.search_song(query)
-                    generators_cache[query] = song_generator
-                    lists_cache[query] = []
-
-                song_list = lists_cache[query]
-                song_list_len = len(song_list)
-
-                next_offset = offset + max_len
-                while next_offset >= song_list_len:
-                    try:
-                        song_list.append(song_generator.__next__())
-                        song_list_len += 1
-                    except StopIteration:
-                        next_offset = 0
-                        break
+                song_list, next_offset = self._search_cache.get_page(api, query, offset, max_len, _cancelled)
+                if next_offset is None:
+                    next_offset = 0
 
                 # set server-side caching time to default (300 seconds)
                 cache_time = 300
-
-                song_list = song_list[offset:]
-                song_list = song_list[:max_len]
             elif suggest and not offset:
                 song_list = api.get_suggestions(max_len=15)
                 cache_time = 20
@@ -425,6 +424,10 @@ class TelegramBot(notifier.Subscribable):
 
             song_list = filter(_seen_add, song_list)
 
+            # The user has typed more in the meantime, the answer would be discarded anyway
+            if _cancelled():
+                return
+
             results = list(map(_get_inline_result_article, song_list))
             bot.answerInlineQuery(update.inline_query.id, results, cache_time=cache_time, next_offset=next_offset)
 
@@ -0,0 +1,97 @@
+import os
+import unittest
+from io import BytesIO
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot import album_art
+from musicbot.album_art import AlbumArtStore, detect_format
+from musicbot.database import ConnectionManager
+from musicbot.music_apis import _offline_db_migrations
+from musicbot.testing import TempDirTest
+
+if test_logger:
+    pass
+
+
+def _create_image(image_format, size=500):
+    image = album_art.Image.new("RGB", (size, size), (255, 0, 0))
+    out = BytesIO()
+    image.save(out, image_format)
+    return out.getvalue()
+
+
+class TestAlbumArtStore(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = ConnectionManager(os.path.join(self.tmp, "offline.db"))
+        self.db.migrate(_offline_db_migrations)
+        self.store = AlbumArtStore(self.db, os.path.join(self.tmp, "album_art"), sizes=[64, 128])
+
+    def tearDown(self):
+        self.store.close()
+        self.db.close_all()
+        super().tearDown()
+
+    def _add(self, song_id, data):
+        with self.db.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO albumArts(songId, albumArt) VALUES(?, ?)", [song_id, data])
+
+    def test_detect_format(self):
+        self.assertEqual("image/jpeg", detect_format(b"\xff\xd8\xff\xe0abc")[0])
+        self.assertEqual("image/png", detect_format(b"\x89PNG\r\n\x1a\nabc")[0])
+        self.assertIsNone(detect_format(b"abc"))
+
+    def test_get(self):
+        data = b"\xff\xd8\xff\xe0not really a jpeg"
+        self._add("a", data)
+        self._add("b", data)
+        self._add("broken", b"no image")
+
+        art = self.store.get("a")
+        self.assertEqual("image/jpeg", art.mime_type)
+        with open(art.path, "rb") as art_file:
+            self.assertEqual(data, art_file.read())
+        # Songs with the same album art share a file
+        self.assertEqual(art.path, self.store.get("b").path)
+        self.assertIsNone(self.store.get("broken"))
+        self.assertIsNone(self.store.get("missing"))
+
+        # Served from the index without reading the database
+        with self.db.transaction() as db:
+            db.execute("DELETE FROM albumArts")
+        self.assertEqual(art.path, self.store.get("a").path)
+        self.assertEqual(art.path, self.store.get_by_hash(art.content_hash).path)
+        self.assertIsNone(self.store.get_by_hash("../" + art.content_hash))
+
+        self.store.forget(["a"])
+        self.assertIsNone(self.store.get("a"))
+
+    @unittest.skipIf(album_art.Image is None, "Pillow is not installed")
+    def test_thumbnails(self):
+        self._add("jpeg", _create_image("JPEG"))
+        self._add("png", _create_image("PNG", 100))
+        self.assertEqual(2, self.store.extract_all())
+        self.assertEqual(0, self.store.extract_all())
+
+        art = self.store.get("jpeg", 100)
+        self.assertEqual(128, art.size)
+        with album_art.Image.open(art.path) as image:
+            self.assertEqual("JPEG", image.format)
+            self.assertEqual((128, 128), image.size)
+        self.assertEqual(64, self.store.get("jpeg", 1).size)
+        self.assertIsNone(self.store.get("jpeg", 1000).size)
+        self.assertIsNone(self.store.get("jpeg").size)
+
+        art = self.store.get("png", 64)
+        self.assertEqual("image/png", art.mime_type)
+        with album_art.Image.open(art.path) as image:
+            self.assertEqual("PNG", image.format)
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.bulk_download import BulkDownload
+from musicbot.music_apis import Song
+from musicbot.testing import StubAPI, TempDirTest
+
+if test_logger:
+    pass
+
+
+class TestBulkDownload(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = StubAPI()
+        self.loads = {}
+        self.failures = {"flaky": 2, "broken": 100}
+
+    def _lookup(self, song_id):
+        if song_id == "missing":
+            return None
+        song = Song(song_id, self.api)
+
+        def _load():
+            self.loads[song_id] = self.loads.get(song_id, 0) + 1
+            if self.loads[song_id] <= self.failures.get(song_id, 0):
+                raise IOError("download failed")
+            fname = os.path.join(self.tmp, song_id + ".mp3")
+            with open(fname, "wb") as song_file:
+                song_file.write(b"0" * 100)
+            return fname
+
+        song.load = _load
+        return song
+
+    def _download(self):
+        return BulkDownload("test", max_attempts=3, backoff=0.001, manifest_path=os.path.join(self.tmp, "m.db"))
+
+    def test_retry(self):
+        summary = self._download().run(["a", "flaky", "broken", "missing"], self._lookup)
+        self.assertEqual(4, summary['total'])
+        self.assertEqual(2, summary['done'])
+        self.assertEqual(2, summary['failed'])
+        self.assertEqual(200, summary['bytes'])
+        self.assertEqual(3, self.loads['flaky'])
+        self.assertEqual(3, self.loads['broken'])
+
+    def test_resume(self):
+        self._download().run(["a", "broken"], self._lookup)
+        self.loads.clear()
+        download = self._download()
+        summary = download.run(["a", "broken", "b"], self._lookup)
+        self.assertEqual(1, summary['skipped'])
+        self.assertNotIn("a", self.loads)
+        self.assertEqual({"done": 2, "failed": 1}, download.get_status())
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import threading
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.database import ConnectionManager
+from musicbot.testing import TempDirTest
+
+if test_logger:
+    pass
+
+
+def _create_table(db):
+    db.execute("CREATE TABLE items(id INTEGER PRIMARY KEY, name TEXT)")
+
+
+def _add_column(db):
+    db.execute("ALTER TABLE items ADD COLUMN size INTEGER")
+
+
+class TestConnectionManager(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = ConnectionManager(os.path.join(self.tmp, "test.db"))
+
+    def tearDown(self):
+        self.db.close_all()
+        super().tearDown()
+
+    def test_thread_local(self):
+        connection = self.db.get_connection()
+        self.assertIs(connection, self.db.get_connection())
+        self.assertEqual("wal", connection.execute("PRAGMA journal_mode").fetchone()[0])
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.db.get_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connection, other[0])
+
+        # Closed connections are replaced on the next access
+        self.db.close_all()
+        new_connection = self.db.get_connection()
+        self.assertIsNot(connection, new_connection)
+        self.assertEqual(1, new_connection.execute("SELECT 1").fetchone()[0])
+
+    def test_transaction(self):
+        self.db.migrate([_create_table])
+        with self.db.transaction() as db:
+            db.execute("INSERT INTO items(name) VALUES('a')")
+        with self.assertRaises(ValueError):
+            with self.db.transaction() as db:
+                db.execute("INSERT INTO items(name) VALUES('b')")
+                raise ValueError()
+
+        # Committed rows are visible to other threads, rolled back ones aren't
+        names = []
+        thread = threading.Thread(
+            target=lambda: names.extend(name for (name,) in self.db.execute("SELECT name FROM items")))
+        thread.start()
+        thread.join()
+        self.assertEqual(["a"], names)
+
+    def test_migrate(self):
+        self.assertEqual(0, self.db.get_schema_version())
+        self.assertEqual(1, self.db.migrate([_create_table]))
+        self.assertEqual(2, self.db.migrate([_create_table, _add_column]))
+        # Applied migrations are skipped
+        self.assertEqual(2, self.db.migrate([_create_table, _add_column]))
+        with self.db.transaction() as db:
+            db.execute("INSERT INTO items(name, size) VALUES('a', 1)")
+
+        def _fail(db):
+            db.execute("CREATE TABLE other(id INTEGER)")
+            raise ValueError()
+
+        # A failing migration is rolled back completely
+        self.assertRaises(ValueError, self.db.migrate, [_create_table, _add_column, _fail])
+        self.assertEqual(2, self.db.get_schema_version())
+        self.assertIsNone(self.db.execute("SELECT name FROM sqlite_master WHERE name='other'").fetchone())
+
+    def test_stats(self):
+        self.db.migrate([_create_table])
+        with self.db.transaction() as db:
+            db.executemany("INSERT INTO items(name) VALUES(?)", [(str(i),) for i in range(100)])
+        query = "SELECT name FROM items"
+        cursor = self.db.execute(query)
+        executed = self.db.get_stats()[query]['total_ms']
+        self.assertEqual(100, len(list(cursor)))
+        self.assertEqual(1, len(self.db.execute(query).fetchmany(1)))
+        self.assertEqual(100, len(self.db.execute(query).fetchall()))
+
+        stats = self.db.get_stats()[query]
+        self.assertEqual(3, stats['count'])
+        # Fetching the rows is included
+        self.assertGreater(stats['total_ms'], executed)
+        self.assertGreaterEqual(stats['total_ms'], stats['max_ms'])
+        self.assertEqual(stats['total_ms'] / 3, stats['avg_ms'])
+        self.assertRaises(Exception, self.db.execute, "SELECT nothing FROM nowhere")
+        self.assertEqual(1, self.db.get_stats()["SELECT nothing FROM nowhere"]['count'])
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot import config
+from musicbot.federated_search import FederatedSearch, ResultMerger, STATUS_OK, STATUS_ERROR, STATUS_TIMEOUT
+from musicbot.music_apis import Song, AbstractAPI
+
+if test_logger:
+    pass
+
+
+class _TestAPI(AbstractAPI):
+    def __init__(self, name, titles, delay=0.0, fail=False):
+        self._name = name
+        self._titles = titles
+        self._delay = delay
+        self._fail = fail
+        self.searched = False
+
+    def get_name(self):
+        return self._name
+
+    def search_song(self, query, max_fetch=50):
+        self.searched = True
+        time.sleep(self._delay)
+        if self._fail:
+            raise IOError("search failed")
+        for i, title in enumerate(self._titles):
+            yield Song("{}{}".format(self._name, i), self, title=title, description="artist")
+
+
+class TestFederatedSearch(unittest.TestCase):
+    def setUp(self):
+        self._old_deadlines = config._config.get("search_deadline")
+        config._config["search_deadline"] = {"slow": 0.2}
+
+    def tearDown(self):
+        if self._old_deadlines is None:
+            config._config.pop("search_deadline", None)
+        else:
+            config._config["search_deadline"] = self._old_deadlines
+
+    def test_merger(self):
+        merger = ResultMerger(["a", "b"])
+        api = _TestAPI("a", [])
+        a_songs = [Song("1", api, title="One", description="X"), Song("2", api, title="Two", description="X")]
+        b_songs = [Song("3", api, title="one ", description="x"), Song("4", api, title="Four", description="X")]
+        self.assertEqual(a_songs, merger.add("a", a_songs))
+        self.assertEqual([b_songs[1]], merger.add("b", b_songs))
+        self.assertEqual([a_songs[0], b_songs[1], a_songs[1]], merger.get_merged())
+        self.assertEqual(2, len(merger.get_merged(2)))
+
+    def test_search(self):
+        apis = [_TestAPI("fast", ["a", "b"], delay=0.05), _TestAPI("slow", ["c"], delay=1.0),
+                _TestAPI("broken", ["d"], fail=True), _TestAPI("other", ["b", "e"], delay=0.1)]
+        search = FederatedSearch(apis)
+        try:
+            start = time.perf_counter()
+            songs, results = search.search("query", max_fetch=10)
+            duration = time.perf_counter() - start
+        finally:
+            search.close()
+
+        self.assertLess(duration, 0.9)
+        statuses = {result.api_name: result.status for result in results}
+        self.assertEqual({"fast": STATUS_OK, "slow": STATUS_TIMEOUT, "broken": STATUS_ERROR, "other": STATUS_OK},
+                         statuses)
+        self.assertEqual(["a", "b", "e"], sorted(song.title for song in songs))
+        # Results arrive fastest first
+        self.assertEqual("broken", results[0].api_name)
+
+    def test_search_async(self):
+        apis = [_TestAPI("fast", ["a"], delay=0.05), _TestAPI("slow", ["c"], delay=1.0),
+                _TestAPI("broken", ["d"], fail=True)]
+        search = FederatedSearch(apis)
+
+        async def _collect():
+            return [result async for result in search.search_async_iter("query")]
+
+        try:
+            start = time.perf_counter()
+            results = asyncio.run(_collect())
+            duration = time.perf_counter() - start
+        finally:
+            search.close()
+
+        self.assertLess(duration, 0.9)
+        self.assertEqual([("broken", STATUS_ERROR), ("fast", STATUS_OK), ("slow", STATUS_TIMEOUT)],
+                         [(result.api_name, result.status) for result in results])
+        self.assertEqual(["a"], [song.title for song in results[1].songs])
+
+    def test_close_early(self):
+        queued = _TestAPI("queued", ["c"])
+        apis = [_TestAPI("fast", ["a"]), _TestAPI("blocking", ["b"], delay=0.2), queued]
+        search = FederatedSearch(apis, max_workers=1)
+
+        async def _first():
+            results = search.search_async_iter("query")
+            try:
+                return await results.__anext__()
+            finally:
+                await results.aclose()
+
+        try:
+            self.assertEqual("fast", asyncio.run(_first()).api_name)
+        finally:
+            search.close()
+        time.sleep(0.3)
+        # The search which was still waiting for a thread has been cancelled
+        self.assertFalse(queued.searched)
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
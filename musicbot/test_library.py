@@ -0,0 +1,110 @@
+import os
+import time
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot import config
+from musicbot.library import LibraryScanner
+from musicbot.test_music_apis import OfflineAPITest
+from musicbot.testing import write_mp3
+
+if test_logger:
+    pass
+
+
+class LibraryTest(OfflineAPITest):
+    def setUp(self):
+        super().setUp()
+        self._old_save_state = config._save_state
+        config._save_state = lambda: None
+        self.music = os.path.join(self.tmp, "music")
+        write_mp3(os.path.join(self.music, "a.mp3"), "Song A")
+        write_mp3(os.path.join(self.music, "b.mp3"), "Song B")
+        write_mp3(os.path.join(self.music, "sub", "c.mp3"), "Song C")
+        with open(os.path.join(self.music, "cover.jpg"), "wb") as other_file:
+            other_file.write(b"no song")
+        # A sibling directory whose path starts with the path of the scanned one
+        write_mp3(os.path.join(self.tmp, "music2", "d.mp3"), "Song D")
+        self.scanner = LibraryScanner(self.api, workers=2, use_processes=False)
+
+    def tearDown(self):
+        config._state.pop("active_offline_playlist", None)
+        config._save_state = self._old_save_state
+        super().tearDown()
+
+    def song_id(self, *path):
+        return os.path.join(self.music, *path)
+
+    def get_titles(self, playlist_id):
+        return sorted(title for (title,) in self.api._db.execute(
+            "SELECT title FROM songs JOIN playlistSongs ON songs.songId=playlistSongs.songId WHERE playlistId=?",
+            [playlist_id]))
+
+
+class TestLibraryScanner(LibraryTest, unittest.TestCase):
+    def test_scan(self):
+        other = self.scanner.add_directory(os.path.join(self.tmp, "music2"), "Other", recursive=True)
+        self.assertEqual(1, len(other['added_ids']))
+
+        result = self.scanner.add_directory(self.music, "Music", recursive=False)
+        self.assertEqual(2, result['files'])
+        self.assertEqual(2, result['parsed'])
+        self.assertEqual(["Song A", "Song B"], self.get_titles(self.music))
+        self.assertEqual([self.song_id("a"), self.song_id("b")], sorted(result['added_ids']))
+
+        # Unchanged files aren't parsed again
+        result = self.scanner.scan_directory(self.music)
+        self.assertEqual(0, result['parsed'])
+        self.assertEqual(([], [], []), (result['added_ids'], result['removed_ids'], result['updated_ids']))
+
+        write_mp3(os.path.join(self.music, "b.mp3"), "Song B2")
+        write_mp3(os.path.join(self.music, "e.mp3"), "Song E")
+        os.remove(os.path.join(self.music, "a.mp3"))
+        with open(os.path.join(self.music, "broken.mp3"), "wb") as broken_file:
+            broken_file.write(b"no mp3")
+        result = self.scanner.scan_directory(self.music)
+        self.assertEqual(2, result['parsed'])
+        self.assertEqual(1, result['failed'])
+        self.assertEqual(1, result['removed_files'])
+        self.assertEqual([self.song_id("e")], result['added_ids'])
+        self.assertEqual([self.song_id("a")], result['removed_ids'])
+        self.assertEqual([self.song_id("b")], result['updated_ids'])
+        self.assertEqual(["Song B2", "Song E"], self.get_titles(self.music))
+        self.assertEqual(["Song B2"], [song.title for song in self.api.search_song("b2")])
+        # The sibling directory isn't affected
+        self.assertEqual(["Song D"], self.get_titles(other['playlist_id']))
+
+    def test_single_write(self):
+        self.scanner.add_directory(self.music, "Music", recursive=True)
+        db = self.api._db
+        db.execute("CREATE TEMP TABLE songUpdates(songId TEXT)")
+        db.execute("CREATE TEMP TRIGGER songUpdatesLog AFTER UPDATE ON main.songs "
+                   "BEGIN INSERT INTO songUpdates VALUES(new.songId); END")
+        write_mp3(os.path.join(self.music, "e.mp3"), "Song E")
+        write_mp3(os.path.join(self.music, "a.mp3"), "Song A2")
+        self.scanner.scan_directory(self.music)
+        # New songs are only inserted, not updated right after
+        self.assertEqual([(self.song_id("a"),)], db.execute("SELECT songId FROM songUpdates").fetchall())
+
+    def test_album_art(self):
+        write_mp3(os.path.join(self.music, "a.mp3"), "Song A", album_art=b"cover")
+        self.scanner.add_directory(self.music, "Music", recursive=True)
+        self.assertEqual(b"cover", self.api.get_album_art(self.song_id("a")))
+
+        write_mp3(os.path.join(self.music, "a.mp3"), "Song A", album_art=b"new cover")
+        self.scanner.scan_directory(self.music)
+        self.assertEqual(b"new cover", self.api.get_album_art(self.song_id("a")))
+
+        # The album art has been removed from the file
+        write_mp3(os.path.join(self.music, "a.mp3"), "Song A")
+        self.scanner.scan_directory(self.music)
+        self.assertIsNone(self.api.get_album_art(self.song_id("a")))
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
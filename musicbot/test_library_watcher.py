@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.library import LibraryWatcher
+from musicbot.test_library import LibraryTest
+from musicbot.testing import write_mp3
+
+if test_logger:
+    pass
+
+
+class TestLibraryWatcher(LibraryTest, unittest.TestCase):
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(condition())
+
+    def _test_watch(self, poll):
+        self.scanner.add_directory(self.music, "Music", recursive=True)
+        self.api.set_active_playlist(self.music)
+        self.assertEqual("Song A", self.api.lookup_song(self.song_id("a")).title)
+
+        watcher = LibraryWatcher(self.api, delay=0.05, poll_interval=0.1)
+        if poll and watcher._inotify:
+            watcher._inotify.close()
+            watcher._inotify = None
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            self._wait_for(lambda: watcher._directories)
+            write_mp3(os.path.join(self.music, "sub", "e.mp3"), "Song E")
+            write_mp3(os.path.join(self.music, "a.mp3"), "Song A2")
+            os.remove(os.path.join(self.music, "b.mp3"))
+            write_mp3(os.path.join(self.tmp, "music2", "f.mp3"), "Song F")
+
+            self._wait_for(lambda: self.get_titles(self.music) == ["Song A2", "Song C", "Song E"])
+            playlist = self.api._active_playlist
+            self._wait_for(lambda: sorted(playlist.song_ids) == [
+                self.song_id("a"), self.song_id("sub", "c"), self.song_id("sub", "e")])
+        finally:
+            watcher.stop()
+            thread.join()
+        # The cached song has been dropped by apply_library_changes()
+        self.assertEqual("Song A2", self.api.lookup_song(self.song_id("a")).title)
+        self.assertIsNone(self.api._db.execute("SELECT songId FROM songs WHERE title='Song F'").fetchone())
+
+    def test_watch(self):
+        self._test_watch(False)
+
+    def test_poll(self):
+        self._test_watch(True)
+
+    def test_debounce(self):
+        self.scanner.add_directory(self.music, "Music", recursive=True)
+        watcher = LibraryWatcher(self.api, delay=1, max_delay=3)
+        watcher._refresh_directories()
+        rescanned = []
+        watcher._rescan = rescanned.append
+
+        watcher._mark_changed(self.music, 0)
+        watcher._flush(0.5)
+        self.assertEqual([], rescanned)
+        watcher._flush(1)
+        self.assertEqual([self.music], rescanned)
+
+        # Continuous changes are rescanned after max_delay
+        for now in [10, 10.8, 11.6, 12.4]:
+            watcher._mark_changed(self.music, now)
+            watcher._flush(now)
+        self.assertEqual([self.music], rescanned)
+        watcher._mark_changed(self.music, 13)
+        watcher._flush(13)
+        self.assertEqual([self.music, self.music], rescanned)
+
+        # Changes of unknown directories are dropped
+        watcher._mark_changed(os.path.join(self.tmp, "music2"), 20)
+        watcher._flush(20, force=True)
+        self.assertEqual([self.music, self.music], rescanned)
+        if watcher._inotify:
+            watcher._inotify.close()
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -1,5 +1,9 @@
+import json
 import logging
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 from _collections_abc import Iterable
 
@@ -8,7 +12,10 @@ import _version
 _version.debug = True
 
 import test_logger
-from musicbot.music_apis import Song, GMusicAPI, YouTubeAPI, SoundCloudAPI, AbstractAPI
+from musicbot import config, music_apis, song_cache
+from musicbot.music_apis import Song, GMusicAPI, YouTubeAPI, SoundCloudAPI, AbstractAPI, OfflineAPI, songs_to_json
+from musicbot.search_cache import SearchCache
+from musicbot.testing import TempDirTest, write_mp3
 
 if test_logger:
     pass
@@ -66,6 +73,15 @@ class TestSong(unittest.TestCase):
         for song in self._create_test_songs():
             self.assertEqual(song, Song.from_json(song.to_json(), {"testapi": TestSong._TestAPI()}))
 
+    def test_json_fragment(self):
+        song = Song("testid", TestSong._TestAPI(), title="title", user="a")
+        self.assertEqual(song.to_json(), json.loads(song.to_json_fragment()))
+        song.user = "b"
+        self.assertEqual("b", json.loads(song.to_json_fragment())['user'])
+        songs = self._create_test_songs()
+        self.assertEqual([song.to_json() for song in songs], json.loads(songs_to_json(songs)))
+        self.assertEqual("[]", songs_to_json([]))
+
 
 class APITest(object):
     def test_search_song(self):
@@ -190,6 +206,351 @@ class TestSoundCloudAPI(unittest.TestCase, APITest):
         os.rmdir("songs")
 
 
+class _TestMobileclient(object):
+    """
+    Serves a remote playlist whose tracks are only known by their IDs.
+    """
+
+    def __init__(self, song_ids):
+        self.tracks = [{"id": "entry_" + song_id, "trackId": song_id} for song_id in song_ids]
+        self.looked_up = []
+        self.removed = []
+        # Called with the song ID before a track info is returned
+        self.on_lookup = None
+
+    def get_all_user_playlist_contents(self):
+        return [{"id": "playlist", "tracks": self.tracks}]
+
+    def get_track_info(self, song_id):
+        self.looked_up.append(song_id)
+        if self.on_lookup:
+            self.on_lookup(song_id)
+        return {"id": song_id, "title": "Title " + song_id, "artist": "Artist", "durationMillis": "180000"}
+
+    def add_songs_to_playlist(self, playlist_id, song_id):
+        self.tracks.append({"id": "entry_" + song_id, "trackId": song_id})
+
+    def remove_entries_from_playlist(self, entry_id):
+        self.removed.append(entry_id)
+
+
+class TestGMusicPlaylist(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._old_client = GMusicAPI._api
+        self._old_songs_path = music_apis._songs_path
+        self._old_song_cache = (song_cache._db_path, song_cache._db)
+        self._old_state = dict(config._state)
+        music_apis._songs_path = self.tmp
+        song_cache._db_path = os.path.join(self.tmp, "song_cache.db")
+        song_cache._db = None
+        # The playlist and station already exist
+        config._state.update({"playlist_token": "token", "playlist_id": "playlist", "station_id": "station"})
+        write_mp3(os.path.join(self.tmp, "a.mp3"), "Song A", "Artist A", album="http://art/a")
+        self.client = _TestMobileclient(["a", "b", "c", "d", "e"])
+        GMusicAPI._api = self.client
+
+    def tearDown(self):
+        GMusicAPI._api = self._old_client
+        music_apis._songs_path = self._old_songs_path
+        if song_cache._db:
+            song_cache._db.close_all()
+        song_cache._db_path, song_cache._db = self._old_song_cache
+        config._state.clear()
+        config._state.update(self._old_state)
+        super().tearDown()
+
+    def _create_api(self):
+        api = GMusicAPI()
+        api._hydration_batch_size = 2
+        flushes = []
+        flush = api._songs.flush
+        api._songs.flush = lambda: flushes.append(len(api._songs._pending)) or flush()
+        return api, flushes
+
+    def test_hydrate(self):
+        api, flushes = self._create_api()
+        # Nothing is looked up until the playlist is requested
+        self.assertEqual([], self.client.looked_up)
+        self.assertEqual({"a", "b", "c", "d", "e"}, set(api._playlist))
+
+        songs = {song.song_id: song for song in api.get_playlist()}
+        self.assertEqual(["a", "b", "c", "d", "e"], sorted(songs))
+        # The downloaded song is read from its tags, the others are looked up in batches
+        song = songs['a']
+        self.assertEqual(("Song A", "Artist A", "http://art/a", "Artist A - Song A (00:01)", "00:01"),
+                         (song.title, song.description, song.albumArtUrl, str(song), song.duration))
+        self.assertEqual(["b", "c", "d", "e"], sorted(self.client.looked_up))
+        self.assertEqual("Title b", songs['b'].title)
+        # The songs of each batch are written to the song cache at once
+        self.assertEqual([3, 2, 0], flushes)
+
+        api.get_playlist()
+        self.assertEqual(4, len(self.client.looked_up))
+        # A new instance finds the songs in the song cache
+        api, _ = self._create_api()
+        self.assertEqual(5, len(api.get_playlist()))
+        self.assertEqual(4, len(self.client.looked_up))
+
+    def test_change_during_hydration(self):
+        api, _ = self._create_api()
+
+        def _on_lookup(song_id):
+            if song_id == "b":
+                api.remove_from_playlist(Song("b", api))
+            elif song_id == "c":
+                api.add_played(Song("f", api, "Song F", "Artist"))
+
+        self.client.on_lookup = _on_lookup
+        songs = api.get_playlist()
+        # The removed song doesn't come back when its lookup finishes
+        self.assertEqual(["a", "c", "d", "e", "f"], sorted(song.song_id for song in songs))
+        self.assertNotIn("b", api._playlist)
+        self.assertEqual(["entry_b"], self.client.removed)
+        self.assertEqual("Song F", api._playlist['f'].title)
+
+
+class OfflineAPITest(object):
+    """
+    Creates an OfflineAPI with its database in a temporary songs directory.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._old_songs_path = music_apis._songs_path
+        self._old_playlist = config._state.pop("active_offline_playlist", None)
+        music_apis._songs_path = self.tmp
+        open(os.path.join(self.tmp, "Tj6fhurtstzgdpvfm4xv6i5cei4.mp3"), "wb").close()
+        self.api = OfflineAPI()
+
+    def tearDown(self):
+        self.api._db.close_all()
+        music_apis._songs_path = self._old_songs_path
+        if self._old_playlist is not None:
+            config._state["active_offline_playlist"] = self._old_playlist
+        shutil.rmtree(self.tmp)
+
+    def add_songs(self, songs):
+        """
+        :param songs: a list of (song_id, title, description) tuples
+        """
+        with self.api._db.transaction() as db:
+            db.executemany(OfflineAPI._insert_song_query,
+                           [(song_id, title, description, None, None, os.path.join(self.tmp, song_id), None, None)
+                            for song_id, title, description in songs])
+
+
+class TestOfflineMigration(OfflineAPITest, unittest.TestCase):
+    def _reopen(self, create):
+        """
+        Replace the database of the OfflineAPI with one created by an older version and open it again.
+        :param create: a function creating the old database, given an sqlite3 connection
+        """
+        self.api._db.close_all()
+        db_path = self.api._db_path
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.isfile(db_path + suffix):
+                os.remove(db_path + suffix)
+        connection = sqlite3.connect(db_path)
+        create(connection)
+        connection.commit()
+        connection.close()
+        self.api = OfflineAPI()
+
+    def _create_baseline(self, connection):
+        # The schema before versioning, without an explicit row ID
+        music = os.path.join(self.tmp, "music")
+        os.makedirs(music)
+        music_apis._offline_db_v1(connection)
+        songs = [("a", "Song A", "Artist", "Artist - Song A (03:00)", "03:00", os.path.join(music, "a.mp3")),
+                 ("b", "Song B", "Artist", "Artist - Song B", "01:02:03", os.path.join(music, "b.mp3")),
+                 ("c", "Song C", "Artist", "Artist - Song C (00:30)", "invalid", os.path.join(music, "sub", "c.mp3"))]
+        connection.executemany(
+            "INSERT INTO songs(songId, title, description, stringRep, duration, path) VALUES(?, ?, ?, ?, ?, ?)",
+            songs)
+        connection.execute("DELETE FROM songs WHERE songId='b'")
+        connection.execute("INSERT INTO songs(songId, title, path) VALUES('d', 'Song D', 'd.mp3')")
+        connection.executemany("INSERT INTO playlists(playlistId, name) VALUES(?, ?)",
+                               [("123", "Numeric"), (music, "Music")])
+        # Numeric-looking playlist IDs were stored as integers
+        connection.executemany("INSERT INTO playlistSongs(playlistId, songId) VALUES(?, ?)",
+                               [("123", "a"), ("123", "d"), (music, "a"), (music, "c")])
+        return music
+
+    def test_upgrade_baseline(self):
+        music = []
+        self._reopen(lambda connection: music.append(self._create_baseline(connection)))
+        db = self.api._db
+        self.assertEqual(len(music_apis._offline_db_migrations), db.get_schema_version())
+        # The row IDs are kept
+        self.assertEqual([(1, "a"), (3, "c"), (4, "d")],
+                         db.execute("SELECT id, songId FROM songs WHERE songId IN ('a', 'c', 'd') ORDER BY id").fetchall())
+        self.assertEqual([("a", "Artist - Song A", 180), ("c", "Artist - Song C (00:30)", None), ("d", None, None)],
+                         db.execute("SELECT songId, stringRep, durationSeconds FROM songs "
+                                    "WHERE songId IN ('a', 'c', 'd') ORDER BY songId").fetchall())
+        self.assertEqual({("text", "123")}, set(db.execute(
+            "SELECT typeof(playlistId), playlistId FROM playlistSongs WHERE songId='d'").fetchall()))
+        self.assertEqual(["a", "d"], [song_id for (song_id,) in db.execute(
+            "SELECT songId FROM playlistSongs WHERE playlistId='123' ORDER BY songId")])
+        # The directory playlist contains songs of a subdirectory
+        self.assertEqual([(music[0], 1)], db.execute("SELECT playlistId, recursive FROM libraryDirectories").fetchall())
+        self.assertEqual("Artist - Song A (03:00)", str(self.api.lookup_song("a")))
+
+        # The songs are indexed for search, and so are new ones
+        self.assertEqual(["c"], [song.song_id for song in self.api.search_page("song c")[0]])
+        self.add_songs([("e", "Song E", "Other")])
+        self.assertEqual(["e"], [song.song_id for song in self.api.search_page("other")[0]])
+
+    def test_rebuild_search_index(self):
+        def _create(connection):
+            self._create_baseline(connection)
+            # A search index created before the songs table was rebuilt
+            connection.execute(
+                "CREATE VIRTUAL TABLE songsSearch USING fts5(title, description, stringRep, content='songs', content_rowid='rowid')")
+            connection.execute(
+                "CREATE TRIGGER songsSearchInsert AFTER INSERT ON songs BEGIN INSERT INTO songsSearch(rowid, title, description, stringRep) VALUES(new.rowid, new.title, new.description, new.stringRep); END")
+            connection.execute("INSERT INTO songsSearch(songsSearch) VALUES('rebuild')")
+            connection.execute("PRAGMA user_version=1")
+
+        self._reopen(_create)
+        db = self.api._db
+        # The triggers have been dropped with the old table and are created again
+        self.assertEqual(3, db.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='trigger' AND name LIKE 'songsSearch%'").fetchone()[0])
+        # The index matches the rebuilt table, the stripped string representation isn't found anymore
+        self.assertEqual(["a", "c", "d"], sorted(song.song_id for song in self.api.search_page("song")[0]))
+        self.assertEqual([], self.api.search_page("03")[0])
+        self.assertEqual(["c"], [song.song_id for song in self.api.search_page("00 30")[0]])
+        with db.transaction():
+            db.execute("UPDATE songs SET title='Renamed' WHERE songId='a'")
+        self.assertEqual(["a"], [song.song_id for song in self.api.search_page("renamed")[0]])
+
+
+class TestOfflineLookup(OfflineAPITest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.api._lookup_chunk_size = 3
+        self.add_songs([("song{}".format(i), "Title {}".format(i), "Artist") for i in range(8)])
+
+    def _count_lookups(self):
+        return sum(stats['count'] for sql, stats in self.api._db.get_stats().items() if "WHERE songId IN" in sql)
+
+    def test_lookup_songs(self):
+        song_ids = ["song7", "song0", "unknown", "song5", "song0", "song3", "song1", "song6", "song2", "song4"]
+        songs = self.api.lookup_songs(song_ids)
+        # In the requested order, with None for unknown songs
+        self.assertEqual(["song7", "song0", None, "song5", "song0", "song3", "song1", "song6", "song2", "song4"],
+                         [song.song_id if song else None for song in songs])
+        self.assertEqual("Title 7", songs[0].title)
+        # Duplicates are looked up once, 9 distinct IDs in chunks of 3
+        self.assertIs(songs[1], songs[4])
+        self.assertEqual(3, self._count_lookups())
+
+    def test_cache(self):
+        first = self.api.lookup_songs(["song0", "song1"])
+        self.assertEqual(1, self._count_lookups())
+        songs = self.api.lookup_songs(["song1", "song2", "song0"])
+        # Cached songs are reused, only the missing one is queried
+        self.assertEqual(2, self._count_lookups())
+        self.assertIs(first[1], songs[0])
+        self.assertIs(first[0], songs[2])
+        self.assertIs(songs[1], self.api.lookup_song("song2"))
+        self.assertEqual(2, self._count_lookups())
+        self.assertEqual([], self.api.lookup_songs([]))
+
+
+class OfflineSearchTest(OfflineAPITest):
+    """
+    Adds some songs to search for to the OfflineAPI.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.add_songs([
+            ("hello_world", "Hello_World", "Some_Artist"),
+            ("world_hello", "World Hello", "Artist"),
+            ("dont_stop", "Don't Stop Me Now", "Queen"),
+            ("rock", "Rock'n'Roll", "Various"),
+            ("cafe_del_mar", "Café del Mar", "Energy 52"),
+            ("cafe_racer", "Cafe Racer", "Motörhead"),
+            ("worlds", "Worlds Apart", "Someone"),
+        ])
+
+    def _search(self, query):
+        songs = []
+        offset = 0
+        while offset is not None:
+            page, offset = self.api.search_page(query, offset, 2)
+            songs.extend(page)
+        return songs
+
+    def _search_ids(self, query):
+        return sorted(song.song_id for song in self._search(query))
+
+
+class TestOfflineSearch(OfflineSearchTest, unittest.TestCase):
+    def test_refine_search(self):
+        self.assertTrue(self.api._fts_enabled)
+        pairs = [("w", "wo"), ("wo", "world"), ("he", "hello wo"), ("hello", "hello_w"), ("don", "don t"),
+                 ("don", "dont"), ("rock", "rock n"), ("caf", "cafe"), ("caf", "café"), ("cafe", "cafe r"),
+                 ("mot", "motö"), ("some", "some_ar")]
+        for prefix, query in pairs:
+            refined = self.api.refine_search(query, self._search(prefix))
+            expected = self._search(query)
+            self.assertEqual(sorted(song.song_id for song in expected), sorted(song.song_id for song in refined),
+                             "{} -> {}".format(prefix, query))
+
+    def test_library_listener(self):
+        cache = SearchCache(prefetch_pages=0)
+        try:
+            self.api.add_library_listener(lambda: cache.invalidate(self.api.get_name()))
+            self.assertEqual(["worlds"], [song.song_id for song in cache.get_songs(self.api, "worlds", 10)])
+            self.add_songs([("worlds_end", "Worlds End", "Someone")])
+            self.api.apply_library_changes("playlist", ["worlds_end"], [], [])
+            self.assertEqual(["worlds", "worlds_end"],
+                             sorted(song.song_id for song in cache.get_songs(self.api, "worlds", 10)))
+        finally:
+            cache.close()
+        self.assertEqual(["hello_world", "world_hello"], sorted(song.song_id for song in self._search("wo hel")))
+
+
+class TestFullTextSearch(OfflineSearchTest, unittest.TestCase):
+    def test_prefix_search(self):
+        self.assertTrue(self.api._fts_enabled)
+        # Every word is a prefix, all of them have to match
+        self.assertEqual(["hello_world", "world_hello", "worlds"], self._search_ids("wor"))
+        self.assertEqual(["hello_world", "world_hello"], self._search_ids("world hel"))
+        self.assertEqual(["cafe_del_mar", "cafe_racer"], self._search_ids("CAFÉ"))
+        self.assertEqual(["dont_stop"], self._search_ids("don't"))
+        self.assertEqual([], self._search_ids("world queen"))
+        self.assertEqual(([], None), self.api.search_page("  '  "))
+
+    def test_query_syntax(self):
+        # FTS5 operators and special characters are taken literally or ignored
+        self.assertEqual(["hello_world", "world_hello", "worlds"], self._search_ids("wor*"))
+        self.assertEqual(["worlds"], self._search_ids("worlds*"))
+        self.assertEqual(["hello_world", "world_hello"], self._search_ids("(hello"))
+        self.assertEqual(["hello_world", "world_hello"], self._search_ids("hello)"))
+        self.assertEqual(["dont_stop"], self._search_ids("-queen"))
+        self.assertEqual(["dont_stop"], self._search_ids("^queen"))
+        for query in ['"', "*", "^"]:
+            self.assertEqual([], self._search_ids(query), query)
+        # Operator words are searched for like any other word
+        for query in ["NEAR(world", "world AND", "world OR queen", "title:world"]:
+            self.assertEqual([], self._search_ids(query), query)
+
+    def test_ranking(self):
+        self.add_songs([("queen_title", "Queen", "Someone"), ("queen_string", "Other", "Someone")])
+        with self.api._db.transaction() as db:
+            db.execute("UPDATE songs SET stringRep='Queen Tribute' WHERE songId='queen_string'")
+        # Title matches first, then description matches, then matches of the string representation
+        self.assertEqual(["queen_title", "dont_stop", "queen_string"],
+                         [song.song_id for song in self._search("queen")])
+
+        songs, next_offset = self.api.search_page("queen", 0, 2)
+        self.assertEqual(["queen_title", "dont_stop"], [song.song_id for song in songs])
+        self.assertEqual(2, next_offset)
+
 if __name__ == "__main__":
     os.chdir("..")
     unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.music_apis import Song
+from musicbot.play_history import PlayHistory
+from musicbot.testing import StubAPI, TempDirTest
+
+if test_logger:
+    pass
+
+
+class TestPlayHistory(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = StubAPI()
+
+    def _history(self):
+        return PlayHistory([self.api], db_path=os.path.join(self.tmp, "history.db"), batch_size=3)
+
+    def _song(self, song_id):
+        return Song(song_id, self.api, title=song_id.upper())
+
+    def test_recent_songs(self):
+        history = self._history()
+        for song_id in ["a", "b", "c", "d"]:
+            history.add_played(self._song(song_id))
+        history.add_skipped(self._song("d"))
+        history.close()
+
+        recent = self._history().get_recent_songs(3)
+        self.assertEqual(["b", "c", "d"], [song.song_id for song in recent])
+        self.assertEqual("D", recent[-1].title)
+
+    def test_events(self):
+        history = self._history()
+        history.add_played(self._song("a"))
+        history.add_played(self._song("b"))
+        history.add_skipped(self._song("b"))
+        self.assertEqual([("a", False), ("b", False), ("b", True)], history.get_events("testapi", 10))
+        self.assertEqual([("b", False), ("b", True)], history.get_events("testapi", 2))
+        self.assertEqual([], history.get_events("otherapi", 10))
+
+    def test_stats(self):
+        history = self._history()
+        for _ in range(3):
+            history.add_played(self._song("a"))
+        history.add_played(self._song("b"))
+        history.add_skipped(self._song("b"))
+
+        self.assertEqual([("testapi", "a", 3), ("testapi", "b", 1)], history.get_play_counts())
+        self.assertEqual(0.25, history.get_skip_rate())
+        self.assertEqual(1.0, history.get_skip_rate("testapi", "b"))
+        self.assertIsNone(history.get_skip_rate("testapi", "c"))
+        self.assertRaises(ValueError, history.get_skip_rate, song_id="b")
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -9,6 +9,7 @@ import test_logger
 from musicbot import async_handler
 from musicbot.music_apis import Song, AbstractSongProvider
 from musicbot.player import SongQueue
+from musicbot.state_log import StateLog
 
 if test_logger:
     pass
@@ -89,6 +90,27 @@ class TestSongQueue(unittest.TestCase):
         queue.append(song)
         self.assertTrue(len(list(filter(lambda song: song == song, self.queue))) == 1)
 
+    def test_move(self):
+        songs = [Song("testidmove" + str(i), self.song_provider) for i in range(3)]
+        queue = self.queue
+        for song in songs:
+            queue.append(song)
+        state_log = StateLog(start_version=0)
+        queue._state_log = state_log
+
+        queue.move(songs[0], songs[2], after_other=True)
+        self.assertEqual([songs[1], songs[2], songs[0]], list(queue))
+        events = state_log.get_since(0)
+        self.assertEqual(1, len(events))
+        self.assertEqual({"type": "queue_move", "version": 1, "from_index": 0, "to_index": 2}, events[0][1])
+
+        missing_song = Song("testidmissing", self.song_provider)
+        for song, other_song in [(songs[1], missing_song), (missing_song, songs[1])]:
+            with self.assertRaises(ValueError) as context:
+                queue.move(song, other_song)
+            self.assertEqual("song {} is not in queue".format(missing_song), str(context.exception))
+        self.assertEqual([songs[1], songs[2], songs[0]], list(queue))
+
 
 if __name__ == "__main__":
     os.chdir("..")
@@ -0,0 +1,72 @@
+import json
+import os
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.testing import TempDirTest
+from playlist_manager import GMusicLibraryIndex
+
+if test_logger:
+    pass
+
+
+class _TestClient(object):
+    def __init__(self, song_ids):
+        self.song_ids = song_ids
+        self.calls = 0
+
+    def get_all_songs(self, incremental=False):
+        self.calls += 1
+        # Pages of two songs, like the generator of the Mobileclient
+        for start in range(0, len(self.song_ids), 2):
+            yield [{"id": song_id, "title": song_id} for song_id in self.song_ids[start:start + 2]]
+
+
+class TestGMusicLibraryIndex(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_path = os.path.join(self.tmp, "library.json")
+
+    def test_get(self):
+        client = _TestClient(["a", "b", "c"])
+        index = GMusicLibraryIndex(client, self.cache_path)
+        self.assertEqual({"id": "c", "title": "c"}, index.get("c"))
+        # The library has just been fetched, so a missing song isn't fetched again
+        self.assertIsNone(index.get("d"))
+        self.assertEqual(1, client.calls)
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(["a", "b", "c"], sorted(json.load(cache_file)))
+
+    def test_refresh_cached(self):
+        GMusicLibraryIndex(_TestClient(["a"]), self.cache_path).get("a")
+
+        client = _TestClient(["a", "b"])
+        index = GMusicLibraryIndex(client, self.cache_path)
+        self.assertEqual("a", index.get("a")['id'])
+        self.assertEqual(0, client.calls)
+        # A song added to the library since the cache has been written
+        self.assertEqual("b", index.get("b")['id'])
+        self.assertEqual(1, client.calls)
+        # The library is only fetched once per run
+        self.assertIsNone(index.get("c"))
+        self.assertEqual(1, client.calls)
+
+        index = GMusicLibraryIndex(_TestClient([]), self.cache_path)
+        self.assertEqual("b", index.get("b")['id'])
+
+    def test_no_cache(self):
+        client = _TestClient(["a"])
+        index = GMusicLibraryIndex(client)
+        self.assertIsNone(index.get("b"))
+        index.invalidate()
+        self.assertEqual("a", index.get("a")['id'])
+        self.assertEqual(2, client.calls)
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
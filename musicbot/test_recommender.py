@@ -0,0 +1,73 @@
+import os
+import random
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.recommender import Recommender, split_artists
+
+if test_logger:
+    pass
+
+
+class TestRecommender(unittest.TestCase):
+    def setUp(self):
+        self.recommender = Recommender(rng=random.Random(42))
+        songs = []
+        for artist in ["a", "b", "c", "d"]:
+            for i in range(5):
+                songs.append(("{}{}".format(artist, i), artist.upper()))
+        songs.append(("ab", "A feat. B"))
+        self.recommender.set_songs(songs)
+
+    def test_split_artists(self):
+        self.assertEqual(["a", "b", "c"], split_artists("A feat. B & c"))
+        self.assertEqual(["ac/dc"], split_artists("AC/DC"))
+        self.assertEqual([], split_artists(None))
+
+    def test_set_songs(self):
+        recommender = self.recommender
+        self.assertEqual(21, len(recommender))
+        self.assertIn("ab", recommender)
+        stats = recommender.get_stats()
+        self.assertEqual(4, stats['artists'])
+        self.assertEqual(2, stats['collaborations'])
+
+    def test_no_history(self):
+        self.assertIsNone(self.recommender.recommend())
+
+    def test_transitions(self):
+        recommender = self.recommender
+        for _ in range(20):
+            recommender.add_played("a0")
+            recommender.add_played("c0")
+        recommendations = [recommender.recommend("a1") for _ in range(500)]
+        artists = [song_id[0] for song_id in recommendations if song_id]
+        self.assertGreater(artists.count("c"), artists.count("d"))
+        self.assertNotIn("a1", recommendations)
+
+    def test_skip(self):
+        recommender = self.recommender
+        recommender.add_played("a0")
+        recommender.add_played("b0")
+        self.assertEqual(1, recommender.get_stats()['transitions'])
+        recommender.add_skipped("b0")
+        self.assertEqual(0, recommender.get_stats()['transitions'])
+        # A skipped song is no seed
+        self.assertIsNone(recommender.recommend())
+
+    def test_remove_song(self):
+        recommender = self.recommender
+        recommender.remove_song("ab")
+        self.assertNotIn("ab", recommender)
+        self.assertEqual(0, recommender.get_stats()['collaborations'])
+        for _ in range(100):
+            self.assertNotEqual("ab", recommender.recommend("a0"))
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,439 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp.test_utils import AioHTTPTestCase
+from passlib.hash import sha256_crypt
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot import config, rest_api, user_store
+from musicbot.music_apis import AbstractSongProvider, Song
+from musicbot.state_log import StateLog
+
+if test_logger:
+    pass
+
+
+class TestPasswordPool(unittest.TestCase):
+    def setUp(self):
+        self._old_executor = rest_api._hash_executor
+        rest_api._hash_executor = rest_api._create_hash_executor()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        rest_api._hash_executor.shutdown()
+        rest_api._hash_executor = self._old_executor
+
+    def _run(self, fn, *args):
+        return self.loop.run_until_complete(rest_api._run_password_job(fn, *args))
+
+    def test_broken_pool(self):
+        self.assertEqual(8, self._run(pow, 2, 3))
+        broken = rest_api._hash_executor
+        # A dying worker breaks the pool
+        with self.assertRaises(rest_api._HTTPError) as context:
+            self._run(os._exit, 1)
+        self.assertEqual(503, context.exception.status)
+        self.assertIsNot(broken, rest_api._hash_executor)
+        self.assertEqual(16, self._run(pow, 2, 4))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self._old_token = rest_api.token
+        rest_api.token = "secret"
+
+    def tearDown(self):
+        rest_api.token = self._old_token
+
+    def test_expiry(self):
+        cache = rest_api._TokenCache(10, 0.05)
+        cache.put("a", {"name": "alice"})
+        cache.put("b", {"name": "bob", "exp": time.time() - 1})
+        self.assertEqual({"name": "alice"}, cache.get("a"))
+        # Expired tokens aren't returned, even before the TTL is over
+        self.assertIsNone(cache.get("b"))
+        self.assertNotIn("bob", cache._user_keys)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual({}, cache._user_keys)
+
+        cache = rest_api._TokenCache(10, 0)
+        cache.put("a", {"name": "alice"})
+        self.assertIsNone(cache.get("a"))
+
+    def test_size(self):
+        cache = rest_api._TokenCache(2, 60)
+        for user_token in ["a", "b", "c"]:
+            cache.put(user_token, {"name": user_token})
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(["b", "c"], sorted(cache._user_keys))
+        self.assertIsNone(cache.get("x" * (cache.max_token_length + 1)))
+
+    def test_secret_rotation(self):
+        cache = rest_api._TokenCache(10, 60)
+        cache.put("a", {"name": "alice"})
+        rest_api.token = "new secret"
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate_user(self):
+        cache = rest_api._TokenCache(10, 60)
+        cache.put("a1", {"name": "alice"})
+        cache.put("a2", {"name": "alice"})
+        cache.put("b", {"name": "bob"})
+        cache.invalidate_user("alice")
+        self.assertIsNone(cache.get("a1"))
+        self.assertIsNone(cache.get("a2"))
+        self.assertEqual({"name": "bob"}, cache.get("b"))
+        self.assertEqual(["bob"], list(cache._user_keys))
+
+
+class _TestAPI(AbstractSongProvider):
+    def get_name(self):
+        return "offline_api"
+
+    def get_pretty_name(self):
+        return "Test API"
+
+    def search_song(self, query, max_fetch=50):
+        for i in range(3):
+            yield Song("{}{}".format(query, i), self, title=query)
+
+    def get_album_art_file(self, song_id, size=None):
+        return None
+
+
+class _TestQueue(list):
+    def __init__(self, state_log):
+        super().__init__()
+        self._state_log = state_log
+
+    def append(self, song):
+        super().append(song)
+        self._state_log.append("queue_add", index=len(self) - 1, song=song.to_json())
+
+    def remove(self, song):
+        index = self.index(song)
+        del self[index]
+        self._state_log.append("queue_remove", index=index)
+
+    def clear(self):
+        super().clear()
+        self._state_log.append("queue_clear")
+
+    def move(self, moving_song, other_song, after_other=False):
+        for song in [moving_song, other_song]:
+            if song not in self:
+                raise ValueError("song {} is not in queue".format(song))
+        from_index = self.index(moving_song)
+        to_index = self.index(other_song)
+        del self[from_index]
+        if from_index < to_index:
+            to_index -= 1
+        if after_other:
+            to_index += 1
+        self.insert(to_index, moving_song)
+        self._state_log.append("queue_move", from_index=from_index, to_index=to_index)
+
+
+class _TestPlayer(object):
+    def __init__(self):
+        self._state_log = StateLog()
+        self._queue = _TestQueue(self._state_log)
+
+    def get_state_log(self):
+        return self._state_log
+
+    def get_queue(self):
+        return self._queue
+
+    def get_current_song(self):
+        return None
+
+    def get_last_played(self):
+        return []
+
+    def is_paused(self):
+        return False
+
+
+class EndpointTest(AioHTTPTestCase):
+    """
+    Serves the REST API with a test API and player.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls._old_db_path = user_store._db_path
+        user_store._db_path = os.path.join(cls.tmp, "clients.db")
+        cls.api = _TestAPI()
+        cls._old_token = rest_api.token
+        # init() would create a REST token and save it to the real secrets file otherwise
+        old_get_secrets = config.get_secrets
+        config.get_secrets = lambda: {"rest_token": "secret"}
+        try:
+            rest_api.init([cls.api], _TestPlayer())
+        finally:
+            config.get_secrets = old_get_secrets
+        # bcrypt is slow on purpose, the tests use a fast scheme in threads instead
+        rest_api._hash_executor.shutdown()
+        rest_api._hash_executor = ThreadPoolExecutor(max_workers=2)
+        cls._old_hash_password = rest_api.hash_password
+        cls._old_verify_password = rest_api.verify_password
+        rest_api.hash_password = sha256_crypt.hash
+        rest_api.verify_password = sha256_crypt.verify
+
+    @classmethod
+    def tearDownClass(cls):
+        rest_api.hash_password = cls._old_hash_password
+        rest_api.verify_password = cls._old_verify_password
+        rest_api._hash_executor.shutdown()
+        rest_api._users._db.close()
+        user_store._db_path = cls._old_db_path
+        rest_api.token = cls._old_token
+        shutil.rmtree(cls.tmp)
+
+    async def get_application(self):
+        return rest_api.create_app()
+
+    def tearDown(self):
+        rest_api.queue.clear()
+
+    async def _register(self, username):
+        response = await self.client.post("/register", data={"username": username, "password": "secret"})
+        self.assertEqual(200, response.status)
+        return await response.json()
+
+
+class TestEndpoints(EndpointTest):
+    async def test_register_login(self):
+        user_token = await self._register("Alice ")
+        response = await self.client.post("/register", data={"username": "alice", "password": "secret"})
+        self.assertEqual(409, response.status)
+
+        response = await self.client.put("/login", json={"username": "alice", "password": "wrong"})
+        self.assertEqual(400, response.status)
+        self.assertEqual("wrong password", await response.json())
+        response = await self.client.put("/login", json={"username": "alice", "password": "secret"})
+        self.assertEqual(200, response.status)
+        login_token = await response.json()
+
+        for headers in [{"Authorization": user_token}, {"Authorization": login_token}]:
+            response = await self.client.get("/get_permissions", headers=headers)
+            self.assertEqual(["user"], await response.json())
+
+        for headers in [{}, {"Authorization": "invalid"}]:
+            response = await self.client.get("/get_permissions", headers=headers)
+            self.assertEqual(401, response.status)
+            self.assertEqual({"title": "Authentication Required",
+                              "description": "Please provide valid Token credentials"}, await response.json())
+
+    async def test_parameter_errors(self):
+        response = await self.client.get("/search", params={"api_name": "offline_api", "max_fetch": "many"})
+        self.assertEqual(400, response.status)
+        self.assertEqual({"errors": {"query": "Required parameter 'query' not supplied",
+                                     "max_fetch": "Invalid int provided"}}, await response.json())
+
+        headers = {"Authorization": await self._register("bob")}
+        response = await self.client.put("/queue", params={"remove": "maybe"},
+                                         json={"song_id": "a", "api_name": "offline_api"}, headers=headers)
+        self.assertEqual(400, response.status)
+        self.assertEqual({"errors": {"remove": "Invalid bool provided"}}, await response.json())
+
+        response = await self.client.put("/queue", data="not json", headers=dict(headers, **{
+            "Content-Type": "application/json"}))
+        self.assertEqual(400, response.status)
+        self.assertEqual({"errors": {"body": "Invalid request body"}}, await response.json())
+
+    async def test_queue(self):
+        headers = {"Authorization": await self._register("carol")}
+        song_json = {"song_id": "a", "api_name": "offline_api"}
+        response = await self.client.put("/queue", json=song_json, headers=headers)
+        self.assertEqual(200, response.status)
+        self.assertEqual(["a"], [song.song_id for song in rest_api.queue])
+        self.assertEqual("carol", rest_api.queue[0].user)
+
+        response = await self.client.put("/queue", json={"song_id": "a", "api_name": "unknown"}, headers=headers)
+        self.assertEqual(400, response.status)
+
+        # Removing songs needs a permission
+        response = await self.client.put("/queue", params={"remove": "true"}, json=song_json, headers=headers)
+        self.assertEqual(403, response.status)
+        response = await self.client.get("/claim_admin", headers=headers)
+        headers = {"Authorization": await response.json()}
+        response = await self.client.put("/queue", params={"remove": "true"}, json=song_json, headers=headers)
+        self.assertEqual(200, response.status)
+        self.assertEqual([], rest_api.queue)
+        response = await self.client.put("/queue", params={"remove": "1"}, json=song_json, headers=headers)
+        self.assertEqual(400, response.status)
+
+    async def test_move(self):
+        headers = {"Authorization": await self._register("dave")}
+        for song_id in ["a", "b", "c"]:
+            await self.client.put("/queue", json={"song_id": song_id, "api_name": "offline_api"}, headers=headers)
+
+        response = await self.client.put("/move", json={
+            "moving_song_json": {"song_id": "a", "api_name": "offline_api"},
+            "other_song_json": {"song_id": "c", "api_name": "offline_api"},
+            "after_other": True
+        }, headers=headers)
+        self.assertEqual(200, response.status)
+        state = await response.json()
+        self.assertEqual(["b", "c", "a"], [song['song_id'] for song in state['queue']])
+
+        # The error names the song which is missing
+        for moving_song_id, other_song_id in [("x", "c"), ("c", "x")]:
+            response = await self.client.put("/move", json={
+                "moving_song_json": {"song_id": moving_song_id, "api_name": "offline_api"},
+                "other_song_json": {"song_id": other_song_id, "api_name": "offline_api"}
+            }, headers=headers)
+            self.assertEqual(400, response.status)
+            self.assertEqual("song {} is not in queue".format(Song("x", self.api)), await response.json())
+        self.assertEqual(["b", "c", "a"], [song.song_id for song in rest_api.queue])
+
+    async def test_search(self):
+        response = await self.client.get("/search", params={"api_name": "offline_api", "query": " Foo "})
+        self.assertEqual(200, response.status)
+        songs = await response.json()
+        self.assertEqual(["foo0", "foo1", "foo2"], [song['song_id'] for song in songs])
+
+        self.assertNotIn("X-Next-Offset", response.headers)
+
+        response = await self.client.get("/search", params={"api_name": "offline_api", "query": "foo", "max_fetch": 2})
+        self.assertEqual(["foo0", "foo1"], [song['song_id'] for song in await response.json()])
+        self.assertEqual("2", response.headers["X-Next-Offset"])
+        response = await self.client.get("/search", params={"api_name": "offline_api", "query": "foo", "max_fetch": 2,
+                                                            "offset": 2})
+        self.assertEqual(["foo2"], [song['song_id'] for song in await response.json()])
+        self.assertNotIn("X-Next-Offset", response.headers)
+        response = await self.client.get("/search", params={"api_name": "unknown", "query": "foo"})
+        self.assertEqual(400, response.status)
+        response = await self.client.get("/search", params={"api_name": "offline_api", "query": "  "})
+        self.assertEqual(400, response.status)
+
+    async def test_federated_search(self):
+        response = await self.client.get("/federated_search", params={"query": "foo", "max_fetch": 2})
+        self.assertEqual("application/x-ndjson", response.headers["Content-Type"])
+        lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual(2, len(lines))
+        self.assertEqual(("offline_api", "ok"), (lines[0]['api_name'], lines[0]['status']))
+        # All songs of the test API have the same title, so they are duplicates
+        self.assertEqual(["foo0"], [song['song_id'] for song in lines[0]['songs']])
+        self.assertTrue(lines[1]['done'])
+
+        response = await self.client.get("/federated_search", params={"query": "foo", "stream": "false"})
+        result = await response.json()
+        self.assertEqual(["foo0"], [song['song_id'] for song in result['songs']])
+        self.assertEqual([[]], [backend['songs'] for backend in result['backends']])
+
+    async def _wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        self.assertTrue(condition())
+
+    async def test_player_events(self):
+        state_log = rest_api.player.get_state_log()
+        ws = await self.client.ws_connect("/player_events")
+        message = await ws.receive_json()
+        self.assertEqual("state", message['type'])
+        self.assertEqual(state_log.get_version(), message['version'])
+        threading.Timer(0.05, state_log.append, ["paused"], {"paused": True}).start()
+        message = await ws.receive_json()
+        self.assertEqual(("paused", True), (message['type'], message['paused']))
+        await ws.close()
+        await self._wait_for(lambda: not rest_api._event_hub._subscriptions)
+
+        # Server-sent events, resuming from the last version
+        response = await self.client.get("/player_events", headers={"Last-Event-ID": str(message['version'])})
+        self.assertEqual("text/event-stream", response.content_type)
+        threading.Timer(0.05, state_log.append, ["paused"], {"paused": False}).start()
+        self.assertEqual("id: {}\n".format(message['version'] + 1), (await response.content.readline()).decode())
+        data = (await response.content.readline()).decode()
+        self.assertEqual({"type": "paused", "paused": False, "version": message['version'] + 1},
+                         json.loads(data[len("data: "):]))
+        response.close()
+        await self._wait_for(lambda: not rest_api._event_hub._subscriptions)
+
+    async def test_album_art(self):
+        response = await self.client.get("/get_album_art", params={"song_id": "a"})
+        self.assertEqual(404, response.status)
+
+        del rest_api.music_api_names['offline_api']
+        try:
+            response = await self.client.get("/get_album_art", params={"song_id": "a"})
+            self.assertEqual(400, response.status)
+            self.assertEqual("Not in offline mode", await response.json())
+        finally:
+            rest_api.music_api_names['offline_api'] = self.api
+
+
+
+class TestPlayerState(EndpointTest):
+    async def test_player_state(self):
+        response = await self.client.get("/player_state")
+        self.assertEqual(200, response.status)
+        etag = response.headers["ETag"]
+        state = await response.json()
+        self.assertEqual('"{}"'.format(state['version']), etag)
+        self.assertEqual([], state['queue'])
+
+        response = await self.client.get("/player_state", headers={"If-None-Match": 'W/"0", ' + etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual(etag, response.headers["ETag"])
+
+        start = time.monotonic()
+        response = await self.client.get("/player_state", params={"wait_for_change": 1},
+                                         headers={"If-None-Match": etag})
+        self.assertEqual(304, response.status)
+        self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+        state_log = rest_api.player.get_state_log()
+        # Events are appended by the player threads
+        threading.Timer(0.1, state_log.append, ["paused"], {"paused": False}).start()
+        response = await self.client.get("/player_state", params={"wait_for_change": 10},
+                                         headers={"If-None-Match": etag})
+        self.assertEqual(200, response.status)
+        self.assertEqual(state['version'] + 1, (await response.json())['version'])
+        self.assertNotEqual(etag, response.headers["ETag"])
+
+    async def test_cache(self):
+        serialized = []
+
+        def _get_player_state():
+            serialized.append(True)
+            return old_get_player_state()
+
+        old_get_player_state = rest_api._get_player_state
+        rest_api._get_player_state = _get_player_state
+        try:
+            for _ in range(3):
+                response = await self.client.get("/player_state")
+                self.assertEqual([], (await response.json())['queue'])
+            # The state is serialized once until it changes
+            self.assertEqual(1, len(serialized))
+
+            song = Song("a", self.api, title="A")
+            rest_api.queue.append(song)
+            response = await self.client.get("/player_state")
+            self.assertEqual(["a"], [song_json['song_id'] for song_json in (await response.json())['queue']])
+            self.assertEqual(2, len(serialized))
+        finally:
+            rest_api._get_player_state = old_get_player_state
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.music_apis import Song, AbstractAPI
+from musicbot.search_cache import SearchCache, QueryDebouncer, normalize_query
+
+if test_logger:
+    pass
+
+
+class _TestAPI(AbstractAPI):
+    def __init__(self, name="testapi", count=50, fail_after=None):
+        self._name = name
+        self._count = count
+        self._fail_after = fail_after
+        self.searches = []
+        self.fetched = 0
+        self._fetched_lock = threading.Lock()
+
+    def get_name(self):
+        return self._name
+
+    def search_song(self, query, max_fetch=50):
+        self.searches.append(query)
+        for i in range(self._count):
+            if self._fail_after is not None and i >= self._fail_after:
+                raise IOError("search failed")
+            with self._fetched_lock:
+                self.fetched += 1
+            yield Song("{}{}".format(query, i), self, title=query)
+
+
+class _RefiningTestAPI(_TestAPI):
+    def search_song(self, query, max_fetch=50):
+        self.searches.append(query)
+        for title in ["foo", "foobar", "foo baz", "bar"]:
+            if title.startswith(query):
+                yield Song(title, self, title=title)
+
+    def refine_search(self, query, songs):
+        return [song for song in songs if song.title.startswith(query)]
+
+
+class TestSearchCache(unittest.TestCase):
+    def setUp(self):
+        self.api = _TestAPI()
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_normalize_query(self):
+        self.assertEqual("foo bar", normalize_query("  Foo\tBAR "))
+        self.assertEqual("", normalize_query("   "))
+        self.assertEqual("", normalize_query(None))
+
+    def test_pages(self):
+        cache = SearchCache(prefetch_pages=1)
+        try:
+            songs, next_offset = cache.get_page(self.api, "query", 0, 20)
+            self.assertEqual(["query{}".format(i) for i in range(20)], [song.song_id for song in songs])
+            self.assertEqual(20, next_offset)
+
+            # The next page is fetched in the background
+            self._wait_for(lambda: self.api.fetched >= 41)
+            self.assertEqual(41, self.api.fetched)
+
+            songs, next_offset = cache.get_page(self.api, " QUERY ", 40, 20)
+            self.assertEqual(10, len(songs))
+            self.assertIsNone(next_offset)
+            self.assertEqual(["query"], self.api.searches)
+            self.assertRaises(ValueError, cache.get_page, self.api, "  ", 0, 20)
+        finally:
+            cache.close()
+
+    def test_ttl(self):
+        cache = SearchCache(ttl=0.05, prefetch_pages=0)
+        try:
+            cache.get_songs(self.api, "query", 5)
+            cache.get_songs(self.api, "query", 5)
+            self.assertEqual(1, len(self.api.searches))
+            time.sleep(0.1)
+            cache.get_songs(self.api, "query", 5)
+            self.assertEqual(2, len(self.api.searches))
+        finally:
+            cache.close()
+
+    def test_size_limit(self):
+        cache = SearchCache(max_songs=25, prefetch_pages=0)
+        try:
+            cache.get_songs(self.api, "a", 10)
+            cache.get_songs(self.api, "b", 10)
+            self.assertEqual(2, len(self.api.searches))
+            # Using a again makes b the least recently used entry
+            cache.get_songs(self.api, "a", 5)
+            cache.get_songs(self.api, "c", 5)
+            self.assertLessEqual(cache.get_size(), 25)
+            cache.get_songs(self.api, "a", 5)
+            self.assertEqual(["a", "b", "c"], self.api.searches)
+            cache.get_songs(self.api, "b", 5)
+            self.assertEqual(["a", "b", "c", "b"], self.api.searches)
+        finally:
+            cache.close()
+
+    def test_error(self):
+        api = _TestAPI(fail_after=0)
+        cache = SearchCache(prefetch_pages=0)
+        try:
+            self.assertRaises(IOError, cache.get_songs, api, "query", 5)
+            # Failed searches aren't cached
+            self.assertRaises(IOError, cache.get_songs, api, "query", 5)
+            self.assertEqual(2, len(api.searches))
+            self.assertEqual(0, cache.get_size())
+        finally:
+            cache.close()
+
+    def test_refine(self):
+        api = _RefiningTestAPI()
+        cache = SearchCache(prefetch_pages=0)
+        try:
+            self.assertEqual(3, len(cache.get_songs(api, "fo", 10)))
+            songs = cache.get_songs(api, "foo b", 10)
+            self.assertEqual(["foo baz"], [song.title for song in songs])
+            self.assertEqual(["fo"], api.searches)
+
+            # The results of "b" aren't complete, so they can't be refined
+            cache.get_page(self.api, "b", 0, 1)
+            cache.get_songs(self.api, "ba", 10)
+            self.assertEqual(["b", "ba"], self.api.searches)
+        finally:
+            cache.close()
+
+    def test_invalidate(self):
+        api = _RefiningTestAPI("refining")
+        cache = SearchCache(prefetch_pages=0)
+        try:
+            cache.get_songs(api, "fo", 10)
+            cache.get_songs(api, "foo", 10)
+            cache.get_songs(self.api, "foo", 10)
+            size = cache.get_size()
+            cache.invalidate("unknown")
+            self.assertEqual(size, cache.get_size())
+
+            # Derived entries are dropped as well
+            cache.invalidate(api.get_name())
+            self.assertEqual(size - 6, cache.get_size())
+            self.assertEqual(["foo"], self.api.searches)
+            cache.get_songs(api, "foo", 10)
+            self.assertEqual(["fo", "foo"], api.searches)
+        finally:
+            cache.close()
+
+    def test_cancel(self):
+        cache = SearchCache(prefetch_pages=1)
+        try:
+            songs, next_offset = cache.get_page(self.api, "query", 0, 20, cancelled=lambda: True)
+            self.assertEqual([], songs)
+            self.assertIsNone(next_offset)
+            time.sleep(0.05)
+            self.assertEqual(0, self.api.fetched)
+
+            songs, next_offset = cache.get_page(self.api, "query", 0, 20, cancelled=lambda: False)
+            self.assertEqual(20, len(songs))
+        finally:
+            cache.close()
+
+
+class TestQueryDebouncer(unittest.TestCase):
+    def test_supersede(self):
+        debouncer = QueryDebouncer(delay=5)
+        first = debouncer.start("user")
+        results = []
+        thread = threading.Thread(target=lambda: results.append(debouncer.wait("user", first)))
+        thread.start()
+        start = time.monotonic()
+        second = debouncer.start("user")
+        thread.join()
+        # The superseded query stops waiting immediately
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([False], results)
+        self.assertFalse(debouncer.is_current("user", first))
+        self.assertTrue(debouncer.is_current("user", second))
+
+        other = debouncer.start("other")
+        self.assertTrue(debouncer.is_current("user", second))
+        debouncer.finish("user", first)
+        self.assertTrue(debouncer.is_current("user", second))
+        debouncer.finish("user", second)
+        self.assertFalse(debouncer.is_current("user", second))
+        self.assertTrue(debouncer.is_current("other", other))
+
+    def test_delay(self):
+        debouncer = QueryDebouncer(delay=0.05)
+        ticket = debouncer.start("user")
+        self.assertTrue(debouncer.wait("user", ticket))
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
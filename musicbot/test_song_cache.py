@@ -0,0 +1,124 @@
+import os
+import time
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot import config, song_cache
+from musicbot.music_apis import Song
+from musicbot.song_cache import SongCache
+from musicbot.testing import StubAPI, TempDirTest
+
+if test_logger:
+    pass
+
+
+class TestSongCache(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._old_db_path = song_cache._db_path
+        self._old_db = song_cache._db
+        song_cache._db_path = os.path.join(self.tmp, "song_cache.db")
+        song_cache._db = None
+        self._old_config = dict(config._config)
+        config._config["song_cache_ttl"] = {"testapi": 60}
+        config._config["song_cache_size"] = {"testapi": 5}
+        self.api = StubAPI()
+
+    def tearDown(self):
+        if song_cache._db:
+            song_cache._db.close_all()
+        song_cache._db_path = self._old_db_path
+        song_cache._db = self._old_db
+        config._config.clear()
+        config._config.update(self._old_config)
+        super().tearDown()
+
+    def _song(self, song_id):
+        return Song(song_id, self.api, "Title " + song_id, "Artist", duration="03:00", user="user")
+
+    def _count_rows(self):
+        return song_cache._get_db().execute("SELECT COUNT(*) FROM songCache").fetchone()[0]
+
+    def test_tiers(self):
+        cache = SongCache(self.api, memory_size=2)
+        cache.put(self._song("a"))
+        # Queued songs are found before they have been written
+        self.assertEqual("Title a", cache.get("a").title)
+        self.assertEqual(0, self._count_rows())
+        cache.flush()
+        self.assertEqual(1, self._count_rows())
+
+        # A new cache only finds the song on disk, the user isn't stored
+        cache = SongCache(self.api, memory_size=2)
+        self.assertIsNone(cache.get_memory("a"))
+        song = cache.get("a")
+        self.assertEqual(("Title a", "Artist", "03:00", None), (song.title, song.description, song.duration, song.user))
+        self.assertIs(song, cache.get_memory("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIn("a", cache)
+
+        stats = cache.get_stats()
+        self.assertEqual(1, stats['disk']['hits'])
+        self.assertEqual(1, stats['disk']['misses'])
+        self.assertEqual(2, stats['memory']['hits'])
+
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, self._count_rows())
+
+    def test_batch(self):
+        cache = SongCache(self.api)
+        cache._max_pending = 3
+        for song_id in "abcd":
+            cache.put(self._song(song_id))
+        # Written in one batch once there are too many songs waiting
+        self.assertEqual(3, self._count_rows())
+        cache.flush()
+        cache.flush()
+        self.assertEqual(4, self._count_rows())
+
+    def test_ttl(self):
+        cache = SongCache(self.api)
+        cache.put(self._song("a"))
+        cache.put(self._song("b"))
+        cache.flush()
+        with song_cache._get_db().transaction() as db:
+            db.execute("UPDATE songCache SET updated=? WHERE songId='a'", [time.time() - 120])
+
+        cache = SongCache(self.api)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        # The expired song has been deleted
+        self.assertEqual(1, self._count_rows())
+
+    def test_prune(self):
+        cache = SongCache(self.api)
+        cache._prune_interval = 4
+        for song_id in "abc":
+            cache.put(self._song(song_id))
+        cache.flush()
+        for song_id in "defg":
+            cache.put(self._song(song_id))
+        cache.flush()
+        # Pruned to the 5 newest songs
+        self.assertEqual(5, self._count_rows())
+        cache = SongCache(self.api)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("g"))
+
+    def test_disabled(self):
+        config._config["song_cache_ttl"] = {"testapi": 0}
+        cache = SongCache(self.api)
+        cache.put(self._song("a"))
+        cache.flush()
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(0, self._count_rows())
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.state_log import StateLog
+
+if test_logger:
+    pass
+
+
+class TestStateLog(unittest.TestCase):
+    def setUp(self):
+        self.state_log = StateLog(max_len=3, start_version=0)
+
+    def test_append(self):
+        received = []
+        self.state_log.add_listener(lambda version, event: received.append(version))
+        self.assertEqual(1, self.state_log.append("paused", paused=True))
+        self.assertEqual(2, self.state_log.append("queue_clear"))
+        self.assertEqual([1, 2], received)
+        self.assertEqual(2, self.state_log.get_version())
+
+    def test_get_since(self):
+        state_log = self.state_log
+        self.assertEqual([], state_log.get_since(0))
+        for i in range(5):
+            state_log.append("queue_remove", index=i)
+        self.assertEqual([], state_log.get_since(5))
+        self.assertEqual([4, 5], [version for version, _ in state_log.get_since(3)])
+        self.assertEqual(3, len(state_log.get_since(2)))
+        self.assertEqual({"type": "queue_remove", "version": 5, "index": 4}, state_log.get_since(4)[0][1])
+        # Dropped from the buffer
+        self.assertIsNone(state_log.get_since(1))
+        # Unknown future version, e.g. after a restart
+        self.assertIsNone(state_log.get_since(6))
+
+    def test_snapshot(self):
+        self.state_log.append("paused", paused=True)
+        self.assertEqual((1, "state"), self.state_log.snapshot(lambda: "state"))
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import random
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.music_apis import Song
+from musicbot.suggestions import SuggestionPool, ShuffleBag
+from musicbot.testing import StubAPI
+
+if test_logger:
+    pass
+
+
+class TestSuggestionPool(unittest.TestCase):
+    def setUp(self):
+        self.api = StubAPI()
+        self.pool = SuggestionPool(recent_size=3)
+
+    def _song(self, song_id):
+        return Song(song_id, self.api)
+
+    def test_pop_order(self):
+        pool = self.pool
+        self.assertEqual(3, pool.extend(map(self._song, ["a", "b", "c"])))
+        self.assertEqual("a", pool.pop().song_id)
+        self.assertEqual("b", pool.pop().song_id)
+        self.assertEqual("c", pool.pop().song_id)
+        with self.assertRaises(IndexError):
+            pool.pop()
+
+    def test_duplicates(self):
+        pool = self.pool
+        self.assertTrue(pool.append(self._song("a")))
+        self.assertFalse(pool.append(self._song("a")))
+        self.assertEqual(1, len(pool))
+        self.assertEqual(1, pool.get_stats()['rejected'])
+
+    def test_remove(self):
+        pool = self.pool
+        pool.extend(map(self._song, ["a", "b", "c"]))
+        self.assertTrue(pool.remove(self._song("b")))
+        self.assertFalse(pool.remove("b"))
+        self.assertNotIn("b", pool)
+        self.assertEqual(["a", "c"], [song.song_id for song in pool.peek(5)])
+
+    def test_add_played(self):
+        pool = self.pool
+        pool.extend(map(self._song, ["a", "b"]))
+        pool.add_played(self._song("a"))
+        self.assertNotIn("a", pool)
+        self.assertFalse(pool.append(self._song("a")))
+        self.assertTrue(pool.append(self._song("a"), ignore_recent=True))
+
+    def test_recent_window(self):
+        pool = self.pool
+        for song_id in ["a", "b", "c", "d"]:
+            pool.add_played(song_id)
+        self.assertEqual(["b", "c", "d"], pool.get_recent_ids())
+        self.assertFalse(pool.was_played_recently("a"))
+        pool.add_played("b")
+        self.assertEqual(["c", "d", "b"], pool.get_recent_ids())
+
+    def test_stats(self):
+        pool = self.pool
+        self.assertFalse(pool.is_stocked(1))
+        pool.append(self._song("a"))
+        self.assertTrue(pool.is_stocked(1))
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.5, stats['hit_ratio'])
+
+    def test_clear(self):
+        pool = self.pool
+        pool.append(self._song("a"))
+        pool.add_played("b")
+        pool.clear()
+        self.assertFalse(pool)
+        self.assertTrue(pool.was_played_recently("b"))
+        pool.reset()
+        self.assertFalse(pool.was_played_recently("b"))
+
+
+class TestShuffleBag(unittest.TestCase):
+    def _bag(self, items, no_repeat=0, weights=None):
+        return ShuffleBag(items, no_repeat, weights, rng=random.Random(42))
+
+    def test_draw_all_once(self):
+        items = list(range(20))
+        bag = self._bag(items)
+        for _ in range(3):
+            drawn = [bag.draw() for _ in items]
+            self.assertEqual(sorted(items), sorted(drawn))
+
+    def test_empty(self):
+        with self.assertRaises(IndexError):
+            self._bag([]).draw()
+
+    def test_no_repeat(self):
+        for seed in range(20):
+            bag = ShuffleBag(range(10), 5, rng=random.Random(seed))
+            drawn = [bag.draw() for _ in range(100)]
+            for index in range(5, len(drawn)):
+                self.assertNotIn(drawn[index], drawn[index - 5:index])
+
+    def test_small_bag(self):
+        bag = self._bag(["a", "b"], no_repeat=50)
+        drawn = [bag.draw() for _ in range(10)]
+        self.assertEqual(["a", "b"], sorted(drawn[0:2]))
+        for index in range(1, len(drawn)):
+            self.assertNotEqual(drawn[index], drawn[index - 1])
+
+    def test_add_remove(self):
+        bag = self._bag(range(10))
+        bag.draw()
+        bag.add(10)
+        bag.remove(3)
+        bag.remove(42)
+        self.assertIn(10, bag)
+        self.assertNotIn(3, bag)
+        drawn = [bag.draw() for _ in range(30)]
+        self.assertIn(10, drawn)
+        self.assertNotIn(3, drawn)
+
+    def test_add_played(self):
+        for seed in range(20):
+            bag = ShuffleBag(range(20), 5, rng=random.Random(seed))
+            if bag.draw() == 5:
+                continue
+            bag.add_played(5)
+            self.assertNotIn(5, [bag.draw() for _ in range(5)])
+
+    def test_weights(self):
+        items = list(range(10))
+        bag = self._bag(items, weights={0: 100})
+        drawn = [bag.draw() for _ in items]
+        self.assertEqual(sorted(items), sorted(drawn))
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import unittest
+
+import _version
+
+_version.debug = True
+
+import test_logger
+from musicbot.testing import TempDirTest
+from musicbot.user_store import UserStore, SecretClient
+
+if test_logger:
+    pass
+
+
+class TestUserStore(TempDirTest, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_path = os.path.join(self.tmp, "clients.db")
+        self.store = UserStore(self.db_path)
+
+    def test_add(self):
+        store = self.store
+        store.add(SecretClient("a", "hash", ["user"]))
+        self.assertRaises(ValueError, store.add, SecretClient("a", "other", ["user"]))
+        client = store.get("a")
+        self.assertEqual("hash", client.pw_hash)
+        self.assertEqual(["user"], client.permissions)
+        self.assertIsNone(store.get("b"))
+
+    def test_write_through(self):
+        store = self.store
+        store.add(SecretClient("a", "hash", ["user"]))
+        store.add(SecretClient("b", "hash", ["user"]))
+        store.set_password("a", "new hash")
+        store.change_permission("b", "mod", True)
+        store.delete("a")
+
+        reloaded = UserStore(self.db_path)
+        self.assertIsNone(reloaded.get("a"))
+        self.assertEqual(["mod", "user"], reloaded.get("b").permissions)
+        self.assertEqual([("b", ["mod", "user"])], reloaded.get_all())
+
+    def test_admin(self):
+        store = self.store
+        store.add(SecretClient("a", "hash", ["user"]))
+        store.add(SecretClient("b", "hash", ["user"]))
+        self.assertFalse(store.has_admin())
+        self.assertEqual(["admin", "user"], store.claim_admin("a"))
+        self.assertIsNone(store.claim_admin("b"))
+        self.assertTrue(UserStore(self.db_path).has_admin())
+
+        store.change_permission("a", "admin", False)
+        self.assertFalse(store.has_admin())
+        self.assertRaises(ValueError, store.claim_admin, "c")
+
+
+if __name__ == "__main__":
+    os.chdir("..")
+    unittest.main()
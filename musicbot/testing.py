@@ -0,0 +1,54 @@
+"""
+Helpers shared by the test modules.
+"""
+import os
+import shutil
+import tempfile
+
+from mutagen.id3 import APIC, ID3, TALB, TIT2, TPE1
+
+from musicbot.music_apis import AbstractAPI
+
+# One second of silent MPEG-1 Layer III frames
+_mp3_data = (b"\xff\xfb\x90\x64" + b"\x00" * 413) * 40
+
+
+def write_mp3(path, title, artist="Artist", album=None, album_art=None):
+    """
+    Write a silent mp3 file with ID3 tags.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as mp3_file:
+        mp3_file.write(_mp3_data)
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=artist))
+    if album:
+        tags.add(TALB(encoding=3, text=album))
+    if album_art:
+        tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=album_art))
+    tags.save(path)
+
+
+class StubAPI(AbstractAPI):
+    """
+    An API which only has a name, for songs which are never loaded.
+    """
+
+    def get_name(self):
+        return "testapi"
+
+
+class TempDirTest(object):
+    """
+    Creates a temporary directory self.tmp for every test and deletes it afterwards.
+    Has to be listed before unittest.TestCase in the base classes.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super().tearDown()
@@ -0,0 +1,194 @@
+import os
+import sqlite3
+import threading
+
+_db_path = os.path.join("config", "clients.db")
+
+
+class SecretClient(object):
+    def __init__(self, name, pw_hash, permissions):
+        self.name = name
+        self.pw_hash = pw_hash
+        self.permissions = permissions
+
+    def __eq__(self, other):
+        if not isinstance(other, SecretClient):
+            return False
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        return "User {}: [permissions={}] [pw_hash={}]".format(self.name, self.permissions, self.pw_hash)
+
+    def to_json(self):
+        return {"name": self.name,
+                "permissions": self.permissions,
+                "pw_hash": self.pw_hash}
+
+    @staticmethod
+    def from_json(client_json):
+        try:
+            name = client_json['name']
+            pw_hash = client_json['pw_hash']
+            permissions = client_json['permissions']
+            return SecretClient(name, pw_hash, permissions)
+        except KeyError as e:
+            raise ValueError("Missing key: " + str(e))
+
+
+class UserStore(object):
+    """
+    Keeps all REST API users and their permissions in memory and writes every change through to the database.
+
+    Lookups don't touch the database. Changes are written on a single connection first and only applied to the
+    in-memory index after they have been committed, so both always agree.
+    """
+
+    def __init__(self, db_path=None):
+        """
+        Constructor
+
+        Keyword arguments:
+        db_path -- the path to the database file
+        """
+        self._db_path = db_path or _db_path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS clients (userid INTEGER PRIMARY KEY ASC AUTOINCREMENT, username TEXT UNIQUE NOT NULL, pw_hash CHAR(75) NOT NULL, permissions TEXT)")
+        self._db.commit()
+        # Username -> (pw_hash, frozenset of permissions)
+        self._clients = {}
+        # Usernames of all clients with admin permission
+        self._admins = set()
+        for username, pw_hash, permissions in self._db.execute("SELECT username, pw_hash, permissions FROM clients"):
+            self._set(username, pw_hash, permissions.split(",") if permissions else [])
+
+    def _set(self, username, pw_hash, permissions):
+        permissions = frozenset(permissions)
+        self._clients[username] = (pw_hash, permissions)
+        if "admin" in permissions:
+            self._admins.add(username)
+        else:
+            self._admins.discard(username)
+
+    def _write(self, query, parameters):
+        with self._db:
+            return self._db.execute(query, parameters)
+
+    def get(self, username):
+        """
+        Get a client.
+        :param username: the username
+        :return: a SecretClient or None if there is no such client
+        """
+        client = self._clients.get(username)
+        if not client:
+            return None
+        return SecretClient(username, client[0], sorted(client[1]))
+
+    def get_permissions(self, username):
+        """
+        Get the permissions of a client.
+        :return: a frozenset of permissions, or None if there is no such client
+        """
+        client = self._clients.get(username)
+        if not client:
+            return None
+        return client[1]
+
+    def get_all(self):
+        """
+        Get all clients.
+        :return: a list of (username, permissions) tuples
+        """
+        with self._lock:
+            return [(username, sorted(client[1])) for username, client in self._clients.items()]
+
+    def has_admin(self):
+        return bool(self._admins)
+
+    def add(self, client):
+        """
+        Add a client.
+        :param client: a SecretClient
+        :raises ValueError: if there already is a client with that name
+        """
+        with self._lock:
+            if client.name in self._clients:
+                raise ValueError("client already in clients")
+            try:
+                self._write("INSERT INTO clients(username, pw_hash, permissions) VALUES(?, ?, ?)",
+                            [client.name, client.pw_hash, ",".join(client.permissions)])
+            except sqlite3.IntegrityError:
+                raise ValueError("client already in clients")
+            self._set(client.name, client.pw_hash, client.permissions)
+
+    def set_password(self, username, pw_hash):
+        with self._lock:
+            client = self._clients.get(username)
+            if not client:
+                raise ValueError("Unknown client: " + username)
+            self._write("UPDATE clients SET pw_hash=? WHERE username=?", [pw_hash, username])
+            self._set(username, pw_hash, client[1])
+
+    def set_permissions(self, username, permissions):
+        """
+        Replace the permissions of a client.
+        :param username: the username
+        :param permissions: an iterable of permissions
+        :raises ValueError: if there is no such client
+        """
+        permissions = sorted(set(permissions))
+        with self._lock:
+            client = self._clients.get(username)
+            if not client:
+                raise ValueError("Unknown client: " + username)
+            self._write("UPDATE clients SET permissions=? WHERE username=?", [",".join(permissions), username])
+            self._set(username, client[0], permissions)
+
+    def change_permission(self, username, permission, grant):
+        """
+        Grant or revoke a single permission.
+        :return: the new permissions
+        :raises ValueError: if there is no such client
+        """
+        with self._lock:
+            permissions = self.get_permissions(username)
+            if permissions is None:
+                raise ValueError("Unknown client: " + username)
+            if grant:
+                permissions = permissions | {permission}
+            else:
+                permissions = permissions - {permission}
+            self.set_permissions(username, permissions)
+            return sorted(permissions)
+
+    def claim_admin(self, username):
+        """
+        Grant admin permission to a client if there is no admin yet.
+        :return: the new permissions, or None if there already is an admin
+        :raises ValueError: if there is no such client
+        """
+        with self._lock:
+            if self._admins:
+                return None
+            return self.change_permission(username, "admin", True)
+
+    def delete(self, username):
+        with self._lock:
+            self._write("DELETE FROM clients WHERE username=?", [username])
+            self._clients.pop(username, None)
+            self._admins.discard(username)
+
+    def reset(self):
+        """
+        Delete all clients and the database file. The store can't be used afterwards.
+        """
+        with self._lock:
+            self._db.close()
+            self._clients.clear()
+            self._admins.clear()
+            os.remove(self._db_path)
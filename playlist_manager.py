@@ -1,59 +1,138 @@
+import argparse
 import difflib
+import json
 import os
-import sqlite3
 import sys
 import threading
+import time
 import typing
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
 from os.path import join, realpath
 
 from gmusicapi import CallFailure
-from mutagen.id3 import ID3
-from mutagen.mp3 import MP3, HeaderNotFoundError
 
 from musicbot import config
+from musicbot.bulk_download import BulkDownload, lower_priority
+from musicbot.library import LibraryScanner
 from musicbot.music_apis import GMusicAPI, OfflineAPI, Song
 
-all_songs_lock = threading.Lock()
+
+class GMusicLibraryIndex(object):
+    """
+    An index from song IDs to the song info dicts of all songs in the GMusic library.
+    The library is fetched page by page on the first lookup and optionally cached in a file.
+    If a song is missing from a cached index, the library is fetched again once, since it may have changed.
+    """
+
+    def __init__(self, gmusic_client, cache_path=None, max_age=24 * 60 * 60):
+        """
+        Constructor
+
+        Keyword arguments:
+        gmusic_client -- the gmusicapi Mobileclient
+        cache_path -- the file to cache the index in, or None to disable caching
+        max_age -- the maximum age of the cache file in seconds
+        """
+        self._client = gmusic_client
+        self._cache_path = cache_path
+        self._max_age = max_age
+        self._index = None
+        # Whether the index has been fetched from GMusic in this run
+        self._fetched = False
+        self._lock = threading.Lock()
+
+    def _load_cache(self):
+        cache_path = self._cache_path
+        if not cache_path or not os.path.isfile(cache_path):
+            return None
+        if time.time() - os.path.getmtime(cache_path) > self._max_age:
+            return None
+        try:
+            with open(cache_path, "r") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError) as e:
+            print("Could not read library cache", e)
+            return None
+
+    def _save_cache(self, index):
+        cache_path = self._cache_path
+        if not cache_path:
+            return
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(index, cache_file)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print("Could not write library cache", e)
+
+    def _get_index(self):
+        with self._lock:
+            if self._index is None:
+                index = self._load_cache()
+                if index is None:
+                    print("Loading GMusic library")
+                    index = {}
+                    # A generator yielding pages of up to 1000 songs
+                    for page in self._client.get_all_songs(True):
+                        for song_json in page:
+                            if "id" in song_json:
+                                index[song_json['id']] = song_json
+                    self._save_cache(index)
+                    self._fetched = True
+                self._index = index
+            return self._index
+
+    def get(self, song_id):
+        """
+        Get the info dict of a song in the library.
+        :return: the info dict or None
+        """
+        song_json = self._get_index().get(song_id)
+        if song_json is None:
+            with self._lock:
+                if not self._fetched:
+                    self._clear()
+            # Another thread may have fetched the library in the meantime as well
+            song_json = self._get_index().get(song_id)
+        return song_json
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._index = None
+        if self._cache_path and os.path.isfile(self._cache_path):
+            os.remove(self._cache_path)
 
 
 def _lookup_gmusic_song(song_id):
     if song_id.startswith("T"):
         return gmusic_api.lookup_song(song_id)
-    if song_id in own_songs:
-        return own_songs[song_id]
-    with all_songs_lock:
-        if song_id in own_songs:
-            return own_songs[song_id]
-        result = None
-        for thousand_songs in all_songs:
-            for song_json in thousand_songs:
-                if "id" in song_json:
-                    song = gmusic_api._song_from_info(song_json)
-                    own_songs[song.song_id] = song
-                    if song.song_id == song_id:
-                        result = song
-            if result:
-                break
-        return result
+    song_json = library_index.get(song_id)
+    if song_json:
+        return gmusic_api._song_from_info(song_json)
+    return None
 
 
-def download_songs(song_ids: typing.Iterator[str]):
-    songs = filter(None, map(_lookup_gmusic_song, song_ids))
+def download_songs(manifest_id, song_ids: typing.Iterator[str]):
+    def _progress(finished, total, song_id, status):
+        print("[{}/{}] {} {}".format(finished, total, status, song_id))
 
-    def _load(song):
-        print("Loading song", song)
-        song.load()
-
-    with ThreadPoolExecutor(os.cpu_count() * 2) as thread_pool:
-        loading = thread_pool.map(_load, songs)
-        for _ in loading:
-            pass
+    lower_priority()
+    try:
+        summary = BulkDownload(manifest_id).run(song_ids, _lookup_gmusic_song, progress=_progress)
+    except KeyboardInterrupt:
+        print("Interrupted, run the import again to resume it.")
+        raise
+    print("Downloaded {} songs ({:.1f} MiB) in {:.0f}s: {:.1f} songs/min, {:.2f} MiB/s. "
+          "{} skipped, {} failed, {} retries.".format(
+        summary['done'], summary['bytes'] / (1024 * 1024), summary['duration'], summary['songs_per_minute'],
+        summary['mib_per_second'], summary['skipped'], summary['failed'], summary['retries']))
 
 
 def ask_for_action():
-    message = "\n(1) Add a playlist\n(2) Remove a playlist\n(3) Show playlists\n(4) Exit\nWhat do you want to do? "
+    message = "\n(1) Add a playlist\n(2) Remove a playlist\n(3) Show playlists\n(4) Rescan local playlists\n(5) Exit\nWhat do you want to do? "
     return input(message)
 
 
@@ -68,49 +147,18 @@ def handle_add_playlist():
         return
 
 
-def add_directory(playlist_id, directory_path, recursive, db):
-    isdir = os.path.isdir
-    isfile = os.path.isfile
-    for file_path in os.listdir(directory_path):
-        joined_path = join(directory_path, file_path)
-        if isdir(joined_path):
-            if recursive:
-                add_directory(playlist_id, joined_path, recursive, db)
-            else:
-                continue
+def print_scan_result(result):
+    print("Scanned {} in {:.1f}s: {} files, {} parsed, {} failed, {} removed, {} songs added to and {} removed from the playlist".format(
+        result['playlist_id'], result['duration'], result['files'], result['parsed'], result['failed'],
+        result['removed_files'], len(result['added_ids']), len(result['removed_ids'])))
 
-        if isfile(joined_path) and joined_path.endswith(".mp3"):
-            print("Loading song", joined_path)
-            song_id = joined_path[:-4]
-            try:
-                audio = MP3(joined_path, ID3=ID3)
-            except HeaderNotFoundError:
-                print("No ID3 header found for", joined_path)
-                continue
-            id3 = audio.tags
-            try:
-                title = id3['TIT2'][0]
-                if "TPE1" in id3:
-                    artist = id3['TPE1']
-                else:
-                    artist = id3.get("TPE2", None) or id3["TPE3"]
-                artist = artist[0]
-
-                if "APIC:" in id3:
-                    apic = id3['APIC:']
-                    db.execute("INSERT OR IGNORE INTO albumArts(songId, albumArt) VALUES(?, ?)",
-                               [song_id, apic.data])
-                duration = datetime.fromtimestamp(audio.info.length).strftime("%M:%S")
-                song = Song(song_id, offline_api, title, artist, duration=duration)
-            except (KeyError, IndexError) as e:
-                print("Could not load", joined_path, e)
-                continue
-
-            song_tuple = (song_id, song.title, song.description, str(song), joined_path, song.duration)
-            db.execute(
-                "INSERT OR IGNORE INTO songs(songId, title, description, stringRep, path, duration) VALUES(?, ?, ?, ?, ?, ?)",
-                song_tuple)
-            db.execute("INSERT OR IGNORE INTO playlistSongs(songId, playlistId) VALUES(?, ?)", (song_id, playlist_id))
+
+def handle_rescan():
+    scanner = LibraryScanner(offline_api)
+    if not scanner.get_directories():
+        print("There are no local playlists")
+    for result in scanner.rescan():
+        print_scan_result(result)
 
 
 def handle_add_local_playlist():
@@ -123,14 +171,8 @@ def handle_add_local_playlist():
 
     name = input("How do you want to call the playlist? ")
 
-    real_path = realpath(directory_path)
-    db = sqlite3.connect(offline_api._db_path)
-    try:
-        with db:
-            db.execute("INSERT INTO playlists(playlistId, name) VALUES(?, ?)", [real_path, name])
-            add_directory(real_path, real_path, recursive, db)
-    finally:
-        db.close()
+    print("Scanning directory")
+    print_scan_result(LibraryScanner(offline_api).add_directory(directory_path, name, recursive))
 
 
 def handle_add_gmusic_playlist():
@@ -172,17 +214,19 @@ def handle_add_gmusic_playlist():
     songs_path = config.get_songs_path()
 
     def _to_offline_song(gmusic_song):
-        if gmusic_song:
-            gmusic_song.song_id = realpath(join(songs_path, gmusic_song.song_id + ".mp3"))[:-4]
-            gmusic_song.api = offline_api
-        return gmusic_song
+        if not gmusic_song:
+            return None
+        # The GMusic song is cached by the GMusic API, so we create a copy instead of changing it
+        song_id = realpath(join(songs_path, gmusic_song.song_id + ".mp3"))[:-4]
+        return Song(song_id, offline_api, gmusic_song.title, gmusic_song.description, gmusic_song.albumArtUrl,
+                    gmusic_song.to_json()['str_rep'], gmusic_song.duration)
 
     song_ids = filter(None, map(_get_song_id, playlist))
     songs = filter(None, map(_to_offline_song, map(_lookup_gmusic_song, filter(None, map(_get_song_id, playlist)))))
 
     # Download songs
     print("Downloading songs in playlist", name)
-    download_songs(song_ids)
+    download_songs(share_token, song_ids)
 
     print("Updating playlists database")
     offline_api.add_playlist(share_token, name, list(songs))
@@ -253,14 +297,20 @@ def show_playlists():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the playlists of the offline API")
+    parser.add_argument("--rescan", action="store_true",
+                        help="rescan all local playlists for new, changed and removed files and exit")
+    args = parser.parse_args()
+
     offline_api = OfflineAPI()
+    if args.rescan:
+        handle_rescan()
+        sys.exit(0)
 
     try:
         gmusic_api = GMusicAPI()
         api = gmusic_api.get_api()
-        own_songs = {}
-        # This is a generator object loading 1000 songs at once
-        all_songs = api.get_all_songs(True)
+        library_index = GMusicLibraryIndex(api, join("config", "gmusic_library.json"))
     except ValueError:
         print("Couldn't connect to GMusic")
         sys.exit(1)
@@ -274,6 +324,8 @@ if __name__ == "__main__":
             elif action == "3":
                 show_playlists()
             elif action == "4":
+                handle_rescan()
+            elif action == "5":
                 break
             else:
                 print("Invalid input")